@@ -10,9 +10,10 @@ from flask_migrate import Migrate
 from flask_moment import Moment
 from flask_sqlalchemy import SQLAlchemy
 
+from app.replicas import RoutingSession, init_replicas
 from config import Config
 
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={"class_": RoutingSession})
 migrate = Migrate()
 login_manager = LoginManager()
 login_manager.login_view = "auth.login"
@@ -23,7 +24,13 @@ moment = Moment()
 def create_app(config_class=Config):
     app = Flask(__name__)
     app.config.from_object(config_class)
+    # GET requests to read-only views read from the read replicas, when there are any.
+    init_replicas(app)
     db.init_app(app)
+    # WAL, busy timeouts and larger caches for file-backed SQLite databases.
+    from app.database import init_sqlite_pragmas
+
+    init_sqlite_pragmas(app)
     migrate.init_app(app, db)
     login_manager.init_app(app)
     ckeditor.init_app(app)
@@ -39,6 +46,66 @@ def create_app(config_class=Config):
         else None
     )
 
+    # Use Elasticsearch for search when it is configured, otherwise fall back to the local SQLite full-text index.
+    from app.search import create_backend
+
+    app.search_backend = create_backend(app)
+
+    # Index changes are queued in the search outbox table and sent to the search backend by a background indexer.
+    from app.indexer import SearchIndexer
+
+    app.search_indexer = SearchIndexer(app)
+
+    # Rendered post cards, shared across requests and optionally across processes through Redis.
+    from app.cache import create_cache
+
+    app.fragment_cache = create_cache(app, "fragments", app.config["FRAGMENT_CACHE_SIZE"])
+
+    # The first pages of the Explore feed, shared by all users.
+    from app.explore import ExploreFeed
+
+    app.explore_feed = ExploreFeed(app)
+
+    # Logged in users are loaded from a small in-process cache instead of the database on every request.
+    from app.cache import LRUCache
+
+    app.user_cache = LRUCache(app.config["USER_CACHE_SIZE"], ttl=app.config["USER_CACHE_TTL"])
+
+    # Outgoing mail is sent by background workers.
+    from app.mail import MailQueue
+
+    app.mail_queue = MailQueue(app)
+
+    # Users' last seen times are buffered in memory and written in batches.
+    from app.activity import LastSeenBuffer
+
+    app.last_seen_buffer = LastSeenBuffer(app)
+
+    # Report lazy loads triggered by templates, which point at N+1 queries in list views.
+    if app.config["LAZY_LOAD_GUARD"] is None and app.debug:
+        app.config["LAZY_LOAD_GUARD"] = "log"
+    from app.instrumentation import init_lazy_load_guard, init_sql_instrumentation
+
+    init_lazy_load_guard(app)
+
+    # Count and time the queries of each request for /metrics and the slow query log.
+    init_sql_instrumentation(app)
+
+    # Compress HTML and JSON responses. Registered after the instrumentation, so the request timings include it.
+    from app.compression import init_compression
+
+    init_compression(app)
+
+    # Serve the fingerprinted static files from `flask assets build`, when they have been built.
+    from app.assets import init_assets
+
+    init_assets(app)
+
+    # Avatars generated or fetched once per size and served from a disk cache.
+    from app.avatars import Avatars
+
+    app.avatars = Avatars(app)
+
     # Register Blueprints
     from app.errors import bp as errors_bp
 
@@ -52,6 +119,14 @@ def create_app(config_class=Config):
 
     app.register_blueprint(main_bp)
 
+    from app.api import bp as api_bp
+
+    app.register_blueprint(api_bp, url_prefix="/api/v1")
+
+    from app.cli import bp as cli_bp
+
+    app.register_blueprint(cli_bp)
+
     # Setup log files
     if not app.debug and not app.testing:
         if not os.path.exists("logs"):
@@ -63,10 +138,16 @@ def create_app(config_class=Config):
         file_handler.setLevel(logging.INFO)
         app.logger.addHandler(file_handler)
 
+        slow_query_handler = RotatingFileHandler("logs/slow-queries.log", maxBytes=102400, backupCount=10)
+        slow_query_handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+        slow_query_logger = app.logger.getChild("slow_queries")
+        slow_query_logger.addHandler(slow_query_handler)
+        slow_query_logger.propagate = False
+
         app.logger.setLevel(logging.INFO)
         app.logger.info("Flask-Blog startup")
 
     return app
 
 
-from app import models
+from app import explore, identity, models
@@ -0,0 +1,70 @@
+import atexit
+import threading
+import time
+import weakref
+from datetime import datetime
+
+from app import db
+from app.models import User
+
+
+# Buffers to flush when the process exits. A weak set, so that it doesn't keep apps that are gone, like those of
+# finished tests, alive.
+_buffers = weakref.WeakSet()
+
+
+@atexit.register
+def _flush_buffers():
+    for buffer in list(_buffers):
+        buffer.flush()
+
+
+class LastSeenBuffer:
+    """Collects users' last activity times in memory and writes them to the database in batches.
+
+    Requests only record the time under a short lock. A background thread flushes everything recorded since the
+    previous flush every LAST_SEEN_FLUSH_INTERVAL seconds as one bulk UPDATE, and the buffer is flushed once more
+    when the process exits. With the interval set to None no thread is started and flush() has to be called.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        _buffers.add(self)
+
+    def touch(self, user_id, when=None):
+        with self._lock:
+            self._pending[user_id] = when or datetime.utcnow()
+            if self._thread is None and self.app.config["LAST_SEEN_FLUSH_INTERVAL"]:
+                self._thread = threading.Thread(target=self.run, name="last-seen-flusher", daemon=True)
+                self._thread.start()
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return 0
+        with self.app.app_context():
+            try:
+                db.session.execute(
+                    db.update(User), [{"id": user_id, "last_seen": when} for user_id, when in pending.items()]
+                )
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                # Put the times back for the next flush, unless the user has been seen again since.
+                with self._lock:
+                    for user_id, when in pending.items():
+                        self._pending.setdefault(user_id, when)
+                raise
+        return len(pending)
+
+    def run(self):
+        while True:
+            time.sleep(self.app.config["LAST_SEEN_FLUSH_INTERVAL"])
+            try:
+                self.flush()
+            except Exception:
+                self.app.logger.exception("Failed to write last seen times")
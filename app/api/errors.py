@@ -0,0 +1,31 @@
+from flask import jsonify
+from flask_login import current_user
+from werkzeug.exceptions import HTTPException
+from werkzeug.http import HTTP_STATUS_CODES
+
+from app.api import bp
+
+
+def error_response(status_code, message=None):
+    payload = {"error": HTTP_STATUS_CODES.get(status_code, "Unknown error")}
+    if message:
+        payload["message"] = message
+    return jsonify(payload), status_code
+
+
+@bp.before_request
+def require_login():
+    # The API uses the same session as the web pages, but answers with 401 instead of redirecting to the login form.
+    if not current_user.is_authenticated:
+        return error_response(401)
+
+
+@bp.errorhandler(HTTPException)
+def http_error(error):
+    # abort() descriptions are only passed on when a view set its own.
+    message = error.description if error.description != type(error).description else None
+    return error_response(error.code, message)
+
+
+# The app's handler for 404 would take precedence over the generic one above.
+bp.register_error_handler(404, http_error)
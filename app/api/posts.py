@@ -0,0 +1,163 @@
+import json
+
+from flask import abort, current_app, jsonify, request, stream_with_context, url_for
+from flask_login import current_user
+
+from app import db
+from app.api import bp
+from app.models import Post, User
+from app.pagination import paginate_by_cursor
+from app.replicas import use_replica
+
+
+def requested_fields():
+    """Return the post fields listed in ?fields=, or all of them."""
+    fields = request.args.get("fields")
+    if not fields:
+        return Post.API_FIELDS
+    fields = tuple(dict.fromkeys(field.strip() for field in fields.split(",") if field.strip()))
+    unknown = [field for field in fields if field not in Post.API_FIELDS]
+    if unknown:
+        abort(400, "Unknown fields: {}".format(", ".join(unknown)))
+    return fields
+
+
+def post_query(query, fields):
+    """Add the loader options for ``fields`` to a query for posts. Columns that are not asked for are not loaded."""
+    if "author" in fields:
+        query = Post.feed_query(query, body="body" in fields)
+    elif "body" not in fields:
+        query = query.options(db.defer(Post.body))
+    if "excerpt" not in fields:
+        query = query.options(db.defer(Post.excerpt))
+    return query
+
+
+def requested_limit():
+    limit = request.args.get("limit", current_app.config["POSTS_PER_PAGE"], type=int)
+    if limit < 1:
+        abort(400, "limit must be positive")
+    return min(limit, current_app.config["API_MAX_PER_PAGE"])
+
+
+def feed_response(query, endpoint, **values):
+    """Return one page of a feed of posts, paginated with the before/after cursors used by the web pages."""
+    fields = requested_fields()
+    limit = requested_limit()
+    try:
+        page = paginate_by_cursor(
+            post_query(query, fields),
+            Post,
+            limit,
+            before=request.args.get("before"),
+            after=request.args.get("after"),
+        )
+    except ValueError:
+        abort(400, "Invalid cursor")
+    values.update(limit=request.args.get("limit"), fields=request.args.get("fields"), _external=True)
+    return jsonify(
+        {
+            "items": [post.to_dict(fields) for post in page.items],
+            "next_cursor": page.next_cursor,
+            "prev_cursor": page.prev_cursor,
+            "_links": {
+                "self": request.url,
+                "next": url_for(endpoint, before=page.next_cursor, **values) if page.next_cursor else None,
+                "prev": url_for(endpoint, after=page.prev_cursor, **values) if page.prev_cursor else None,
+            },
+        }
+    )
+
+
+@bp.route("/timeline")
+def timeline():
+    return feed_response(current_user.followed_posts(), "api.timeline")
+
+
+@bp.route("/explore")
+@use_replica
+def explore():
+    return feed_response(Post.query.order_by(Post.timestamp.desc()), "api.explore")
+
+
+@bp.route("/search")
+@use_replica
+def search():
+    q = request.args.get("q", "").strip()
+    if not q:
+        abort(400, "Missing search query q")
+    fields = requested_fields()
+    page = request.args.get("page", 1, type=int)
+    try:
+        posts, total = Post.search(q, page, requested_limit(), after=request.args.get("after"))
+    except ValueError as e:
+        abort(400, str(e))
+    next_url = None
+    if posts.has_next:
+        next_url = url_for(
+            "api.search",
+            q=q,
+            page=page + 1,
+            after=posts.next_cursor,
+            limit=request.args.get("limit"),
+            fields=request.args.get("fields"),
+            _external=True,
+        )
+    return jsonify(
+        {
+            "items": [post.to_dict(fields) for post in posts.items],
+            "total": total,
+            # Totals are only counted up to SEARCH_TRACK_TOTAL_HITS.
+            "total_is_capped": posts.total_is_capped,
+            "_links": {"self": request.url, "next": next_url},
+        }
+    )
+
+
+@bp.route("/posts/<int:id>")
+@use_replica
+def get_post(id):
+    fields = requested_fields()
+    return jsonify(db.first_or_404(post_query(db.select(Post), fields).filter_by(id=id)).to_dict(fields))
+
+
+@bp.route("/posts")
+@use_replica
+def get_posts():
+    """Fetch the posts listed in ?ids=1,2,3 in one request, in the order given."""
+    try:
+        ids = list(dict.fromkeys(int(id) for id in request.args.get("ids", "").split(",") if id.strip()))
+    except ValueError:
+        abort(400, "ids must be a comma separated list of post ids")
+    if len(ids) > current_app.config["API_BATCH_LIMIT"]:
+        abort(400, "At most {} ids can be fetched at once".format(current_app.config["API_BATCH_LIMIT"]))
+    fields = requested_fields()
+    found = {}
+    if ids:
+        found = {post.id: post for post in post_query(Post.query.filter(Post.id.in_(ids)), fields)}
+    return jsonify(
+        {
+            "items": [found[id].to_dict(fields) for id in ids if id in found],
+            "missing": [id for id in ids if id not in found],
+        }
+    )
+
+
+@bp.route("/posts/export")
+@use_replica
+def export_posts():
+    """Stream every post, or every post of ?user=, as newline delimited JSON without holding them all in memory."""
+    fields = requested_fields()
+    query = Post.query.order_by(Post.id)
+    username = request.args.get("user")
+    if username:
+        user = db.first_or_404(db.select(User).filter_by(username=username))
+        query = query.filter_by(user_id=user.id)
+    rows = post_query(query, fields).yield_per(current_app.config["API_EXPORT_CHUNK_SIZE"])
+
+    @stream_with_context
+    def generate():
+        for post in rows:
+            yield json.dumps(post.to_dict(fields)) + "\n"
+
+    return current_app.response_class(generate(), mimetype="application/x-ndjson")
@@ -0,0 +1,20 @@
+from flask import jsonify
+
+from app import db
+from app.api import bp
+from app.api.posts import feed_response
+from app.models import Post, User
+from app.replicas import use_replica
+
+
+@bp.route("/users/<username>")
+@use_replica
+def get_user(username):
+    return jsonify(db.first_or_404(db.select(User).filter_by(username=username)).to_dict())
+
+
+@bp.route("/users/<username>/posts")
+@use_replica
+def get_user_posts(username):
+    user = db.first_or_404(db.select(User).filter_by(username=username))
+    return feed_response(user.posts.order_by(Post.timestamp.desc()), "api.get_user_posts", username=username)
@@ -0,0 +1,219 @@
+import gzip
+import hashlib
+import io
+import json
+import mimetypes
+import os
+import posixpath
+import re
+
+from flask import current_app, request, send_from_directory
+
+MANIFEST = "manifest.json"
+# Files of other types, like source maps and SCSS sources, are not part of the build.
+COMPRESSIBLE_EXTENSIONS = {".css", ".js", ".svg", ".json", ".txt", ".ttf", ".otf", ".eot", ".ico"}
+ASSET_EXTENSIONS = COMPRESSIBLE_EXTENSIONS | {".woff", ".woff2", ".png", ".jpg", ".jpeg", ".gif", ".webp"}
+IMAGE_EXTENSIONS = {".png", ".jpg", ".jpeg"}
+# Preferred first.
+ENCODINGS = {"br": ".br", "gzip": ".gz"}
+CSS_URL = re.compile(r"""url\(\s*(['"]?)([^'")]+)\1\s*\)""")
+
+
+def fingerprint(path, content):
+    """Return ``path`` with a hash of ``content`` before its extension, e.g. css/main.0a1b2c3d4e5f.css."""
+    root, ext = posixpath.splitext(path)
+    return "{}.{}{}".format(root, hashlib.sha256(content).hexdigest()[:12], ext)
+
+
+def compressors():
+    """Return the available compression functions by Content-Encoding. Brotli requires the optional brotli package."""
+    available = {"gzip": lambda data: gzip.compress(data, compresslevel=9, mtime=0)}
+    try:
+        import brotli
+    except ImportError:
+        pass
+    else:
+        available["br"] = lambda data: brotli.compress(data, quality=11)
+    return available
+
+
+def image_variants(content, ext, widths):
+    """Yield (suffix, extension, content, width) for the resized and WebP versions of an image.
+
+    Requires the optional Pillow package and yields nothing without it.
+    """
+    try:
+        from PIL import Image
+    except ImportError:
+        return
+
+    with Image.open(io.BytesIO(content)) as image:
+        image.load()
+    fmt = "PNG" if ext == ".png" else "JPEG"
+    sizes = [("", image)] + [
+        (f"-{width}w", image.resize((width, round(image.height * width / image.width)), Image.LANCZOS))
+        for width in widths
+        if width < image.width
+    ]
+    for suffix, resized in sizes:
+        for variant_ext, variant_fmt in ((ext, fmt), (".webp", "WEBP")):
+            if not suffix and variant_ext == ext:
+                continue
+            output = io.BytesIO()
+            resized.save(output, variant_fmt, quality=85, optimize=True)
+            yield suffix, variant_ext, output.getvalue(), resized.width
+
+
+def rewrite_css_urls(css, path, entries):
+    """Point the url() references of the stylesheet at ``path`` to the fingerprinted files they refer to."""
+
+    def replace(match):
+        quote, url = match.groups()
+        if re.match(r"^([a-z][a-z0-9+.\-]*:|//|#)", url, re.IGNORECASE):
+            return match.group(0)
+        name = posixpath.normpath(posixpath.join(posixpath.dirname(path), re.split(r"[?#]", url, maxsplit=1)[0]))
+        if name not in entries:
+            return match.group(0)
+        relative = posixpath.relpath(entries[name]["path"], posixpath.dirname(path))
+        # The fingerprint replaces cache busting query strings, fragments like #iefix are kept.
+        fragment = url[url.index("#") :] if "#" in url else ""
+        return "url({0}{1}{2}{0})".format(quote, relative, fragment)
+
+    return CSS_URL.sub(replace, css)
+
+
+def build_assets(source, target, image_widths=(), clean=False):
+    """Copy the static files in ``source`` to ``target`` under fingerprinted names and write the manifest.
+
+    Text files get gzip and brotli compressed copies next to them and images get resized and WebP variants, when the
+    optional packages are installed. Files of earlier builds are kept, so that processes still using the previous
+    manifest keep working, unless ``clean`` is set. Returns the manifest.
+    """
+    available = compressors()
+    entries = {}
+    paths = []
+    for directory, dirs, files in os.walk(source):
+        dirs[:] = sorted(d for d in dirs if os.path.abspath(os.path.join(directory, d)) != os.path.abspath(target))
+        for name in sorted(files):
+            if os.path.splitext(name)[1].lower() in ASSET_EXTENSIONS:
+                paths.append(os.path.relpath(os.path.join(directory, name), source).replace(os.sep, "/"))
+    # Stylesheets refer to fonts and images by name, so those are fingerprinted first.
+    paths.sort(key=lambda path: path.endswith(".css"))
+
+    written = {MANIFEST}
+
+    def write(path, content):
+        written.add(path)
+        destination = os.path.join(target, *path.split("/"))
+        if not os.path.exists(destination):
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+            with open(destination, "wb") as f:
+                f.write(content)
+
+    for path in paths:
+        with open(os.path.join(source, *path.split("/")), "rb") as f:
+            content = f.read()
+        ext = posixpath.splitext(path)[1].lower()
+        if ext == ".css":
+            content = rewrite_css_urls(content.decode("utf-8"), path, entries).encode("utf-8")
+        entry = {"path": fingerprint(path, content), "encodings": []}
+        write(entry["path"], content)
+        if ext in COMPRESSIBLE_EXTENSIONS:
+            for encoding, compress in available.items():
+                compressed = compress(content)
+                # Not worth a second request path when it barely saves anything.
+                if len(compressed) < len(content) * 0.9:
+                    write(entry["path"] + ENCODINGS[encoding], compressed)
+                    entry["encodings"].append(encoding)
+        if ext in IMAGE_EXTENSIONS:
+            root = posixpath.splitext(path)[0]
+            for suffix, variant_ext, variant, width in image_variants(content, ext, image_widths):
+                variant_path = fingerprint(root + suffix + variant_ext, variant)
+                write(variant_path, variant)
+                if not suffix:
+                    entry["width"] = width
+                entry.setdefault("variants", {})[suffix.lstrip("-") + variant_ext] = {
+                    "path": variant_path,
+                    "width": width,
+                }
+        entries[path] = entry
+
+    temporary = os.path.join(target, MANIFEST + ".tmp")
+    with open(temporary, "w", encoding="utf-8") as f:
+        json.dump(entries, f, indent=1, sort_keys=True)
+    os.replace(temporary, os.path.join(target, MANIFEST))
+
+    if clean:
+        for directory, dirs, files in os.walk(target):
+            for name in files:
+                path = os.path.relpath(os.path.join(directory, name), target).replace(os.sep, "/")
+                if path not in written:
+                    os.remove(os.path.join(directory, name))
+    return entries
+
+
+class Assets:
+    """The manifest written by `flask assets build`, used to serve the fingerprinted static files.
+
+    Without a manifest, or in debug mode where the source files are edited, static files are served as usual.
+    """
+
+    def __init__(self, app):
+        self.directory = app.config["ASSETS_BUILD_DIR"]
+        self.entries = {}
+        self.files = {}
+        self.names = {}
+        path = os.path.join(self.directory, MANIFEST)
+        if not app.debug and os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                self.load(json.load(f))
+
+    def load(self, entries):
+        self.entries = entries
+        self.files = {entry["path"]: entry["encodings"] for entry in entries.values()}
+        # Fingerprinted names by source name, where variants are named like img/photo-480w.webp and img/photo.webp.
+        self.names = {filename: entry["path"] for filename, entry in entries.items()}
+        for filename, entry in entries.items():
+            root = posixpath.splitext(filename)[0]
+            for name, variant in entry.get("variants", {}).items():
+                self.files[variant["path"]] = []
+                self.names[root + name if name.startswith(".") else "{}-{}".format(root, name)] = variant["path"]
+
+    def resolve(self, filename):
+        return self.names.get(filename, filename)
+
+
+def serve_static(filename):
+    """Serve a fingerprinted file, compressed if the client accepts it, or fall back to Flask's static files."""
+    assets = current_app.assets
+    encodings = assets.files.get(filename)
+    if encodings is None:
+        return current_app.send_static_file(filename)
+    path, encoding = filename, None
+    for candidate in ENCODINGS:
+        if candidate in encodings and request.accept_encodings[candidate]:
+            path, encoding = filename + ENCODINGS[candidate], candidate
+            break
+    # The type of the uncompressed file, not of a .gz or .br file.
+    mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+    response = send_from_directory(
+        assets.directory, path, mimetype=mimetype, max_age=current_app.config["ASSETS_MAX_AGE"]
+    )
+    if encoding:
+        response.content_encoding = encoding
+    if encodings:
+        response.vary.add("Accept-Encoding")
+    # The name changes whenever the content does, so the file never has to be checked again.
+    response.cache_control.immutable = True
+    return response
+
+
+def init_assets(app):
+    app.assets = Assets(app)
+    app.view_functions["static"] = serve_static
+
+    @app.url_defaults
+    def fingerprint_static_urls(endpoint, values):
+        # url_for("static", filename="css/main.css") links to the fingerprinted copy once the assets are built.
+        if endpoint == "static" and "filename" in values:
+            values["filename"] = app.assets.resolve(values["filename"])
@@ -6,6 +6,7 @@ from app import db
 from app.auth import bp
 from app.auth.email import send_password_reset_email
 from app.auth.forms import LoginForm, RegistrationForm, ResetPasswordForm, ResetPasswordRequestForm
+from app.identity import invalidate_user
 from app.models import User
 
 
@@ -81,6 +82,7 @@ def reset_password(token):
     if form.validate_on_submit():
         user.set_password(form.password.data)
         db.session.commit()
+        invalidate_user(user)
         flash("Your password has been reset.")
         return redirect(url_for("auth.login"))
     return render_template("auth/reset_password.html", form=form, title="Reset Password")
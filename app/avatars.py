@@ -0,0 +1,233 @@
+import colorsys
+import hashlib
+import os
+import re
+import struct
+import threading
+import zlib
+from time import time
+from urllib.error import HTTPError
+from urllib.request import urlopen
+
+from flask import current_app, request
+
+# MD5 hex digest of a lowercased email address, as used by Gravatar.
+DIGEST = re.compile(r"[0-9a-f]{32}")
+GRAVATAR_URL = "https://www.gravatar.com/avatar/{digest}?d=404&s={size}"
+GRID = 5
+BACKGROUND = (240, 240, 240)
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+IMAGE_SIGNATURES = [(PNG_SIGNATURE, "image/png"), (b"\xff\xd8\xff", "image/jpeg"), (b"GIF8", "image/gif")]
+
+
+def _png_chunk(kind, data):
+    return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+
+def encode_png(rows, palette):
+    """Return a PNG of ``rows``, equally long byte strings of indexes into ``palette``, a list of RGB tuples."""
+    header = struct.pack(">IIBBBBB", len(rows[0]), len(rows), 8, 3, 0, 0, 0)
+    # Every row starts with filter type 0, none.
+    raw = b"".join(b"\x00" + row for row in rows)
+    return b"".join(
+        [
+            PNG_SIGNATURE,
+            _png_chunk(b"IHDR", header),
+            _png_chunk(b"PLTE", b"".join(bytes(color) for color in palette)),
+            _png_chunk(b"IDAT", zlib.compress(raw, 9)),
+            _png_chunk(b"IEND", b""),
+        ]
+    )
+
+
+def identicon(digest, size):
+    """Return a PNG of ``size`` by ``size`` pixels with a symmetric 5x5 pattern and colour derived from ``digest``."""
+    value = int(digest, 16)
+    # The 15 lowest bits fill the left three columns, which are mirrored onto the right two.
+    cells = [[(value >> (row * 3 + min(col, GRID - 1 - col))) & 1 for col in range(GRID)] for row in range(GRID)]
+    red, green, blue = colorsys.hls_to_rgb((value >> 96) / 2**32, 0.55, 0.6)
+    palette = [BACKGROUND, (round(red * 255), round(green * 255), round(blue * 255))]
+
+    margin = size // 12
+    inner = size - 2 * margin
+
+    def cell(pixel):
+        return (pixel - margin) * GRID // inner if margin <= pixel < size - margin else None
+
+    columns = [cell(x) for x in range(size)]
+    lines = {}
+    rows = []
+    for y in range(size):
+        row = cell(y)
+        if row not in lines:
+            lines[row] = bytes(0 if row is None or col is None else cells[row][col] for col in columns)
+        rows.append(lines[row])
+    return encode_png(rows, palette)
+
+
+def image_type(data):
+    for signature, mimetype in IMAGE_SIGNATURES:
+        if data.startswith(signature):
+            return mimetype
+    return "application/octet-stream"
+
+
+class AvatarCache:
+    """Files in ``directory`` that take up at most about ``max_bytes``, evicting the least recently used first.
+
+    Reading a file updates its modification time, which eviction goes by. The total size is kept per process and
+    counted again from the directory on every eviction, so processes sharing the directory correct each other.
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._size = None
+
+    def path(self, name):
+        return os.path.join(self.directory, *name.split("/"))
+
+    def get(self, name):
+        path = self.path(name)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return data
+
+    def put(self, name, data):
+        path = self.path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Written under another name first, so that readers never see a partial file.
+        temporary = "{}.{}-{}.tmp".format(path, os.getpid(), threading.get_ident())
+        with open(temporary, "wb") as f:
+            f.write(data)
+        os.replace(temporary, path)
+        with self._lock:
+            if self._size is None:
+                self._size = sum(size for _, size, _ in self._files())
+            else:
+                self._size += len(data)
+            full = self._size > self.max_bytes
+        if full:
+            self.evict()
+
+    def _files(self):
+        files = []
+        for directory, dirs, names in os.walk(self.directory):
+            for name in names:
+                if name.endswith(".tmp"):
+                    continue
+                path = os.path.join(directory, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    # Evicted by another process.
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+        return files
+
+    def evict(self):
+        """Delete the least recently used files until the cache is down to 90% of max_bytes. Returns how many."""
+        with self._lock:
+            files = sorted(self._files())
+            total = sum(size for _, size, _ in files)
+            removed = 0
+            for _, size, path in files:
+                if total <= self.max_bytes * 0.9:
+                    break
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+                removed += 1
+            self._size = total
+        return removed
+
+
+class Avatars:
+    """Avatar images by the digest of the user's email address, made once per size and then served from disk.
+
+    Avatars are identicons generated here. With AVATAR_GRAVATAR, the user's Gravatar image is fetched instead and the
+    identicon is only used for addresses without one. Fetched images, and the fact that there was none, are kept for
+    AVATAR_GRAVATAR_TTL seconds, so that changes on Gravatar show up eventually.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.cache = AvatarCache(app.config["AVATAR_CACHE_DIR"], app.config["AVATAR_CACHE_MAX_BYTES"])
+        self._gravatar_down_until = 0
+
+    def identicon(self, digest, size):
+        name = "identicon/{}/{}-{}.png".format(digest[:2], digest, size)
+        data = self.cache.get(name)
+        if data is None:
+            data = identicon(digest, size)
+            self.cache.put(name, data)
+        return data
+
+    def fetch_gravatar(self, digest, size):
+        """Return the Gravatar image for ``digest``, or b"" if there is none. Raises OSError when the request fails."""
+        try:
+            with urlopen(
+                GRAVATAR_URL.format(digest=digest, size=size), timeout=self.app.config["AVATAR_GRAVATAR_TIMEOUT"]
+            ) as response:
+                data = response.read()
+        except HTTPError as e:
+            if e.code == 404:
+                return b""
+            raise
+        if image_type(data) == "application/octet-stream":
+            raise OSError("Gravatar returned something other than an image")
+        return data
+
+    def gravatar(self, digest, size):
+        """Return the Gravatar image for ``digest``, b"" if there is none, or None if Gravatar can't be reached.
+
+        After a failed request Gravatar is not asked again for AVATAR_GRAVATAR_RETRY seconds, so that an outage
+        doesn't make every avatar wait for the timeout.
+        """
+        # The time period is part of the name, so entries expire by no longer being looked up and get evicted later.
+        period = int(time() // self.app.config["AVATAR_GRAVATAR_TTL"])
+        name = "gravatar/{}/{}-{}-{}".format(digest[:2], digest, size, period)
+        data = self.cache.get(name)
+        if data is None:
+            if time() < self._gravatar_down_until:
+                return None
+            try:
+                data = self.fetch_gravatar(digest, size)
+            except OSError as e:
+                self._gravatar_down_until = time() + self.app.config["AVATAR_GRAVATAR_RETRY"]
+                self.app.logger.warning("Could not fetch the Gravatar for %s: %s", digest, e)
+                return None
+            # An empty file records that the address has no Gravatar.
+            self.cache.put(name, data)
+        return data
+
+    def image(self, digest, size):
+        """Return the image for ``digest`` and whether it is a stand-in for a Gravatar that couldn't be fetched."""
+        data = self.gravatar(digest, size) if self.app.config["AVATAR_GRAVATAR"] else b""
+        if data is None:
+            return self.identicon(digest, size), True
+        return data or self.identicon(digest, size), False
+
+
+def serve_avatar(digest, size):
+    config = current_app.config
+    data, fallback = current_app.avatars.image(digest, size)
+    response = current_app.response_class(data, mimetype=image_type(data))
+    response.set_etag(hashlib.md5(data).hexdigest())
+    response.cache_control.public = True
+    if fallback:
+        # Replaced by the Gravatar once it can be fetched again.
+        response.cache_control.max_age = config["AVATAR_GRAVATAR_RETRY"]
+    else:
+        response.cache_control.max_age = config["AVATAR_MAX_AGE"]
+        if not config["AVATAR_GRAVATAR"]:
+            # An identicon is derived from the digest in the URL alone, so it never changes.
+            response.cache_control.immutable = True
+    return response.make_conditional(request)
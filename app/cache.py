@@ -0,0 +1,136 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """Thread-safe in-process cache that evicts the least recently used entry once ``maxsize`` is reached.
+
+    With ``ttl`` set, entries also expire that many seconds after they were stored.
+    """
+
+    def __init__(self, maxsize, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                value, expires = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            if expires is not None and expires < time.monotonic():
+                del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + self.ttl if self.ttl else None)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+        }
+
+
+class RedisCache:
+    """Cache shared by all processes, stored in Redis. Requires the optional ``redis`` package."""
+
+    def __init__(self, url, prefix, timeout):
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+        self.timeout = timeout
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return value.decode("utf-8")
+
+    def set(self, key, value):
+        self.client.set(self.prefix + key, value.encode("utf-8"), ex=self.timeout)
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+    def clear(self):
+        for key in self.client.scan_iter(self.prefix + "*"):
+            self.client.delete(key)
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
+
+
+class TieredCache:
+    """An in-process LRU in front of a shared cache. Values found in the shared cache are copied into the LRU."""
+
+    def __init__(self, local, shared):
+        self.local = local
+        self.shared = shared
+
+    def get(self, key):
+        value = self.local.get(key)
+        if value is None:
+            value = self.shared.get(key)
+            if value is not None:
+                self.local.set(key, value)
+        return value
+
+    def set(self, key, value):
+        self.local.set(key, value)
+        self.shared.set(key, value)
+
+    def delete(self, key):
+        self.local.delete(key)
+        self.shared.delete(key)
+
+    def clear(self):
+        self.local.clear()
+        self.shared.clear()
+
+    def stats(self):
+        return {"local": self.local.stats(), "shared": self.shared.stats()}
+
+
+def create_cache(app, name, maxsize, ttl=None):
+    """Create an LRU cache, backed by Redis when CACHE_REDIS_URL is set.
+
+    Entries of a cache with a ``ttl`` expire after that many seconds in both tiers, otherwise they stay in the LRU
+    until evicted and in Redis for CACHE_TIMEOUT seconds.
+    """
+    local = LRUCache(maxsize, ttl=ttl)
+    if not app.config["CACHE_REDIS_URL"]:
+        return local
+    shared = RedisCache(app.config["CACHE_REDIS_URL"], f"microblog:{name}:", ttl or app.config["CACHE_TIMEOUT"])
+    return TieredCache(local, shared)
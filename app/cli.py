@@ -0,0 +1,185 @@
+import os
+import time
+
+import click
+from flask import Blueprint, current_app
+
+from app import db
+from app.assets import build_assets, compressors
+from app.indexer import drain
+from app.models import SearchableMixin, backfill_excerpts, rebuild_timelines, reconcile_counters
+from app.transfer import TABLES, export_rows, finish_import, import_rows, read_rows
+
+bp = Blueprint("cli", __name__, cli_group=None)
+
+
+@bp.cli.group()
+def timeline():
+    """Home timeline maintenance commands."""
+    pass
+
+
+@timeline.command()
+def rebuild():
+    """Rebuild the materialized home timeline of every user."""
+    rows = rebuild_timelines()
+    click.echo(f"Rebuilt timelines with {rows} entries.")
+
+
+@bp.cli.group()
+def counters():
+    """Denormalized user counter commands."""
+    pass
+
+
+@counters.command()
+def reconcile():
+    """Recompute the follower, following and post counters of every user."""
+    users = reconcile_counters()
+    click.echo(f"Repaired the counters of {users} users.")
+
+
+@bp.cli.group()
+def posts():
+    """Post maintenance commands."""
+    pass
+
+
+@posts.command("backfill-excerpts")
+@click.option("--all", "everything", is_flag=True, help="Recompute every excerpt, not only the missing ones.")
+@click.option("--batch-size", default=500, show_default=True, help="Posts updated per transaction.")
+def posts_backfill_excerpts(everything, batch_size):
+    """Compute the excerpts shown on post cards."""
+    count = backfill_excerpts(everything, batch_size)
+    click.echo(f"Computed the excerpts of {count} posts.")
+
+
+@bp.cli.group()
+def search():
+    """Search index commands."""
+    pass
+
+
+@search.command("drain")
+def search_drain():
+    """Send every due search outbox entry to the search engine and exit."""
+    total = 0
+    while count := drain():
+        total += count
+    click.echo(f"Processed {total} search outbox entries.")
+
+
+@search.command("worker")
+def search_worker():
+    """Drain the search outbox continuously."""
+    interval = current_app.config["SEARCH_OUTBOX_POLL_INTERVAL"]
+    click.echo(f"Draining the search outbox every {interval} seconds.")
+    while True:
+        try:
+            if drain():
+                continue
+        except Exception:
+            db.session.rollback()
+            current_app.logger.exception("Search worker failed to drain the outbox")
+        time.sleep(interval)
+
+
+@search.command("reindex")
+@click.option("--chunk-size", default=500, show_default=True, help="Rows per bulk request.")
+@click.option("--workers", default=4, show_default=True, help="Number of concurrent bulk requests.")
+@click.option(
+    "--new-index", is_flag=True, help="Build a new index, swap the alias to it when done and delete the old one."
+)
+@click.option("--resume", is_flag=True, help="Continue from the checkpoint of an interrupted run.")
+def search_reindex(chunk_size, workers, new_index, resume):
+    """Rebuild the search index from the database."""
+    for model in SearchableMixin.__subclasses__():
+        index = model.__tablename__
+
+        def progress(sent, elapsed):
+            click.echo(f"{index}: {sent} documents indexed ({sent / max(elapsed, 1e-6):.0f} docs/s)")
+
+        sent = model.reindex(
+            chunk_size=chunk_size,
+            workers=workers,
+            new_index=new_index,
+            checkpoint=current_app.config["SEARCH_REINDEX_CHECKPOINT"].format(index=index),
+            resume=resume,
+            progress=progress,
+        )
+        click.echo(f"Reindexed {sent} {index} documents.")
+
+
+@bp.cli.group()
+def assets():
+    """Static asset pipeline commands."""
+    pass
+
+
+@assets.command("build")
+@click.option("--clean", is_flag=True, help="Delete the files of earlier builds.")
+def assets_build(clean):
+    """Fingerprint, compress and resize the static files into ASSETS_BUILD_DIR."""
+    if "br" not in compressors():
+        click.echo("brotli is not installed, only gzip copies are written.")
+    entries = build_assets(
+        current_app.static_folder,
+        current_app.config["ASSETS_BUILD_DIR"],
+        current_app.config["ASSETS_IMAGE_WIDTHS"],
+        clean=clean,
+    )
+    variants = sum(len(entry.get("variants", {})) for entry in entries.values())
+    click.echo(
+        f"Built {len(entries)} assets and {variants} image variants in {current_app.config['ASSETS_BUILD_DIR']}."
+    )
+    if not variants:
+        click.echo("No image variants were written, they require Pillow.")
+
+
+@bp.cli.group()
+def data():
+    """Bulk export and import of users, posts and follows."""
+    pass
+
+
+def report_rows(name, count, started):
+    elapsed = time.perf_counter() - started
+    click.echo(f"{name}: {count} rows in {elapsed:.1f}s ({count / max(elapsed, 1e-6):.0f} rows/s)")
+
+
+@data.command("export")
+@click.argument("directory", type=click.Path(file_okay=False))
+@click.option("--format", "fmt", type=click.Choice(["ndjson", "csv"]), default="ndjson", show_default=True)
+@click.option("--chunk-size", default=1000, show_default=True, help="Rows fetched from the database at a time.")
+def data_export(directory, fmt, chunk_size):
+    """Write every user, post and follow to DIRECTORY, one file per table."""
+    os.makedirs(directory, exist_ok=True)
+    for name, table in TABLES.items():
+        started = time.perf_counter()
+        with open(os.path.join(directory, f"{name}.{fmt}"), "w", newline="", encoding="utf-8") as f:
+            count = export_rows(table, f, fmt, chunk_size)
+        report_rows(name, count, started)
+
+
+@data.command("import")
+@click.argument("directory", type=click.Path(exists=True, file_okay=False))
+@click.option("--format", "fmt", type=click.Choice(["ndjson", "csv"]), default="ndjson", show_default=True)
+@click.option("--batch-size", default=1000, show_default=True, help="Rows per INSERT statement.")
+def data_import(directory, fmt, batch_size):
+    """Load the files written by `flask data export` into an empty database."""
+    for name, table in TABLES.items():
+        path = os.path.join(directory, f"{name}.{fmt}")
+        if not os.path.exists(path):
+            click.echo(f"{name}: skipped, {path} does not exist")
+            continue
+        started = time.perf_counter()
+        with open(path, newline="", encoding="utf-8") as f:
+            count = import_rows(table, read_rows(table, f, fmt), batch_size)
+        report_rows(name, count, started)
+    # Search hooks never ran for the imported rows, so the index is rebuilt once at the end.
+    started = time.perf_counter()
+    indexed = finish_import()
+    click.echo(
+        f"Rebuilt counters, timelines, excerpts and caches, and reindexed {indexed} documents in "
+        f"{time.perf_counter() - started:.1f}s."
+    )
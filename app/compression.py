@@ -0,0 +1,118 @@
+import time
+import zlib
+
+from flask import current_app, g, request
+
+
+def brotli_available():
+    try:
+        import brotli  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+class Compressor:
+    """Incremental gzip or brotli compression of a response body. Brotli requires the optional brotli package."""
+
+    def __init__(self, encoding, level):
+        if encoding == "br":
+            import brotli
+
+            compressor = brotli.Compressor(quality=level)
+            self._compress, self._flush, self._finish = compressor.process, compressor.flush, compressor.finish
+        else:
+            # 31 selects the gzip container instead of a raw zlib stream.
+            compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+            self._compress, self._finish = compressor.compress, compressor.flush
+            self._flush = lambda: compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def compress(self, data, flush=False):
+        """Compress ``data``. With ``flush``, everything so far is output, so the client can decode it right away."""
+        output = self._compress(data)
+        return output + self._flush() if flush else output
+
+    def finish(self):
+        return self._finish()
+
+
+def negotiate_encoding(accept_encodings, brotli=True):
+    """Return "br" or "gzip", whichever the client prefers, or None if it accepts neither."""
+    candidates = ["br", "gzip"] if brotli else ["gzip"]
+    # On equal quality brotli wins, being listed first.
+    encoding = max(candidates, key=lambda candidate: accept_encodings[candidate])
+    return encoding if accept_encodings[encoding] else None
+
+
+def compress_stream(app, chunks, compressor, encoding, charset):
+    """Compress a streamed body chunk by chunk, flushing after each so that streaming stays incremental."""
+    bytes_in = bytes_out = 0
+    cpu_seconds = 0.0
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode(charset)
+            started = time.thread_time()
+            output = compressor.compress(chunk, flush=True)
+            cpu_seconds += time.thread_time() - started
+            bytes_in += len(chunk)
+            bytes_out += len(output)
+            if output:
+                yield output
+        started = time.thread_time()
+        output = compressor.finish()
+        cpu_seconds += time.thread_time() - started
+        bytes_out += len(output)
+        yield output
+    finally:
+        # Closing the original body runs the cleanup of stream_with_context() and similar wrappers.
+        if hasattr(chunks, "close"):
+            chunks.close()
+        app.metrics.observe_compression(encoding, bytes_in, bytes_out, cpu_seconds)
+
+
+def compress_response(response):
+    config = current_app.config
+    if (
+        not config["COMPRESS_ENABLED"]
+        # Files from send_file(), like static files, are passed through untouched.
+        or response.direct_passthrough
+        or response.status_code < 200
+        or response.status_code in (204, 206, 304)
+        or "Content-Encoding" in response.headers
+        or response.mimetype not in config["COMPRESS_MIMETYPES"]
+    ):
+        return response
+    if not response.is_streamed and response.calculate_content_length() < config["COMPRESS_MIN_SIZE"]:
+        return response
+    # BREACH: when a compressed page holds a secret next to text from the request, an attacker who can send requests
+    # on the user's behalf can guess the secret from the response sizes. The secret here is the CSRF token, which
+    # Flask-WTF keeps in g once a form has rendered it.
+    if config.get("WTF_CSRF_FIELD_NAME", "csrf_token") in g and (request.args or request.form):
+        return response
+
+    response.vary.add("Accept-Encoding")
+    encoding = negotiate_encoding(request.accept_encodings, brotli_available())
+    if encoding is None:
+        return response
+    compressor = Compressor(encoding, config["COMPRESS_BR_LEVEL"] if encoding == "br" else config["COMPRESS_LEVEL"])
+    if response.is_streamed:
+        app = current_app._get_current_object()
+        response.response = compress_stream(app, response.response, compressor, encoding, response.charset)
+        response.headers.pop("Content-Length", None)
+    else:
+        data = response.get_data()
+        started = time.thread_time()
+        compressed = compressor.compress(data) + compressor.finish()
+        current_app.metrics.observe_compression(encoding, len(data), len(compressed), time.thread_time() - started)
+        response.set_data(compressed)
+    response.headers["Content-Encoding"] = encoding
+    # The compressed body is a different byte sequence, so an ETag of the uncompressed one can only be weak.
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+
+def init_compression(app):
+    app.after_request(compress_response)
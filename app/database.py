@@ -0,0 +1,25 @@
+from functools import partial
+
+from app import db
+
+
+def is_sqlite_file(engine):
+    return engine.dialect.name == "sqlite" and engine.url.database not in (None, "", ":memory:")
+
+
+def _set_pragmas(pragmas, dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for name, value in pragmas.items():
+        cursor.execute(f"PRAGMA {name} = {value}")
+    cursor.close()
+
+
+def init_sqlite_pragmas(app):
+    """Run the SQLITE_PRAGMAS on every new connection to a file-backed SQLite database."""
+    pragmas = app.config["SQLITE_PRAGMAS"]
+    if not pragmas:
+        return
+    with app.app_context():
+        for engine in db.engines.values():
+            if is_sqlite_file(engine):
+                db.event.listen(engine, "connect", partial(_set_pragmas, pragmas))
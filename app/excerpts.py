@@ -0,0 +1,102 @@
+import re
+from html import escape
+from html.parser import HTMLParser
+from urllib.parse import urlsplit
+
+# Tags kept in excerpts. Other tags are dropped but their text is kept.
+ALLOWED_TAGS = {"a", "b", "blockquote", "br", "code", "em", "i", "li", "ol", "p", "pre", "s", "strong", "u", "ul"}
+# Tags dropped together with everything inside them.
+DROPPED_TAGS = {"script", "style", "template", "iframe", "object", "noscript"}
+VOID_TAGS = {"br"}
+# Tags that end an open tag of the same kind, as in "<li>one<li>two".
+SELF_CLOSING_SIBLINGS = {"li", "p"}
+# Links are kept when they are relative or use one of these schemes, which rules out javascript: URLs.
+SAFE_SCHEMES = {"http", "https", "mailto"}
+# Browsers remove tabs and newlines anywhere in a URL and control characters and spaces around it, so that
+# "java\tscript:" is a javascript: URL. Control characters are removed everywhere here, spaces at the ends.
+CONTROL_CHARACTERS = re.compile(r"[\x00-\x1f\x7f]")
+
+
+def clean_url(url):
+    """Return ``url`` as the browser would read it if it is relative or has a safe scheme, otherwise None.
+
+    Character references in ``url`` must have been decoded already, as HTMLParser does for attribute values.
+    """
+    url = CONTROL_CHARACTERS.sub("", url).strip(" ")
+    try:
+        scheme = urlsplit(url).scheme
+    except ValueError:
+        return None
+    return url if not scheme or scheme.lower() in SAFE_SCHEMES else None
+
+
+class ExcerptParser(HTMLParser):
+    def __init__(self, length):
+        super().__init__(convert_charrefs=True)
+        self.length = length
+        self.remaining = length
+        self.parts = []
+        self.open_tags = []
+        self.skipping = 0
+        self.truncated = False
+
+    def handle_starttag(self, tag, attrs):
+        if tag in DROPPED_TAGS:
+            self.skipping += 1
+            return
+        if self.truncated or self.skipping or tag not in ALLOWED_TAGS:
+            return
+        if tag in SELF_CLOSING_SIBLINGS and self.open_tags and self.open_tags[-1] == tag:
+            self.parts.append("</{}>".format(self.open_tags.pop()))
+        attributes = ""
+        href = clean_url(dict(attrs).get("href") or "") if tag == "a" else None
+        if href:
+            attributes = ' href="{}"'.format(escape(href))
+        self.parts.append("<{}{}>".format(tag, attributes))
+        if tag not in VOID_TAGS:
+            self.open_tags.append(tag)
+
+    def handle_endtag(self, tag):
+        if tag in DROPPED_TAGS:
+            self.skipping = max(self.skipping - 1, 0)
+            return
+        if self.truncated or self.skipping or tag not in self.open_tags:
+            return
+        # Close whatever was left open inside this tag, so that the excerpt stays balanced.
+        while self.open_tags:
+            open_tag = self.open_tags.pop()
+            self.parts.append("</{}>".format(open_tag))
+            if open_tag == tag:
+                break
+
+    def handle_data(self, data):
+        if self.truncated or self.skipping:
+            return
+        if len(data) > self.remaining:
+            cut = data[: self.remaining]
+            # Like Jinja's truncate filter, don't cut words in half, unless the first word is too long on its own.
+            if not data[self.remaining].isspace():
+                if " " in cut:
+                    cut = cut.rsplit(" ", 1)[0]
+                elif self.remaining < self.length:
+                    cut = ""
+            self.parts.append(escape(cut.rstrip(), quote=False) + "...")
+            self.truncated = True
+            return
+        self.remaining -= len(data)
+        self.parts.append(escape(data, quote=False))
+
+    def excerpt(self):
+        return "".join(self.parts) + "".join("</{}>".format(tag) for tag in reversed(self.open_tags))
+
+
+def make_excerpt(html, length=500):
+    """Return about the first ``length`` characters of the text of ``html`` as sanitized HTML.
+
+    Only a few formatting tags and safe links are kept, and every tag that is opened is closed, so the excerpt can be
+    marked safe in templates no matter where it was cut.
+    """
+    parser = ExcerptParser(length)
+    parser.feed(html or "")
+    parser.close()
+    return parser.excerpt()
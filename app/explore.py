@@ -0,0 +1,127 @@
+import json
+import threading
+from datetime import datetime
+
+from flask import current_app, has_app_context
+
+from app import db
+from app.cache import create_cache
+from app.models import Post
+from app.pagination import CursorPage, ListPagination, decode_cursor
+
+
+class ExploreFeed:
+    """The newest posts shown on the Explore page, which are the same for every user.
+
+    The first EXPLORE_CACHE_PAGES pages are cached as (timestamp, id) pairs, newest first, together with the total
+    number of posts. Committed inserts and deletes of posts are applied to the cached list instead of rebuilding it.
+    When the list has expired, one thread per process rebuilds it while the others wait for the result.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.cache = create_cache(app, "explore", 1, ttl=app.config["EXPLORE_CACHE_TTL"])
+        self._lock = threading.Lock()
+
+    @property
+    def size(self):
+        # One more post than fits on the cached pages tells whether the last of them has a next page.
+        return self.app.config["EXPLORE_CACHE_PAGES"] * self.app.config["POSTS_PER_PAGE"] + 1
+
+    def _load(self):
+        value = self.cache.get("feed")
+        if value is None:
+            return None
+        feed = json.loads(value)
+        return [(datetime.fromisoformat(timestamp), id) for timestamp, id in feed["entries"]], feed["total"]
+
+    def _store(self, entries, total):
+        feed = {"entries": [[timestamp.isoformat(), id] for timestamp, id in entries], "total": total}
+        self.cache.set("feed", json.dumps(feed, separators=(",", ":")))
+
+    def _build(self):
+        rows = db.session.execute(
+            db.select(Post.timestamp, Post.id).order_by(Post.timestamp.desc(), Post.id.desc()).limit(self.size)
+        ).all()
+        return [tuple(row) for row in rows], db.session.scalar(db.select(db.func.count(Post.id)))
+
+    def get(self):
+        """Return the cached (timestamp, id) pairs and the total number of posts."""
+        feed = self._load()
+        if feed is None:
+            with self._lock:
+                # Another thread may have rebuilt the list while this one was waiting for the lock.
+                feed = self._load()
+                if feed is None:
+                    feed = self._build()
+                    self._store(*feed)
+        return feed
+
+    def apply(self, added, removed):
+        """Add the (timestamp, id) pairs of new posts to the cached list and drop the ids of deleted ones."""
+        with self._lock:
+            feed = self._load()
+            if feed is None:
+                return
+            entries, total = feed
+            # Posts older than the last cached one may have uncached posts in front of them, unless none are missing.
+            oldest = entries[-1] if entries and len(entries) < total else None
+            removed = set(removed)
+            entries = [entry for entry in entries if entry[1] not in removed]
+            entries.extend(entry for entry in added if oldest is None or entry > oldest)
+            entries.sort(reverse=True)
+            self._store(entries[: self.size], total + len(added) - len(removed))
+
+    def paginate(self, per_page, page=None, before=None, after=None):
+        """Return the page of (timestamp, id) pairs paginate_feed() would return for the same arguments.
+
+        Returns None when the page reaches past the cached posts. Raises ValueError for a malformed cursor.
+        """
+        entries, total = self.get()
+        complete = len(entries) >= total
+        if page is not None:
+            page = max(page, 1)
+            items = entries[(page - 1) * per_page : page * per_page]
+            if page * per_page > len(entries) and not complete:
+                return None
+            return ListPagination(page, per_page, items, total)
+
+        if after:
+            cursor = decode_cursor(after)
+            if not complete and (not entries or cursor < entries[-1]):
+                return None
+            newer = [entry for entry in entries if entry > cursor]
+            if len(newer) > per_page:
+                return CursorPage(newer[-per_page:], has_next=True, has_prev=True)
+            # Reached the newest posts, so show a full first page instead of a partial one.
+            before = None
+
+        older = entries
+        if before:
+            cursor = decode_cursor(before)
+            older = [entry for entry in entries if entry < cursor]
+        rows = older[: per_page + 1]
+        if len(rows) <= per_page and not complete:
+            return None
+        return CursorPage(rows[:per_page], has_next=len(rows) > per_page, has_prev=before is not None)
+
+
+def record_changes(session, flush_context):
+    added, removed = session.info.setdefault("explore_changes", ([], []))
+    added.extend((obj.timestamp, obj.id) for obj in session.new if isinstance(obj, Post))
+    removed.extend(obj.id for obj in session.deleted if isinstance(obj, Post))
+
+
+def apply_changes(session):
+    changes = session.info.pop("explore_changes", None)
+    if changes and (changes[0] or changes[1]) and has_app_context():
+        current_app.explore_feed.apply(*changes)
+
+
+def discard_changes(session):
+    session.info.pop("explore_changes", None)
+
+
+db.event.listen(db.session, "after_flush", record_changes)
+db.event.listen(db.session, "after_commit", apply_changes)
+db.event.listen(db.session, "after_rollback", discard_changes)
@@ -0,0 +1,35 @@
+from flask import current_app, render_template
+from flask_login import current_user
+from markupsafe import Markup
+
+from app import db
+
+# Marks where the viewer-specific edit and delete links go in a cached post card.
+ACTIONS_PLACEHOLDER = "<!-- post-actions -->"
+
+
+def post_card_key(post):
+    return f"post-card:{post.id}:{post.version}"
+
+
+def render_post_card(post):
+    """Render a post card, reusing the cached HTML for this version of the post.
+
+    Only the edit and delete links depend on who is viewing, so they are rendered on every call and spliced in.
+    """
+    cache = current_app.fragment_cache
+    # Transient posts built from search documents may be incomplete and are never cached.
+    cacheable = db.inspect(post).persistent
+    html = cache.get(post_card_key(post)) if cacheable else None
+    if html is None:
+        html = render_template("_post_card.html", post=post)
+        if cacheable:
+            cache.set(post_card_key(post), html)
+    actions = ""
+    if current_user.is_authenticated and current_user.id == post.user_id:
+        actions = render_template("_post_actions.html", post=post)
+    return Markup(html.replace(ACTIONS_PLACEHOLDER, actions, 1))
+
+
+def invalidate_post_card(post):
+    current_app.fragment_cache.delete(post_card_key(post))
@@ -0,0 +1,57 @@
+from flask import current_app
+from flask_login import UserMixin
+
+from app import db, login_manager
+from app.models import User
+
+
+class SessionUser(UserMixin):
+    """Read-only snapshot of the logged in user, cached between requests.
+
+    It carries the fields that are read on most requests. Anything else is read from the ORM instance, which is only
+    loaded when needed. Routes that change the user must call rehydrate() and write to the instance it returns.
+    """
+
+    def __init__(self, user):
+        self.id = user.id
+        self.username = user.username
+        self.email = user.email
+        self.about_me = user.about_me
+
+    def __repr__(self):
+        return "<SessionUser {}>".format(self.username)
+
+    def __getattr__(self, name):
+        return getattr(self.rehydrate(), name)
+
+    def rehydrate(self):
+        # Session.get() uses the identity map, so this queries the database at most once per request.
+        return db.session.get(User, self.id)
+
+    avatar_digest = User.avatar_digest
+
+    def avatar(self, size, external=False):
+        return User.avatar(self, size, external)
+
+    def is_following(self, user):
+        return User.is_following(self, user)
+
+    def followed_posts(self):
+        return User.followed_posts(self)
+
+
+@login_manager.user_loader
+def load_user(id):
+    cache = current_app.user_cache
+    user = cache.get(int(id))
+    if user is None:
+        model = db.session.get(User, int(id))
+        if model is None:
+            return None
+        user = SessionUser(model)
+        cache.set(user.id, user)
+    return user
+
+
+def invalidate_user(user):
+    current_app.user_cache.delete(user.id)
@@ -0,0 +1,87 @@
+import threading
+from datetime import datetime, timedelta
+
+from flask import current_app
+
+from app import db
+from app.models import SearchableMixin, SearchOutbox
+from app.search import bulk_update
+
+
+def drain(batch_size=None):
+    """Send one batch of due search outbox entries to the search engine and return how many were processed."""
+    now = datetime.utcnow()
+    entries = (
+        SearchOutbox.query.filter(SearchOutbox.available_at <= now)
+        .order_by(SearchOutbox.id)
+        .limit(batch_size or current_app.config["SEARCH_OUTBOX_BATCH_SIZE"])
+        .all()
+    )
+    if not entries:
+        return 0
+
+    models = {cls.__tablename__: cls for cls in SearchableMixin.__subclasses__()}
+    pending = {}
+    for entry in entries:
+        pending.setdefault(entry.index, {}).setdefault(entry.object_id, []).append(entry)
+
+    for index, objects in pending.items():
+        model = models[index]
+        # Index whatever the database holds now rather than replaying each entry. Repeated updates to the same
+        # object coalesce into one document, and a stale entry can never resurrect a deleted row.
+        found = model.query.filter(model.id.in_(objects)).all()
+        deleted = set(objects) - {obj.id for obj in found}
+        try:
+            failed = bulk_update(index, found, deleted)
+        except Exception:
+            current_app.logger.exception("Search indexing of %d %s objects failed", len(objects), index)
+            failed = set(objects)
+        for object_id, object_entries in objects.items():
+            for entry in object_entries:
+                if object_id in failed:
+                    entry.attempts += 1
+                    entry.available_at = now + retry_delay(entry.attempts)
+                else:
+                    db.session.delete(entry)
+    db.session.commit()
+    return len(entries)
+
+
+def retry_delay(attempts):
+    delay = current_app.config["SEARCH_OUTBOX_RETRY_DELAY"] * 2 ** (attempts - 1)
+    return timedelta(seconds=min(delay, current_app.config["SEARCH_OUTBOX_RETRY_MAX_DELAY"]))
+
+
+class SearchIndexer:
+    """Background thread that drains the search outbox.
+
+    The thread is started on the first commit that writes to the outbox and is woken up by every commit after
+    that. It also polls, so entries waiting for a retry are picked up without new writes.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self._wakeup = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def notify(self):
+        if not self.app.config["SEARCH_INDEXER_THREAD"]:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self.run, name="search-indexer", daemon=True)
+                self._thread.start()
+        self._wakeup.set()
+
+    def run(self):
+        while True:
+            self._wakeup.wait(self.app.config["SEARCH_OUTBOX_POLL_INTERVAL"])
+            self._wakeup.clear()
+            with self.app.app_context():
+                try:
+                    while drain():
+                        pass
+                except Exception:
+                    db.session.rollback()
+                    self.app.logger.exception("Search indexer failed to drain the outbox")
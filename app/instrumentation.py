@@ -0,0 +1,272 @@
+import re
+import threading
+import time
+from datetime import datetime
+
+from flask import (
+    before_render_template,
+    current_app,
+    g,
+    got_request_exception,
+    has_app_context,
+    has_request_context,
+    request,
+    template_rendered,
+)
+
+from app import db
+
+
+class LazyLoadError(Exception):
+    pass
+
+
+def init_lazy_load_guard(app):
+    before_render_template.connect(_start_rendering, app)
+    template_rendered.connect(_stop_rendering, app)
+    # A template that raised never sends template_rendered, and would get the blame for the queries of the error
+    # handlers and whatever else runs later in the same context.
+    got_request_exception.connect(_forget_rendering, app)
+    app.teardown_request(_forget_rendering)
+
+
+def _start_rendering(app, template, context):
+    g.rendering_templates = g.get("rendering_templates", []) + [template.name]
+
+
+def _stop_rendering(app, template, context):
+    g.rendering_templates = g.get("rendering_templates", [])[:-1]
+
+
+def _forget_rendering(sender, **extra):
+    g.pop("rendering_templates", None)
+
+
+@db.event.listens_for(db.session, "do_orm_execute")
+def _check_lazy_load(orm_execute_state):
+    # A lazy load while a template renders usually means a list query is missing an eager load option and is
+    # running one extra query per row.
+    if not orm_execute_state.is_select or not has_app_context() or not g.get("rendering_templates"):
+        return
+    if orm_execute_state.lazy_loaded_from is None:
+        return
+    mode = current_app.config["LAZY_LOAD_GUARD"]
+    if mode is None:
+        return
+    message = "Lazy load on {} while rendering {}: {}".format(
+        orm_execute_state.lazy_loaded_from.class_.__name__,
+        g.rendering_templates[-1],
+        orm_execute_state.statement,
+    )
+    if mode == "raise":
+        raise LazyLoadError(message)
+    current_app.logger.warning(message)
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+
+    def render(self, name, labels):
+        lines = []
+        for bound, count in zip(self.buckets, self.counts):
+            lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {count}')
+        lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {self.count}')
+        lines.append(f"{name}_sum{{{labels}}} {self.sum}")
+        lines.append(f"{name}_count{{{labels}}} {self.count}")
+        return lines
+
+
+class Metrics:
+    """Per-route request latencies, query counts and response compression of this process, exposed in Prometheus
+    format by /metrics."""
+
+    LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+    QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+    def __init__(self):
+        self.latency = {}
+        self.queries = {}
+        self.query_seconds = {}
+        self.slow_queries = 0
+        # Responses, uncompressed bytes, compressed bytes and CPU seconds by Content-Encoding.
+        self.compression = {}
+        self._lock = threading.Lock()
+
+    def observe_request(self, endpoint, seconds, queries, query_seconds):
+        with self._lock:
+            self.latency.setdefault(endpoint, Histogram(self.LATENCY_BUCKETS)).observe(seconds)
+            self.queries.setdefault(endpoint, Histogram(self.QUERY_BUCKETS)).observe(queries)
+            self.query_seconds[endpoint] = self.query_seconds.get(endpoint, 0) + query_seconds
+
+    def observe_slow_query(self):
+        with self._lock:
+            self.slow_queries += 1
+
+    def observe_compression(self, encoding, bytes_in, bytes_out, cpu_seconds):
+        with self._lock:
+            totals = self.compression.setdefault(encoding, [0, 0, 0, 0.0])
+            totals[0] += 1
+            totals[1] += bytes_in
+            totals[2] += bytes_out
+            totals[3] += cpu_seconds
+
+    def render(self):
+        with self._lock:
+            lines = [
+                "# HELP microblog_request_duration_seconds Time spent handling requests.",
+                "# TYPE microblog_request_duration_seconds histogram",
+            ]
+            for endpoint, histogram in sorted(self.latency.items()):
+                lines += histogram.render("microblog_request_duration_seconds", f'endpoint="{endpoint}"')
+            lines += [
+                "# HELP microblog_request_queries SQL queries run per request.",
+                "# TYPE microblog_request_queries histogram",
+            ]
+            for endpoint, histogram in sorted(self.queries.items()):
+                lines += histogram.render("microblog_request_queries", f'endpoint="{endpoint}"')
+            lines += [
+                "# HELP microblog_request_query_seconds_total Time spent in SQL queries by requests.",
+                "# TYPE microblog_request_query_seconds_total counter",
+            ]
+            for endpoint, seconds in sorted(self.query_seconds.items()):
+                lines.append(f'microblog_request_query_seconds_total{{endpoint="{endpoint}"}} {seconds}')
+            lines += [
+                "# HELP microblog_slow_queries_total SQL queries slower than SLOW_QUERY_THRESHOLD.",
+                "# TYPE microblog_slow_queries_total counter",
+                f"microblog_slow_queries_total {self.slow_queries}",
+            ]
+            families = (
+                ("responses_total", "counter", "Compressed responses.", lambda t: t[0]),
+                ("bytes_in_total", "counter", "Response bytes before compression.", lambda t: t[1]),
+                ("bytes_out_total", "counter", "Response bytes after compression.", lambda t: t[2]),
+                (
+                    "ratio",
+                    "gauge",
+                    "Compressed size as a share of the uncompressed size.",
+                    lambda t: t[2] / t[1] if t[1] else 0,
+                ),
+                ("cpu_seconds_total", "counter", "CPU time spent compressing responses.", lambda t: t[3]),
+            )
+            for name, kind, description, value in families:
+                lines += [
+                    f"# HELP microblog_compression_{name} {description}",
+                    f"# TYPE microblog_compression_{name} {kind}",
+                ]
+                for encoding, totals in sorted(self.compression.items()):
+                    lines.append(f'microblog_compression_{name}{{encoding="{encoding}"}} {value(totals)}')
+        return lines
+
+
+def init_sql_instrumentation(app):
+    app.metrics = Metrics()
+    with app.app_context():
+        for engine in db.engines.values():
+            db.event.listen(engine, "before_cursor_execute", _start_query)
+            db.event.listen(engine, "after_cursor_execute", _finish_query)
+            db.event.listen(engine, "handle_error", _fail_query)
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
+
+
+def normalize_sql(statement):
+    """Collapse whitespace, literals and lists of parameters, so that the same query always logs the same way."""
+    statement = re.sub(r"\s+", " ", statement).strip()
+    statement = re.sub(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b", "?", statement)
+    return re.sub(r"\((?:\s*(?:\?|%\(\w+\)s|:\w+)\s*,)+\s*(?:\?|%\(\w+\)s|:\w+)\s*\)", "(...)", statement)
+
+
+def _route():
+    return (request.endpoint or "none") if has_request_context() else "-"
+
+
+def _start_request():
+    g.request_started = time.perf_counter()
+    g.sql_queries = 0
+    g.sql_seconds = 0
+
+
+def _finish_request(response):
+    started = g.pop("request_started", None)
+    if started is not None:
+        current_app.metrics.observe_request(
+            _route(), time.perf_counter() - started, g.get("sql_queries", 0), g.get("sql_seconds", 0)
+        )
+    return response
+
+
+def _start_query(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+
+def _finish_query(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["query_started"].pop()
+    if not has_app_context():
+        return
+    if has_request_context():
+        g.sql_queries = g.get("sql_queries", 0) + 1
+        g.sql_seconds = g.get("sql_seconds", 0) + elapsed
+    threshold = current_app.config["SLOW_QUERY_THRESHOLD"]
+    if threshold is not None and elapsed >= threshold:
+        current_app.metrics.observe_slow_query()
+        current_app.logger.getChild("slow_queries").warning(
+            "%.1f ms in %s: %s", elapsed * 1000, _route(), normalize_sql(statement)
+        )
+
+
+def _fail_query(exception_context):
+    started = exception_context.connection.info.get("query_started") if exception_context.connection else None
+    if started:
+        started.pop()
+
+
+def render_metrics(app):
+    """Return the Prometheus text exposition of the request metrics, cache statistics and search indexing lag."""
+    lines = app.metrics.render()
+
+    caches = {"fragments": app.fragment_cache, "users": app.user_cache, "explore": app.explore_feed.cache}
+    families = {
+        "microblog_cache_hits_total": ("counter", "Cache lookups that found an entry.", []),
+        "microblog_cache_misses_total": ("counter", "Cache lookups that found nothing.", []),
+        "microblog_cache_hit_ratio": ("gauge", "Share of cache lookups that found an entry.", []),
+    }
+    for name, cache in caches.items():
+        stats = cache.stats()
+        # A cache backed by Redis reports each tier separately.
+        for tier, tier_stats in (stats if "local" in stats else {"local": stats}).items():
+            labels = f'{{cache="{name}",tier="{tier}"}}'
+            lookups = tier_stats["hits"] + tier_stats["misses"]
+            families["microblog_cache_hits_total"][2].append(f"{labels} {tier_stats['hits']}")
+            families["microblog_cache_misses_total"][2].append(f"{labels} {tier_stats['misses']}")
+            families["microblog_cache_hit_ratio"][2].append(
+                f"{labels} {tier_stats['hits'] / lookups if lookups else 0}"
+            )
+    for family, (kind, description, samples) in families.items():
+        lines += [f"# HELP {family} {description}", f"# TYPE {family} {kind}"]
+        lines += [family + sample for sample in samples]
+
+    from app.models import SearchOutbox
+
+    pending, oldest = db.session.execute(
+        db.select(db.func.count(SearchOutbox.id), db.func.min(SearchOutbox.created))
+    ).one()
+    lag = (datetime.utcnow() - oldest).total_seconds() if oldest else 0
+    lines += [
+        "# HELP microblog_search_outbox_pending Changes waiting to be sent to the search index.",
+        "# TYPE microblog_search_outbox_pending gauge",
+        f"microblog_search_outbox_pending {pending}",
+        "# HELP microblog_search_indexing_lag_seconds Age of the oldest change waiting to be indexed.",
+        "# TYPE microblog_search_indexing_lag_seconds gauge",
+        f"microblog_search_indexing_lag_seconds {lag}",
+    ]
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,181 @@
+import atexit
+import os
+import queue
+import smtplib
+import threading
+import time
+import weakref
+from datetime import datetime
+from email.message import EmailMessage
+
+
+class Message:
+    def __init__(self, sender, recipient, subject, html, dedupe_key=None):
+        self.sender = sender
+        self.recipient = recipient
+        self.subject = subject
+        self.html = html
+        self.dedupe_key = dedupe_key
+        self.attempts = 0
+
+    def __repr__(self):
+        return "<Message {} to {}>".format(self.subject, self.recipient)
+
+    def as_email(self):
+        email = EmailMessage()
+        email["From"] = self.sender
+        email["To"] = self.recipient
+        email["Subject"] = self.subject
+        email.set_content(self.html, subtype="html")
+        return email
+
+
+class SendGridTransport:
+    def __init__(self, api_key):
+        import sendgrid
+
+        # One client for the life of the process instead of one per message.
+        self.client = sendgrid.SendGridAPIClient(api_key=api_key)
+
+    def send(self, message):
+        from sendgrid.helpers.mail import Content, Email, Mail, To
+
+        mail = Mail(Email(message.sender), To(message.recipient), message.subject, Content("text/html", message.html))
+        response = self.client.send(mail)
+        if response.status_code >= 300:
+            raise RuntimeError("SendGrid returned {}".format(response.status_code))
+
+
+class SMTPTransport:
+    def __init__(self, host, port, username=None, password=None, use_tls=False):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.use_tls = use_tls
+
+    def send(self, message):
+        with smtplib.SMTP(self.host, self.port, timeout=30) as smtp:
+            if self.use_tls:
+                smtp.starttls()
+            if self.username:
+                smtp.login(self.username, self.password)
+            smtp.send_message(message.as_email())
+
+
+class FileTransport:
+    """Writes every message to a .eml file in ``directory``, for development and tests."""
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def send(self, message):
+        os.makedirs(self.directory, exist_ok=True)
+        name = "{}-{}.eml".format(datetime.utcnow().strftime("%Y%m%d%H%M%S%f"), threading.get_ident())
+        with open(os.path.join(self.directory, name), "wb") as f:
+            f.write(message.as_email().as_bytes())
+
+
+def create_transport(app):
+    transport = app.config["MAIL_TRANSPORT"]
+    if transport is None:
+        transport = "sendgrid" if app.config["SENDGRID_API_KEY"] else "file"
+    if transport == "sendgrid":
+        return SendGridTransport(app.config["SENDGRID_API_KEY"])
+    if transport == "smtp":
+        return SMTPTransport(
+            app.config["MAIL_SERVER"],
+            app.config["MAIL_PORT"],
+            app.config["MAIL_USERNAME"],
+            app.config["MAIL_PASSWORD"],
+            app.config["MAIL_USE_TLS"],
+        )
+    if transport == "file":
+        return FileTransport(app.config["MAIL_FILE_DIR"])
+    raise ValueError("Unknown mail transport {!r}".format(transport))
+
+
+# Queues to drain when the process exits. A weak set, so that it doesn't keep apps that are gone, like those of finished
+# tests, alive.
+_queues = weakref.WeakSet()
+
+
+@atexit.register
+def _drain_queues():
+    for mail_queue in list(_queues):
+        mail_queue.drain()
+
+
+class MailQueue:
+    """Delivers outgoing mail from background worker threads so requests never wait on the mail provider.
+
+    Failed deliveries are retried with exponential backoff up to MAIL_MAX_ATTEMPTS times. Messages with the same
+    dedupe key as one queued in the last MAIL_DEDUPE_WINDOW seconds are dropped. With MAIL_WORKERS set to 0 no
+    threads are started and drain() has to be called.
+    """
+
+    def __init__(self, app, transport=None):
+        self.app = app
+        self.transport = transport
+        self._queue = queue.Queue()
+        self._recent = {}
+        self._lock = threading.Lock()
+        self._workers = []
+        _queues.add(self)
+
+    def get_transport(self):
+        # Created on first use so that importing the app does not need the transport's configuration.
+        if self.transport is None:
+            self.transport = create_transport(self.app)
+        return self.transport
+
+    def send(self, message):
+        now = time.monotonic()
+        with self._lock:
+            if message.dedupe_key is not None:
+                window = self.app.config["MAIL_DEDUPE_WINDOW"]
+                self._recent = {key: at for key, at in self._recent.items() if at > now - window}
+                if message.dedupe_key in self._recent:
+                    return False
+                self._recent[message.dedupe_key] = now
+            if not self._workers:
+                for i in range(self.app.config["MAIL_WORKERS"]):
+                    worker = threading.Thread(target=self.run, name="mail-worker-{}".format(i), daemon=True)
+                    worker.start()
+                    self._workers.append(worker)
+        self._queue.put(message)
+        return True
+
+    def deliver(self, message):
+        """Sends one message, sleeping and retrying on failure. Returns whether it was delivered."""
+        config = self.app.config
+        while True:
+            message.attempts += 1
+            try:
+                self.get_transport().send(message)
+                return True
+            except Exception:
+                if message.attempts >= config["MAIL_MAX_ATTEMPTS"]:
+                    self.app.logger.exception("Giving up on %r after %d attempts", message, message.attempts)
+                    return False
+                self.app.logger.warning("Failed to send %r, attempt %d", message, message.attempts, exc_info=True)
+                time.sleep(
+                    min(config["MAIL_RETRY_DELAY"] * 2 ** (message.attempts - 1), config["MAIL_RETRY_MAX_DELAY"])
+                )
+
+    def drain(self):
+        """Delivers everything queued in the calling thread. Returns the number of messages delivered."""
+        delivered = 0
+        while True:
+            try:
+                message = self._queue.get_nowait()
+            except queue.Empty:
+                return delivered
+            delivered += self.deliver(message)
+            self._queue.task_done()
+
+    def run(self):
+        while True:
+            message = self._queue.get()
+            self.deliver(message)
+            self._queue.task_done()
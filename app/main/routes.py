@@ -1,24 +1,81 @@
-from datetime import datetime
+import hashlib
+import hmac
+from time import time
 
-from flask import current_app, flash, g, redirect, render_template, request, url_for
+from flask import abort, current_app, flash, g, redirect, render_template, request, session, url_for
 from flask_login import current_user, login_required
 
 from app import db
+from app.avatars import DIGEST, serve_avatar
+from app.fragments import invalidate_post_card, render_post_card
+from app.identity import invalidate_user
+from app.instrumentation import render_metrics
 from app.main import bp
 from app.main.forms import CreatePostForm, EditProfileForm, EmptyForm, SearchForm
 from app.models import Post, User
+from app.pagination import paginate_by_cursor
+from app.replicas import use_replica
+
+bp.add_app_template_global(render_post_card)
+
+
+def paginate_feed(query, eager=True):
+    query = Post.feed_query(query) if eager else query
+    per_page = current_app.config["POSTS_PER_PAGE"]
+    # Page-number URLs are kept working, but they pay for OFFSET and a COUNT on every request.
+    page = request.args.get("page", type=int)
+    if page is not None:
+        return query.paginate(page=page, per_page=per_page, error_out=False)
+    try:
+        return paginate_by_cursor(
+            query, Post, per_page, before=request.args.get("before"), after=request.args.get("after")
+        )
+    except ValueError:
+        abort(400)
+
+
+def feed_validator(query):
+    """Ids and versions of the posts paginate_feed() returns for this request, read without loading the posts."""
+    posts = paginate_feed(query.with_entities(Post.id, Post.version, Post.timestamp), eager=False)
+    return [(post.id, post.version) for post in posts.items], posts.has_prev, posts.has_next
+
+
+def not_modified(*validators):
+    """Derive this page's ETag from ``validators`` and return a 304 response if the client's copy is current.
+
+    Pages depend on the viewer, so the current user is part of the ETag. The ETag and Cache-Control headers are set
+    on the response by set_validators().
+    """
+    etag = hashlib.sha1(repr((current_user.get_id(),) + validators).encode("utf-8")).hexdigest()
+    g.etag = etag
+    # A page with pending flashed messages has to be rendered to show them.
+    if request.if_none_match.contains_weak(etag) and "_flashes" not in session:
+        return current_app.response_class(status=304)
+
+
+@bp.after_request
+def set_validators(response):
+    etag = g.get("etag")
+    if etag is not None and response.status_code in (200, 304):
+        # Weak, because the page may be sent compressed. A 304 has to carry the same validators and Vary as the 200 it
+        # stands for, and compress_response() leaves 304s alone, so both are set here.
+        response.set_etag(etag, weak=True)
+        # Only the logged in browser may store the page, and it has to revalidate it every time.
+        response.headers["Cache-Control"] = "private, no-cache"
+        response.vary.add("Cookie")
+        response.vary.add("Accept-Encoding")
+    return response
 
 
 @bp.before_app_request
 def before_request():
+    # Static files and avatars are the same for everyone, and reading the session would make their responses vary by
+    # cookie.
+    if request.endpoint in ("static", "main.avatar"):
+        return
     if current_user.is_authenticated:
-        # Only update user's last seen time if it's been over 10 seconds since its last update.
-        # This also avoids database lock error due to multiple database commits when static assets are loaded
-        # which are independent requests.
-        time_difference = (datetime.utcnow() - current_user.last_seen).total_seconds()
-        if time_difference > 10:
-            current_user.last_seen = datetime.utcnow()
-            db.session.commit()
+        # Recorded in memory and written in batches by a background flusher, so requests never wait on this write.
+        current_app.last_seen_buffer.touch(current_user.id)
         g.search_form = SearchForm()
 
 
@@ -26,31 +83,62 @@ def before_request():
 @bp.route("/index")
 @login_required
 def index():
-    page = request.args.get("page", 1, type=int)
-    posts = current_user.followed_posts().paginate(
-        page=page, per_page=current_app.config["POSTS_PER_PAGE"], error_out=False
-    )
+    posts = paginate_feed(current_user.followed_posts())
     return render_template("index.html", title="Home", posts=posts, route="main.index")
 
 
 @bp.route("/explore")
 @login_required
+@use_replica
 def explore():
-    page = request.args.get("page", 1, type=int)
-    posts = Post.query.order_by(Post.timestamp.desc()).paginate(
-        page=page, per_page=current_app.config["POSTS_PER_PAGE"], error_out=False
-    )
+    query = Post.query.order_by(Post.timestamp.desc())
+    try:
+        cached = current_app.explore_feed.paginate(
+            current_app.config["POSTS_PER_PAGE"],
+            page=request.args.get("page", type=int),
+            before=request.args.get("before"),
+            after=request.args.get("after"),
+        )
+    except ValueError:
+        abort(400)
+    if cached is None:
+        # The page is older than the cached ones.
+        response = not_modified(feed_validator(query))
+        if response:
+            return response
+        posts = paginate_feed(query)
+    else:
+        ids = [id for _, id in cached.items]
+        order = (Post.timestamp.desc(), Post.id.desc())
+        versions = db.session.execute(db.select(Post.id, Post.version).where(Post.id.in_(ids)).order_by(*order))
+        response = not_modified([tuple(row) for row in versions], cached.has_prev, cached.has_next)
+        if response:
+            return response
+        cached.items = Post.feed_query().filter(Post.id.in_(ids)).order_by(*order).all()
+        posts = cached
     return render_template("index.html", title="Explore", posts=posts, route="main.explore")
 
 
 @bp.route("/user/<username>")
 @login_required
+@use_replica
 def user(username):
     user = User.query.filter_by(username=username).first_or_404()
-    page = request.args.get("page", 1, type=int)
-    posts = user.posts.order_by(Post.timestamp.desc()).paginate(
-        page=page, per_page=current_app.config["POSTS_PER_PAGE"], error_out=False
+    response = not_modified(
+        user.username,
+        user.about_me,
+        user.last_seen,
+        user.posts_count,
+        user.followers_count,
+        user.followed_count,
+        current_user.is_following(user),
+        feed_validator(user.posts.order_by(Post.timestamp.desc())),
+        # The follow form carries a CSRF token that expires, so a cached page must not outlive it.
+        int(time() // ((current_app.config.get("WTF_CSRF_TIME_LIMIT") or 3600) // 2)),
     )
+    if response:
+        return response
+    posts = paginate_feed(user.posts.order_by(Post.timestamp.desc()))
     form = EmptyForm()
     return render_template(
         "user.html", title=f"Profile: {user.username}", user=user, posts=posts, form=form, route="main.user"
@@ -62,11 +150,19 @@ def user(username):
 def edit_profile():
     form = EditProfileForm(current_user.username)
     if form.validate_on_submit():
-        current_user.username = form.username.data.lower()
-        current_user.about_me = form.about_me.data
+        user = current_user.rehydrate()
+        if form.username.data.lower() != user.username:
+            # Post cards show the author's name, so every cached card of this user is now stale.
+            db.session.execute(
+                db.update(Post).where(Post.user_id == user.id).values(version=Post.version + 1),
+                execution_options={"synchronize_session": False},
+            )
+        user.username = form.username.data.lower()
+        user.about_me = form.about_me.data
         db.session.commit()
+        invalidate_user(user)
         flash("Your changes have been saved.")
-        return redirect(url_for("main.user", username=current_user.username))
+        return redirect(url_for("main.user", username=user.username))
     elif request.method == "GET":
         form.username.data = current_user.username
         form.about_me.data = current_user.about_me
@@ -85,8 +181,10 @@ def follow(username):
         if user == current_user:
             flash("You cannot follow yourself!")
             return redirect(url_for("user", username=username))
-        current_user.follow(user)
+        current_user.rehydrate().follow(user)
         db.session.commit()
+        invalidate_user(current_user)
+        invalidate_user(user)
         flash(f"You are now following {username}.")
         return redirect(url_for("main.user", username=username))
     else:
@@ -105,8 +203,10 @@ def unfollow(username):
         if user == current_user:
             flash("You cannot unfollow yourself!")
             return redirect(url_for("main.user", username=username))
-        current_user.unfollow(user)
+        current_user.rehydrate().unfollow(user)
         db.session.commit()
+        invalidate_user(current_user)
+        invalidate_user(user)
         flash(f"You've unfollowed {username}.")
         return redirect(url_for("main.user", username=username))
     else:
@@ -118,7 +218,7 @@ def unfollow(username):
 def new_post():
     form = CreatePostForm()
     if form.validate_on_submit():
-        post = Post(title=form.title.data, subtitle=form.subtitle.data, body=form.body.data, author=current_user)
+        post = Post(title=form.title.data, subtitle=form.subtitle.data, body=form.body.data, user_id=current_user.id)
         db.session.add(post)
         db.session.commit()
         flash("Your post is now live!")
@@ -128,8 +228,13 @@ def new_post():
 
 @bp.route("/post/<int:post_id>", methods=["GET", "POST"])
 @login_required
+@use_replica
 def show_post(post_id):
-    post = Post.query.get(post_id)
+    # Editing a post or renaming its author bumps the post's version.
+    response = not_modified(db.first_or_404(db.select(Post.version).filter_by(id=post_id)))
+    if response:
+        return response
+    post = Post.feed_query(body=True).filter_by(id=post_id).first_or_404()
     return render_template("single_post.html", post=post, title=post.title)
 
 
@@ -142,6 +247,7 @@ def edit_post(post_id):
         return redirect(url_for("main.index", post_id=post.id))
     form = CreatePostForm(title=post.title, subtitle=post.subtitle, body=post.body)
     if form.validate_on_submit():
+        invalidate_post_card(post)
         post.title = form.title.data
         post.subtitle = form.subtitle.data
         post.body = form.body.data
@@ -158,19 +264,38 @@ def delete_post(post_id):
     if current_user.id != post.user_id:
         flash("Sorry, you don't have permission to delete this post. Please only edit posts you made.")
         return redirect(url_for("main.index", post_id=post.id))
+    invalidate_post_card(post)
     db.session.delete(post)
     db.session.commit()
     flash("Post has been deleted.")
     return redirect(url_for("main.index"))
 
 
+@bp.route("/metrics")
+def metrics():
+    token = current_app.config["METRICS_TOKEN"]
+    if not token:
+        # Route names, timings and queue sizes are not for the public, so without a token only development gets them.
+        if not (current_app.debug or current_app.testing):
+            abort(404)
+    elif not hmac.compare_digest(request.headers.get("Authorization", "").encode(), f"Bearer {token}".encode()):
+        abort(401)
+    return render_metrics(current_app), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+
 @bp.route("/search")
 @login_required
+@use_replica
 def search():
     if not g.search_form.validate():
         return redirect(url_for("main.explore"))
     page = request.args.get("page", 1, type=int)
-    posts, total = Post.search(g.search_form.q.data, page)
+    try:
+        posts, total = Post.search(
+            g.search_form.q.data, page, after=request.args.get("after"), before=request.args.get("before")
+        )
+    except ValueError:
+        abort(400)
     return render_template("search.html", title="Search", route="main.search", posts=posts, total=total)
 
 
@@ -178,3 +303,10 @@ def search():
 @login_required
 def about():
     return render_template("about.html", title="About Microblog")
+
+
+@bp.route("/avatar/<digest>/<int:size>")
+def avatar(digest, size):
+    if not DIGEST.fullmatch(digest) or not 0 < size <= current_app.config["AVATAR_MAX_SIZE"]:
+        abort(404)
+    return serve_avatar(digest, size)
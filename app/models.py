@@ -3,66 +3,145 @@ from hashlib import md5
 from time import time
 
 import jwt
-from elasticsearch.exceptions import ConnectionError
-from flask import current_app
+from flask import current_app, url_for
 from flask_login import UserMixin
+from sqlalchemy.orm.attributes import set_committed_value
 from werkzeug.security import check_password_hash, generate_password_hash
 
-from app import db, login_manager
-from app.search import add_to_index, query_index, remove_from_index
+from app import db
+from app.excerpts import make_excerpt
+from app.pagination import SearchPagination, decode_sort_values
+from app.search import query_index, reindex
 
 
 class SearchableMixin:
     @classmethod
-    def search(cls, expression, page):
-        ids, total = query_index(cls.__tablename__, expression)
-        if total == 0:
-            return cls.query.filter_by(id=0), 0
-        when = {}
-        for i in range(len(ids)):
-            when[ids[i]] = i
-        return (
-            cls.query.filter(cls.id.in_(ids))
-            .order_by(db.case(when, value=cls.id))
-            .paginate(page=page, per_page=current_app.config["POSTS_PER_PAGE"], error_out=False),
+    def search(cls, expression, page, per_page=None, after=None, before=None):
+        """Return one page of search results and the total number of hits.
+
+        Pages past SEARCH_MAX_RESULT_WINDOW are reached with the ``after`` cursor of the page before them or the
+        ``before`` cursor of the page after them. Raises ValueError for a malformed cursor or a page number that can't
+        be reached without one.
+        """
+        per_page = per_page or current_app.config["POSTS_PER_PAGE"]
+        max_offset = current_app.config["SEARCH_MAX_RESULT_WINDOW"]
+        from_source = current_app.config["SEARCH_RENDER_FROM_SOURCE"]
+        cursor = after or before
+        if not cursor and page * per_page > max_offset:
+            raise ValueError(f"Page {page} is past the search result window")
+        hits, total = query_index(
+            cls.__tablename__,
+            expression,
+            cls.__searchable__,
+            page,
+            per_page,
+            search_after=decode_sort_values(cursor) if cursor else None,
+            reverse=bool(before and not after),
+            source=from_source,
+        )
+        if from_source:
+            items = cls.from_search_hits(hits)
+        else:
+            ids = [hit["id"] for hit in hits]
+            found = {obj.id: obj for obj in cls.feed_query().filter(cls.id.in_(ids))} if ids else {}
+            # Keep the search engine's ranking. Ids whose rows are gone but still in the index are skipped.
+            items = [found[id] for id in ids if id in found]
+        pagination = SearchPagination(
+            page,
+            per_page,
+            items,
             total,
+            max_total=current_app.config["SEARCH_TRACK_TOTAL_HITS"],
+            max_offset=max_offset,
+            first_sort=hits[0]["sort"] if hits else None,
+            last_sort=hits[-1]["sort"] if hits else None,
         )
+        return pagination, total
 
     @classmethod
-    def before_commit(cls, session):
-        session._changes = {"add": list(session.new), "update": list(session.dirty), "delete": list(session.deleted)}
+    def feed_query(cls, query=None):
+        """Return ``query``, or a query for all rows, with the loader options needed to render a list of results."""
+        return cls.query if query is None else query
 
     @classmethod
-    def after_commit(cls, session):
-        try:
-            for obj in session._changes["add"]:
-                if isinstance(obj, SearchableMixin):
-                    add_to_index(obj.__tablename__, obj)
-            for obj in session._changes["update"]:
-                if isinstance(obj, SearchableMixin):
-                    add_to_index(obj.__tablename__, obj)
-            for obj in session._changes["delete"]:
+    def from_search_hits(cls, hits):
+        """Build transient objects from the documents stored in the search index, without querying the database."""
+        items = []
+        for hit in hits:
+            obj = cls(**{field: _from_source(cls.__table__.c[field], value) for field, value in hit["source"].items()})
+            obj.id = hit["id"]
+            items.append(obj)
+        return items
+
+    @classmethod
+    def after_flush(cls, session, flush_context):
+        # Record index changes in the search outbox as part of the same transaction, so they are committed or rolled
+        # back together with the rows they describe. The search indexer sends them to the search backend later.
+        if not current_app.search_backend:
+            return
+        entries = []
+        for op, objs in (("add", session.new), ("add", session.dirty), ("delete", session.deleted)):
+            for obj in objs:
                 if isinstance(obj, SearchableMixin):
-                    remove_from_index(obj.__tablename__, obj)
-            session._changes = None
-        except ConnectionError:
-            print(
-                "Failed to establish a connection to Elasticsearch. Please make sure Elasticsearch service is running."
-            )
+                    entries.append({"index": obj.__tablename__, "object_id": obj.id, "op": op})
+        if entries:
+            session.connection().execute(SearchOutbox.__table__.insert(), entries)
+            session.info["search_outbox_pending"] = True
+
+    @classmethod
+    def after_commit(cls, session):
+        if session.info.pop("search_outbox_pending", False):
+            current_app.search_indexer.notify()
 
     @classmethod
-    def reindex(cls):
-        for obj in cls.query:
-            add_to_index(cls.__tablename__, obj)
+    def reindex(cls, **kwargs):
+        return reindex(cls, **kwargs)
 
 
-db.event.listen(db.session, "before_commit", SearchableMixin.before_commit)
+def _from_source(column, value):
+    # Documents come back from the search backend as JSON or SQLite text.
+    if isinstance(value, str) and isinstance(column.type, db.DateTime):
+        return datetime.fromisoformat(value)
+    if isinstance(value, str) and isinstance(column.type, db.Integer):
+        return int(value)
+    return value
+
+
+db.event.listen(db.session, "after_flush", SearchableMixin.after_flush)
 db.event.listen(db.session, "after_commit", SearchableMixin.after_commit)
 
+
+class SearchOutbox(db.Model):
+    __tablename__ = "search_outbox"
+    id = db.Column(db.Integer, primary_key=True)
+    index = db.Column(db.String(64), nullable=False)
+    object_id = db.Column(db.Integer, nullable=False)
+    op = db.Column(db.String(8), nullable=False)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    created = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    # Failed entries are retried with exponential backoff and become available again at this time.
+    available_at = db.Column(db.DateTime, nullable=False, index=True, default=datetime.utcnow)
+
+    def __repr__(self):
+        return "<SearchOutbox {} {} {}>".format(self.op, self.index, self.object_id)
+
+
+# The primary key serves lookups by follower, the second index lookups by followed user.
 followers = db.Table(
     "followers",
-    db.Column("follower_id", db.Integer, db.ForeignKey("user.id")),
-    db.Column("followed_id", db.Integer, db.ForeignKey("user.id")),
+    db.Column("follower_id", db.Integer, db.ForeignKey("user.id"), primary_key=True),
+    db.Column("followed_id", db.Integer, db.ForeignKey("user.id"), primary_key=True),
+    db.Index("ix_followers_followed_id", "followed_id", "follower_id"),
+)
+
+# Materialized home timeline. Each row delivers one post to one user's home feed, so reading the feed is a single
+# range scan on (user_id, timestamp) instead of a join on followers unioned with the user's own posts.
+timeline = db.Table(
+    "timeline",
+    db.Column("user_id", db.Integer, db.ForeignKey("user.id"), primary_key=True),
+    db.Column("post_id", db.Integer, db.ForeignKey("post.id"), primary_key=True),
+    db.Column("timestamp", db.DateTime, nullable=False),
+    db.Index("ix_timeline_user_id_timestamp", "user_id", "timestamp"),
 )
 
 
@@ -75,6 +154,11 @@ class User(db.Model, UserMixin):
     posts = db.relationship("Post", backref="author", lazy="dynamic")
     about_me = db.Column(db.String(140))
     last_seen = db.Column(db.DateTime, default=datetime.utcnow)
+    # Denormalized counts shown on the profile page. Kept up to date by follow(), unfollow() and the Post insert and
+    # delete events, and repaired in bulk by reconcile_counters().
+    followers_count = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    followed_count = db.Column(db.Integer, nullable=False, default=0, server_default="0")
+    posts_count = db.Column(db.Integer, nullable=False, default=0, server_default="0")
     followed = db.relationship(
         "User",
         secondary=followers,
@@ -93,28 +177,99 @@ class User(db.Model, UserMixin):
     def check_password(self, password):
         return check_password_hash(self.password_hash, password)
 
-    def avatar(self, size):
-        digest = md5(self.email.lower().encode("utf-8")).hexdigest()
-        return f"https://www.gravatar.com/avatar/{digest}?d=retro&s={size}"
+    def rehydrate(self):
+        # Counterpart of SessionUser.rehydrate(), so current_user can be either.
+        return self
+
+    @property
+    def avatar_digest(self):
+        # Memoized, as pages show the same users' avatars many times. Kept with the address it was computed from, so
+        # that a changed address gets a new digest. Read through __dict__, where SessionUser has no fallback lookup.
+        email = self.email.lower()
+        memo = self.__dict__.get("_avatar_digest")
+        if memo is None or memo[0] != email:
+            memo = email, md5(email.encode("utf-8")).hexdigest()
+            self.__dict__["_avatar_digest"] = memo
+        return memo[1]
+
+    def avatar(self, size, external=False):
+        return url_for("main.avatar", digest=self.avatar_digest, size=size, _external=external)
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "username": self.username,
+            "about_me": self.about_me,
+            "last_seen": self.last_seen.isoformat() + "Z" if self.last_seen else None,
+            "posts_count": self.posts_count,
+            "followers_count": self.followers_count,
+            "followed_count": self.followed_count,
+            "avatar": self.avatar(128, external=True),
+            "url": url_for("main.user", username=self.username, _external=True),
+        }
 
     def follow(self, user):
         if not self.is_following(user):
             self.followed.append(user)
+            adjust_counters(self, followed_count=1)
+            adjust_counters(user, followers_count=1)
+            if current_app.config["TIMELINE_ENABLED"]:
+                # Backfill the new follower's timeline with the posts that were fanned out on write. Posts that
+                # were not fanned out are pulled at read time by followed_posts().
+                db.session.execute(
+                    timeline.insert().from_select(
+                        ["user_id", "post_id", "timestamp"],
+                        db.select(db.literal(self.id), Post.id, Post.timestamp).where(
+                            Post.user_id == user.id, Post.fanned_out.is_(True)
+                        ),
+                    )
+                )
 
     def unfollow(self, user):
         if self.is_following(user):
             self.followed.remove(user)
+            adjust_counters(self, followed_count=-1)
+            adjust_counters(user, followers_count=-1)
+            if current_app.config["TIMELINE_ENABLED"]:
+                db.session.execute(
+                    timeline.delete().where(
+                        timeline.c.user_id == self.id,
+                        timeline.c.post_id.in_(db.select(Post.id).where(Post.user_id == user.id)),
+                    )
+                )
 
     def is_following(self, user):
-        return self.followed.filter(followers.c.followed_id == user.id).count() > 0
+        return (
+            db.session.query(followers.c.follower_id)
+            .filter(followers.c.follower_id == self.id, followers.c.followed_id == user.id)
+            .first()
+            is not None
+        )
 
     def followed_posts(self):
-        followed = Post.query.join(followers, (followers.c.followed_id == Post.user_id)).filter(
-            followers.c.follower_id == self.id
-        )
-        # Add the current user to its own followed user, so user's own posts will be included in followed posts.
-        own = Post.query.filter_by(user_id=self.id)
-        return followed.union(own).order_by(Post.timestamp.desc())
+        # The union only combines post ids, so that its deduplication never has to read whole posts and their bodies.
+        if current_app.config["TIMELINE_ENABLED"]:
+            materialized = db.select(timeline.c.post_id.label("id")).where(timeline.c.user_id == self.id)
+            # Posts from popular authors are not fanned out on write, so they are pulled in at read time.
+            pulled = (
+                db.select(Post.id)
+                .join(followers, (followers.c.followed_id == Post.user_id))
+                .where(followers.c.follower_id == self.id)
+                .where(Post.fanned_out.is_(False))
+            )
+            # So are the user's own posts from before the timeline was enabled, until `flask timeline rebuild` runs.
+            own = db.select(Post.id).where(Post.user_id == self.id, Post.fanned_out.is_(False))
+            ids = db.union(materialized, pulled, own).subquery()
+        else:
+            followed = (
+                db.select(Post.id)
+                .join(followers, (followers.c.followed_id == Post.user_id))
+                .where(followers.c.follower_id == self.id)
+            )
+            # Add the current user to its own followed user, so user's own posts will be included in followed posts.
+            own = db.select(Post.id).where(Post.user_id == self.id)
+            ids = db.union(followed, own).subquery()
+        return Post.query.join(ids, ids.c.id == Post.id).order_by(Post.timestamp.desc())
 
     def get_reset_password_token(self, expires_in=600):
         return jwt.encode(
@@ -133,17 +288,195 @@ class User(db.Model, UserMixin):
 class Post(db.Model, SearchableMixin):
     __tablename__ = "post"
     __searchable__ = ["title", "subtitle", "body"]
+    __search_stored__ = ["timestamp", "user_id"]
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(250), nullable=False)
     subtitle = db.Column(db.String(250), nullable=False)
     body = db.Column(db.Text, nullable=False)
+    # Sanitized start of the body shown on post cards, so list pages never have to load the body.
+    excerpt = db.Column(db.Text)
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
     user_id = db.Column(db.Integer, db.ForeignKey("user.id"))
+    # Incremented whenever the post, or how its card renders, changes. Used to key cached renderings of the post.
+    version = db.Column(db.Integer, nullable=False, default=1, server_default="1")
+    # Whether the post was pushed into its followers' timelines when it was written.
+    fanned_out = db.Column(db.Boolean, nullable=False, default=False, server_default=db.false())
+
+    # Fields a client of the API can ask for.
+    API_FIELDS = ("id", "title", "subtitle", "body", "excerpt", "timestamp", "version", "author", "url")
+
+    # Profile and home feeds filter on the author and then sort by time.
+    __table_args__ = (db.Index("ix_post_user_id_timestamp", "user_id", "timestamp"),)
 
     def __repr__(self):
         return "<Post {}>".format(self.body)
 
+    def to_dict(self, fields=API_FIELDS):
+        """Return the API representation of the post, with only ``fields``. Fields that are not asked for are not read."""
+        data = {}
+        for field in fields:
+            if field == "timestamp":
+                data[field] = self.timestamp.isoformat() + "Z"
+            elif field == "author":
+                data[field] = self.author.username
+            elif field == "url":
+                data[field] = url_for("main.show_post", post_id=self.id, _external=True)
+            else:
+                data[field] = getattr(self, field)
+        return data
 
-@login_manager.user_loader
-def load_user(id):
-    return User.query.get(int(id))
+    @classmethod
+    def feed_query(cls, query=None, body=False):
+        # Every post card shows its author, so load them in the same query instead of one lazy load per post.
+        query = super().feed_query(query).options(db.joinedload(cls.author))
+        # Cards show the excerpt instead of the body, which can be large. Pages showing the whole post pass body=True.
+        return query if body else query.options(db.defer(cls.body))
+
+    @classmethod
+    def from_search_hits(cls, hits):
+        posts = super().from_search_hits(hits)
+        # Load all the authors in one query. set_committed_value attaches them without touching the session, so the
+        # transient posts are never flushed.
+        authors = {user.id: user for user in User.query.filter(User.id.in_({post.user_id for post in posts}))}
+        for post in posts:
+            set_committed_value(post, "author", authors.get(post.user_id))
+        return posts
+
+
+def adjust_counters(user, **deltas):
+    if user.id is None:
+        for name, delta in deltas.items():
+            setattr(user, name, (getattr(user, name) or 0) + delta)
+        return
+    # Increment in SQL so concurrent requests can't lose updates, then expire the stale values on the instance.
+    db.session.execute(
+        db.update(User.__table__)
+        .where(User.__table__.c.id == user.id)
+        .values({name: User.__table__.c[name] + delta for name, delta in deltas.items()})
+    )
+    db.session.expire(user, list(deltas))
+
+
+def reconcile_counters():
+    """Recompute the denormalized counters of every user and return how many users had drifted."""
+    users = User.__table__
+    counts = {
+        "followers_count": db.select(db.func.count())
+        .select_from(followers)
+        .where(followers.c.followed_id == users.c.id)
+        .scalar_subquery(),
+        "followed_count": db.select(db.func.count())
+        .select_from(followers)
+        .where(followers.c.follower_id == users.c.id)
+        .scalar_subquery(),
+        "posts_count": db.select(db.func.count(Post.id)).where(Post.user_id == users.c.id).scalar_subquery(),
+    }
+    result = db.session.execute(
+        db.update(users).where(db.or_(*(users.c[name] != count for name, count in counts.items()))).values(counts)
+    )
+    db.session.commit()
+    return result.rowcount
+
+
+@db.event.listens_for(Post.body, "set")
+def update_excerpt(post, value, oldvalue, initiator):
+    post.excerpt = make_excerpt(value, current_app.config["POST_EXCERPT_LENGTH"])
+
+
+def backfill_excerpts(everything=False, batch_size=500):
+    """Compute the excerpts of posts that have none, or of all posts with ``everything``, and return the count.
+
+    Bumps the version of every updated post, so that cached post cards are rendered again with the new excerpt.
+    """
+    posts = Post.__table__
+    length = current_app.config["POST_EXCERPT_LENGTH"]
+    count = 0
+    last_id = 0
+    while True:
+        query = db.select(posts.c.id, posts.c.body).where(posts.c.id > last_id).order_by(posts.c.id).limit(batch_size)
+        if not everything:
+            query = query.where(posts.c.excerpt.is_(None))
+        rows = db.session.execute(query).all()
+        if not rows:
+            return count
+        db.session.execute(
+            db.update(posts)
+            .where(posts.c.id == db.bindparam("post_id"))
+            .values(excerpt=db.bindparam("new_excerpt"), version=posts.c.version + 1),
+            [{"post_id": id, "new_excerpt": make_excerpt(body, length)} for id, body in rows],
+        )
+        db.session.commit()
+        count += len(rows)
+        last_id = rows[-1].id
+
+
+@db.event.listens_for(Post, "before_update")
+def bump_post_version(mapper, connection, post):
+    if db.object_session(post).is_modified(post, include_collections=False):
+        post.version = post.version + 1
+
+
+@db.event.listens_for(Post, "before_insert")
+def before_post_insert(mapper, connection, post):
+    if not current_app.config["TIMELINE_ENABLED"]:
+        return
+    follower_count = connection.scalar(db.select(User.followers_count).where(User.id == post.user_id))
+    # Fanning out to a very large audience makes every post by that author expensive to write. Leave those posts to
+    # be pulled at read time instead.
+    post.fanned_out = follower_count <= current_app.config["TIMELINE_FANOUT_LIMIT"]
+
+
+@db.event.listens_for(Post, "after_insert")
+def count_post_insert(mapper, connection, post):
+    users = User.__table__
+    connection.execute(db.update(users).where(users.c.id == post.user_id).values(posts_count=users.c.posts_count + 1))
+
+
+@db.event.listens_for(Post, "after_delete")
+def count_post_delete(mapper, connection, post):
+    users = User.__table__
+    connection.execute(db.update(users).where(users.c.id == post.user_id).values(posts_count=users.c.posts_count - 1))
+
+
+@db.event.listens_for(Post, "after_insert")
+def after_post_insert(mapper, connection, post):
+    if not current_app.config["TIMELINE_ENABLED"]:
+        return
+    # The author always sees their own posts.
+    connection.execute(timeline.insert().values(user_id=post.user_id, post_id=post.id, timestamp=post.timestamp))
+    if post.fanned_out:
+        connection.execute(
+            timeline.insert().from_select(
+                ["user_id", "post_id", "timestamp"],
+                db.select(followers.c.follower_id, db.literal(post.id), db.literal(post.timestamp)).where(
+                    followers.c.followed_id == post.user_id
+                ),
+            )
+        )
+
+
+@db.event.listens_for(Post, "before_delete")
+def before_post_delete(mapper, connection, post):
+    connection.execute(timeline.delete().where(timeline.c.post_id == post.id))
+
+
+def rebuild_timelines():
+    """Recompute every user's materialized home timeline from the followers and post tables."""
+    db.session.execute(timeline.delete())
+    popular = db.select(User.id).where(User.followers_count > current_app.config["TIMELINE_FANOUT_LIMIT"])
+    db.session.execute(db.update(Post).values(fanned_out=Post.user_id.not_in(popular)))
+    db.session.execute(
+        timeline.insert().from_select(
+            ["user_id", "post_id", "timestamp"], db.select(Post.user_id, Post.id, Post.timestamp)
+        )
+    )
+    db.session.execute(
+        timeline.insert().from_select(
+            ["user_id", "post_id", "timestamp"],
+            db.select(followers.c.follower_id, Post.id, Post.timestamp)
+            .join(followers, followers.c.followed_id == Post.user_id)
+            .where(Post.fanned_out.is_(True)),
+        )
+    )
+    db.session.commit()
+    return db.session.scalar(db.select(db.func.count()).select_from(timeline))
@@ -0,0 +1,155 @@
+import base64
+import binascii
+import json
+from datetime import datetime
+
+from flask_sqlalchemy.pagination import Pagination
+
+from app import db
+
+
+class CursorPage:
+    """One page of a feed paginated on (timestamp, id) instead of OFFSET/LIMIT.
+
+    Mirrors the parts of Flask-SQLAlchemy's Pagination used by the templates, but navigates with opaque
+    before/after tokens and never counts the total.
+    """
+
+    def __init__(self, items, has_next, has_prev):
+        self.items = items
+        self.has_next = has_next
+        self.has_prev = has_prev
+
+    @property
+    def next_cursor(self):
+        # Token for the page of older posts.
+        if self.has_next and self.items:
+            return encode_cursor(self.items[-1])
+
+    @property
+    def prev_cursor(self):
+        # Token for the page of newer posts.
+        if self.has_prev and self.items:
+            return encode_cursor(self.items[0])
+
+
+def encode_cursor(post):
+    raw = f"{post.timestamp.isoformat()}|{post.id}".encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(token):
+    """Return the (timestamp, id) pair encoded in a cursor token, or raise ValueError if it is malformed."""
+    try:
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)).decode("utf-8")
+        timestamp, id = raw.split("|")
+        return datetime.fromisoformat(timestamp), int(id)
+    except (binascii.Error, UnicodeDecodeError, ValueError) as e:
+        raise ValueError(f"Invalid cursor: {token!r}") from e
+
+
+def paginate_by_cursor(query, model, per_page, before=None, after=None):
+    """Paginate a query on (model.timestamp, model.id), newest first.
+
+    ``before`` returns the page of posts older than the cursor, ``after`` the page of posts newer than it. With
+    neither, the newest page is returned.
+    """
+    key = db.tuple_(model.timestamp, model.id)
+    query = query.order_by(None)
+    if after:
+        rows = (
+            query.filter(key > db.tuple_(*decode_cursor(after)))
+            .order_by(model.timestamp.asc(), model.id.asc())
+            .limit(per_page + 1)
+            .all()
+        )
+        if len(rows) <= per_page:
+            # Reached the newest posts, so show a full first page instead of a partial one.
+            return paginate_by_cursor(query, model, per_page)
+        return CursorPage(list(reversed(rows[:per_page])), has_next=True, has_prev=True)
+
+    if before:
+        query = query.filter(key < db.tuple_(*decode_cursor(before)))
+    rows = query.order_by(model.timestamp.desc(), model.id.desc()).limit(per_page + 1).all()
+    return CursorPage(rows[:per_page], has_next=len(rows) > per_page, has_prev=before is not None)
+
+
+class ListPagination(Pagination):
+    """Pagination over a page of items that has already been cut out, with a known total."""
+
+    def __init__(self, page, per_page, items, total):
+        super().__init__(page=page, per_page=per_page, max_per_page=None, error_out=False, items=items, total=total)
+
+    def _query_items(self):
+        return self._query_args["items"]
+
+    def _query_count(self):
+        return self._query_args["total"]
+
+
+class SearchPagination(ListPagination):
+    """Pagination over a page of search hits that the search engine has already cut out.
+
+    ``total`` is only counted up to ``max_total``, so once it reaches that cap there may be more pages than it
+    suggests. Pages past ``max_offset`` cannot be reached with from/size and are linked with search_after cursors
+    from their neighbours instead.
+    """
+
+    def __init__(self, page, per_page, items, total, max_total, max_offset, first_sort=None, last_sort=None):
+        self.max_total = max_total
+        self.max_offset = max_offset
+        self.first_sort = first_sort
+        self.last_sort = last_sort
+        super().__init__(page, per_page, items, total)
+
+    def reachable(self, page):
+        """Whether ``page`` can be fetched by its number, without a cursor."""
+        return page * self.per_page <= self.max_offset
+
+    @property
+    def total_is_capped(self):
+        return self.total >= self.max_total
+
+    @property
+    def has_next(self):
+        return super().has_next or (self.total_is_capped and len(self.items) == self.per_page)
+
+    @property
+    def next_cursor(self):
+        if self.has_next and self.last_sort is not None and not self.reachable(self.page + 1):
+            return encode_sort_values(self.last_sort)
+
+    @property
+    def prev_cursor(self):
+        if self.has_prev and self.first_sort is not None and not self.reachable(self.page - 1):
+            return encode_sort_values(self.first_sort)
+
+    def iter_pages(self, **kwargs):
+        # Numbered links only go to pages that don't need a cursor, and to the current one.
+        gap = False
+        for page in super().iter_pages(**kwargs):
+            if page is not None and (page == self.page or self.reachable(page)):
+                if gap:
+                    yield None
+                gap = False
+                yield page
+            else:
+                gap = True
+        if gap:
+            yield None
+
+
+def encode_sort_values(values):
+    raw = json.dumps(values, separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_sort_values(token):
+    """Return the search_after sort values encoded in a cursor token, or raise ValueError if it is malformed."""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)))
+    except (binascii.Error, UnicodeDecodeError, ValueError) as e:
+        raise ValueError(f"Invalid cursor: {token!r}") from e
+    if not isinstance(values, list):
+        raise ValueError(f"Invalid cursor: {token!r}")
+    return values
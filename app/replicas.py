@@ -0,0 +1,88 @@
+import random
+from time import time
+
+from flask import current_app, has_request_context, request, session
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event
+
+
+def use_replica(view):
+    """Mark a view as read-only, so that its GET requests may read from a replica."""
+    view.use_replica = True
+    return view
+
+
+class RoutingSession(Session):
+    """A session that sends SELECTs to the replica engine stored in ``info["replica"]`` for the current request.
+
+    Flushes and every other statement go to the primary, and so does everything after them in the same request,
+    so that a request always reads its own writes.
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        flushing = self.info.get("flushing", False)
+        if bind is None and (flushing or getattr(clause, "is_dml", False)):
+            self.info["wrote"] = True
+        replica = self.info.get("replica")
+        if replica is not None and bind is None:
+            if not flushing and getattr(clause, "is_select", False):
+                return replica
+            self.info["replica"] = None
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+def init_replicas(app):
+    """Add a bind for every READ_REPLICA_URLS entry and route the reads of read-only views to one of them.
+
+    Has to be called before the app is initialized with Flask-SQLAlchemy, which creates the engines.
+    """
+    binds = ["replica{}".format(i) for i in range(len(app.config["READ_REPLICA_URLS"]))]
+    app.config["SQLALCHEMY_BINDS"] = {
+        **app.config.get("SQLALCHEMY_BINDS", {}),
+        **dict(zip(binds, app.config["READ_REPLICA_URLS"])),
+    }
+    if not binds:
+        return
+
+    @app.before_request
+    def choose_replica():
+        db = current_app.extensions["sqlalchemy"]
+        view = current_app.view_functions.get(request.endpoint)
+        replica = None
+        # Users who have just written something read from the primary until the replicas have caught up.
+        if (
+            getattr(view, "use_replica", False)
+            and request.method in ("GET", "HEAD")
+            and session.get("read_primary_until", 0) < time()
+        ):
+            replica = db.engines[random.choice(binds)]
+        db.session.info["replica"] = replica
+
+    @app.teardown_request
+    def forget_replica(exc):
+        current_app.extensions["sqlalchemy"].session.info.pop("replica", None)
+
+
+def _remember_write(db_session):
+    if db_session.info.pop("wrote", False) and has_request_context() and current_app.config["READ_REPLICA_URLS"]:
+        session["read_primary_until"] = time() + current_app.config["READ_REPLICA_STICKY_SECONDS"]
+
+
+def _forget_write(db_session):
+    db_session.info.pop("wrote", None)
+    # A flush that raised never gets to after_flush_postexec.
+    db_session.info.pop("flushing", None)
+
+
+def _start_flush(db_session, flush_context, instances):
+    db_session.info["flushing"] = True
+
+
+def _end_flush(db_session, flush_context):
+    db_session.info.pop("flushing", None)
+
+
+event.listen(RoutingSession, "before_flush", _start_flush)
+event.listen(RoutingSession, "after_flush_postexec", _end_flush)
+event.listen(RoutingSession, "after_commit", _remember_write)
+event.listen(RoutingSession, "after_rollback", _forget_write)
@@ -1,31 +1,374 @@
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from elasticsearch import helpers
 from flask import current_app
 
+from app import db
+
+
+# Documents carry their id as a numeric field, which sorts without the fielddata that sorting on _id needs.
+ID_MAPPING = {"properties": {"id": {"type": "long"}}}
+
+
+def _with_id(id, doc):
+    return dict(doc, id=id)
+
+
+class ElasticsearchBackend:
+    def __init__(self, client):
+        self.client = client
+
+    def add(self, index, id, doc):
+        self.client.index(index=index, id=id, document=_with_id(id, doc))
+
+    def remove(self, index, id):
+        self.client.delete(index=index, id=id)
+
+    def bulk(self, index, docs, deleted_ids):
+        actions = [
+            {"_op_type": "index", "_index": index, "_id": id, "_source": _with_id(id, source)} for id, source in docs
+        ]
+        actions += [{"_op_type": "delete", "_index": index, "_id": id} for id in deleted_ids]
+        if not actions:
+            return set()
+        _, errors = helpers.bulk(self.client, actions, raise_on_error=False)
+        failed = set()
+        for error in errors:
+            op, result = next(iter(error.items()))
+            if op == "delete" and result.get("status") == 404:
+                continue
+            failed.add(int(result["_id"]))
+        return failed
+
+    def send_bulk(self, index, docs):
+        helpers.bulk(
+            self.client, ({"_index": index, "_id": id, "_source": _with_id(id, source)} for id, source in docs)
+        )
+
+    def query(self, index, query, fields, page, per_page, max_total, search_after=None, reverse=False, source=False):
+        body = {
+            "query": {"multi_match": {"query": query, "fields": fields}},
+            # Sorting on the id as well gives every hit a unique sort key for search_after. Indices built before the id
+            # field was added sort its hits last until they are rebuilt with `flask search reindex --new-index`.
+            # Reversed, the same order fetches the page before the search_after values.
+            "sort": [
+                {"_score": "asc" if reverse else "desc"},
+                {"id": {"order": "desc" if reverse else "asc", "unmapped_type": "long"}},
+            ],
+            "size": per_page,
+            "track_total_hits": max_total,
+            "_source": source,
+        }
+        if search_after:
+            body["search_after"] = search_after
+        else:
+            body["from"] = (page - 1) * per_page
+        search = self.client.search(index=index, body=body)
+        hits = []
+        for hit in search["hits"]["hits"]:
+            stored = hit.get("_source")
+            if stored:
+                stored = {field: value for field, value in stored.items() if field != "id"}
+            hits.append({"id": int(hit["_id"]), "sort": hit["sort"], "source": stored})
+        if reverse:
+            hits.reverse()
+        return hits, search["hits"]["total"]["value"]
+
+    def create_index(self, name):
+        self.client.indices.create(index=name, mappings=ID_MAPPING)
+
+    def delete_index(self, name):
+        self.client.indices.delete(index=name)
+
+    def swap_alias(self, alias, index):
+        """Atomically point ``alias`` at ``index`` and return the indices it was moved away from."""
+        actions = []
+        old = []
+        if self.client.indices.exists_alias(name=alias):
+            old = list(self.client.indices.get_alias(name=alias))
+            actions += [{"remove": {"index": name, "alias": alias}} for name in old]
+        elif self.client.indices.exists(index=alias):
+            # The index predates aliases and uses the alias name itself, so replace it in the same request.
+            actions.append({"remove_index": {"index": alias}})
+        actions.append({"add": {"index": index, "alias": alias}})
+        self.client.indices.update_aliases(body={"actions": actions})
+        return old
+
+
+class SQLiteSearchBackend:
+    """Full-text search on SQLite FTS5 for deployments without Elasticsearch.
+
+    Each index is an FTS5 table whose rowid is the model id and whose columns are the model's searchable fields.
+    Results are ranked with BM25 across all columns. A single connection is shared by all threads.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._conn = None
+        self._lock = threading.RLock()
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        return self._conn
+
+    def _exists(self, table):
+        row = self.conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone()
+        return row is not None
+
+    def _ensure_table(self, table, fields):
+        # Stored fields are only returned with the hits, so they are kept out of the full-text index.
+        stored = _stored_fields()
+        columns = ", ".join(_quote(field) + (" UNINDEXED" if field in stored else "") for field in fields)
+        self.conn.execute(
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {_quote(table)} USING fts5({columns}, tokenize='porter unicode61')"
+        )
+
+    def _write(self, table, docs, deleted_ids=()):
+        with self._lock:
+            self.conn.execute("BEGIN")
+            try:
+                if docs:
+                    fields = list(docs[0][1])
+                    self._ensure_table(table, fields)
+                    self.conn.executemany(
+                        f"INSERT OR REPLACE INTO {_quote(table)} (rowid, {', '.join(_quote(f) for f in fields)}) "
+                        f"VALUES (?, {', '.join('?' for _ in fields)})",
+                        [[id] + [_text(source[field]) for field in fields] for id, source in docs],
+                    )
+                if deleted_ids and self._exists(table):
+                    self.conn.executemany(f"DELETE FROM {_quote(table)} WHERE rowid = ?", [(id,) for id in deleted_ids])
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+
+    def add(self, index, id, doc):
+        self._write(index, [(id, doc)])
+
+    def remove(self, index, id):
+        self._write(index, [], [id])
+
+    def bulk(self, index, docs, deleted_ids):
+        self._write(index, docs, deleted_ids)
+        return set()
+
+    def send_bulk(self, index, docs):
+        self._write(index, docs)
+
+    def query(self, index, query, fields, page, per_page, max_total, search_after=None, reverse=False, source=False):
+        # Match any of the words in the given columns, like Elasticsearch's multi_match. Quoting each word keeps FTS5
+        # query syntax in the user's input from being interpreted.
+        terms = " OR ".join('"{}"'.format(word) for word in re.findall(r"\w+", query))
+        with self._lock:
+            if not terms or not self._exists(index):
+                return [], 0
+            table = _quote(index)
+            match = "{%s}: (%s)" % (" ".join(fields), terms)
+            total = self.conn.execute(
+                f"SELECT count(*) FROM (SELECT 1 FROM {table} WHERE {table} MATCH ? LIMIT ?)", (match, max_total)
+            ).fetchone()[0]
+            ranked = f"SELECT rowid AS id, bm25({table}) AS score, * FROM {table} WHERE {table} MATCH ?"
+            if search_after and reverse:
+                cursor = self.conn.execute(
+                    f"SELECT * FROM ({ranked}) WHERE score < ? OR (score = ? AND id < ?) "
+                    "ORDER BY score DESC, id DESC LIMIT ?",
+                    (match, search_after[0], search_after[0], search_after[1], per_page),
+                )
+            elif search_after:
+                cursor = self.conn.execute(
+                    f"SELECT * FROM ({ranked}) WHERE score > ? OR (score = ? AND id > ?) ORDER BY score, id LIMIT ?",
+                    (match, search_after[0], search_after[0], search_after[1], per_page),
+                )
+            else:
+                cursor = self.conn.execute(
+                    f"SELECT * FROM ({ranked}) ORDER BY score, id LIMIT ? OFFSET ?",
+                    (match, per_page, (page - 1) * per_page),
+                )
+            columns = [column[0] for column in cursor.description]
+            rows = cursor.fetchall()
+        if search_after and reverse:
+            rows.reverse()
+        hits = [
+            {"id": row[0], "sort": [row[1], row[0]], "source": dict(zip(columns[2:], row[2:])) if source else None}
+            for row in rows
+        ]
+        return hits, total
+
+    def create_index(self, name):
+        # The table is created with the model's fields on the first write.
+        pass
+
+    def swap_alias(self, alias, index):
+        # SQLite has no aliases. Replace the table in one transaction, so readers see either the old or new index.
+        with self._lock:
+            self.conn.execute("BEGIN")
+            try:
+                self.conn.execute(f"DROP TABLE IF EXISTS {_quote(alias)}")
+                if self._exists(index):
+                    self.conn.execute(f"ALTER TABLE {_quote(index)} RENAME TO {_quote(alias)}")
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+        return []
+
+    def delete_index(self, name):
+        with self._lock:
+            self.conn.execute(f"DROP TABLE IF EXISTS {_quote(name)}")
+
+
+def _stored_fields():
+    return {
+        field
+        for mapper in db.Model.registry.mappers
+        for field in getattr(mapper.class_, "__search_stored__", [])
+        if field not in getattr(mapper.class_, "__searchable__", [])
+    }
+
+
+def _quote(name):
+    return '"{}"'.format(name.replace('"', '""'))
+
+
+def _text(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if not isinstance(value, str):
+        return value
+    # Index the text of CKEditor HTML rather than its markup.
+    return re.sub(r"<[^>]+>", " ", value)
+
+
+def create_backend(app):
+    backend = app.config["SEARCH_BACKEND"] or ("elasticsearch" if app.elasticsearch else "sqlite")
+    if backend == "elasticsearch":
+        return ElasticsearchBackend(app.elasticsearch) if app.elasticsearch else None
+    if backend == "sqlite":
+        return SQLiteSearchBackend(app.config["SEARCH_SQLITE_PATH"])
+    if backend == "none":
+        return None
+    raise ValueError(f"Unknown search backend: {backend}")
+
+
+def document(model):
+    # Stored fields are not searched, but are returned with the hits so results can be rendered from the index.
+    fields = model.__searchable__ + getattr(model, "__search_stored__", [])
+    return {field: getattr(model, field) for field in fields}
+
 
 def add_to_index(index, model):
-    if not current_app.elasticsearch:
+    if not current_app.search_backend:
         return
-    payload = {}
-    for field in model.__searchable__:
-        payload[field] = getattr(model, field)
-    current_app.elasticsearch.index(index=index, id=model.id, document=payload)
-    # print("Payload", payload)
+    current_app.search_backend.add(index, model.id, document(model))
 
 
 def remove_from_index(index, model):
-    if not current_app.elasticsearch:
+    if not current_app.search_backend:
         return
-    current_app.elasticsearch.delete(index=index, id=model.id)
+    current_app.search_backend.remove(index, model.id)
+
+
+def bulk_update(index, models, deleted_ids):
+    """Index ``models`` and delete ``deleted_ids`` in a single bulk request.
+
+    Returns the ids whose operation failed. Deleting a document that is already gone is not a failure.
+    """
+    if not current_app.search_backend:
+        return set()
+    return current_app.search_backend.bulk(index, [(model.id, document(model)) for model in models], deleted_ids)
+
+
+def reindex(model, chunk_size=500, workers=4, new_index=False, checkpoint=None, resume=False, progress=None):
+    """Stream every row of ``model`` into the search engine with parallel bulk requests.
+
+    Rows are read in primary key order in chunks of ``chunk_size``. After each chunk is acknowledged, and all
+    chunks before it, the last id is written to the ``checkpoint`` file so an interrupted run can continue with
+    ``resume``. With ``new_index`` the rows go to a fresh index which the alias is swapped to at the end, and the
+    indices the alias pointed to before are deleted. ``progress`` is called with the number of documents sent and the elapsed seconds.
+    """
+    backend = current_app.search_backend
+    if not backend:
+        return 0
+    alias = model.__tablename__
+    state = None
+    if resume and checkpoint and os.path.exists(checkpoint):
+        with open(checkpoint) as f:
+            state = json.load(f)
+    if state:
+        target, last_id, new_index = state["index"], state["last_id"], state["new_index"]
+    else:
+        target, last_id = alias, 0
+        if new_index:
+            target = f"{alias}-{datetime.utcnow():%Y%m%d%H%M%S}"
+            backend.create_index(target)
+
+    def save_checkpoint():
+        if checkpoint:
+            os.makedirs(os.path.dirname(os.path.abspath(checkpoint)), exist_ok=True)
+            with open(checkpoint, "w") as f:
+                json.dump({"index": target, "last_id": last_id, "new_index": new_index}, f)
+
+    def finish_oldest_chunk():
+        nonlocal last_id, sent
+        future, last_id_in_chunk, count = pending.popleft()
+        future.result()
+        last_id = last_id_in_chunk
+        sent += count
+        save_checkpoint()
+        if progress:
+            progress(sent, time.perf_counter() - start)
+
+    query = db.select(model).where(model.id > last_id).order_by(model.id).execution_options(yield_per=chunk_size)
+    pending = deque()
+    sent = 0
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for chunk in db.session.execute(query).scalars().partitions():
+            docs = [(obj.id, document(obj)) for obj in chunk]
+            for obj in chunk:
+                db.session.expunge(obj)
+            pending.append((pool.submit(backend.send_bulk, target, docs), docs[-1][0], len(docs)))
+            # Bound the number of chunks held in memory, and advance the checkpoint over finished chunks.
+            while pending and (len(pending) >= workers * 2 or pending[0][0].done()):
+                finish_oldest_chunk()
+        while pending:
+            finish_oldest_chunk()
+
+    if new_index:
+        for old in backend.swap_alias(alias, target):
+            backend.delete_index(old)
+    if checkpoint and os.path.exists(checkpoint):
+        os.remove(checkpoint)
+    return sent
+
 
+def query_index(index, query, fields, page, per_page, search_after=None, reverse=False, source=False):
+    """Return one page of hits for ``query`` and the total number of matches.
 
-def query_index(index, query):
-    if not current_app.elasticsearch:
+    Each hit is a dict with the document ``id``, its ``sort`` values for ``search_after`` and, when ``source`` is
+    true, the stored document. With ``reverse``, the page is the one before ``search_after`` instead of after it. The
+    total is counted up to SEARCH_TRACK_TOTAL_HITS only.
+    """
+    if not current_app.search_backend:
         return [], 0
-    search = current_app.elasticsearch.search(
-        index=index,
-        body={
-            "query": {"multi_match": {"query": query, "fields": ["*"]}},
-            "size": 999,
-        },
+    return current_app.search_backend.query(
+        index,
+        query,
+        fields,
+        page,
+        per_page,
+        current_app.config["SEARCH_TRACK_TOTAL_HITS"],
+        search_after=search_after,
+        reverse=reverse,
+        source=source,
     )
-    ids = [int(hit["_id"]) for hit in search["hits"]["hits"]]
-    return ids, search["hits"]["total"]["value"]
@@ -0,0 +1,114 @@
+import csv
+import json
+from datetime import datetime
+
+from flask import current_app
+
+from app import db
+from app.models import (
+    Post,
+    SearchableMixin,
+    User,
+    backfill_excerpts,
+    followers,
+    rebuild_timelines,
+    reconcile_counters,
+)
+
+# One file per table, in an order that satisfies the foreign keys on import.
+TABLES = {"users": User.__table__, "posts": Post.__table__, "follows": followers}
+
+
+def _encode(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+def _decoder(column):
+    if isinstance(column.type, db.DateTime):
+        return datetime.fromisoformat
+    if isinstance(column.type, db.Boolean):
+        return lambda value: value if isinstance(value, bool) else value.lower() in ("1", "true")
+    if isinstance(column.type, db.Integer):
+        return int
+    return str
+
+
+def export_rows(table, f, fmt, chunk_size=1000):
+    """Write every row of ``table`` to ``f`` as NDJSON or CSV, streaming ``chunk_size`` rows at a time."""
+    columns = [column.name for column in table.columns]
+    rows = db.session.execute(
+        db.select(table).order_by(*table.primary_key.columns), execution_options={"yield_per": chunk_size}
+    )
+    writer = None
+    if fmt == "csv":
+        writer = csv.writer(f)
+        writer.writerow(columns)
+    count = 0
+    for row in rows:
+        values = [_encode(value) for value in row]
+        if writer:
+            writer.writerow(["" if value is None else value for value in values])
+        else:
+            f.write(json.dumps(dict(zip(columns, values))) + "\n")
+        count += 1
+    return count
+
+
+def read_rows(table, f, fmt):
+    """Yield the rows of a file written by export_rows() as dicts of column values."""
+    decoders = {column.name: (_decoder(column), column.nullable) for column in table.columns}
+    records = csv.DictReader(f) if fmt == "csv" else (json.loads(line) for line in f if line.strip())
+    for record in records:
+        row = {}
+        for name, value in record.items():
+            if name not in decoders:
+                raise ValueError(f"Unknown column {name!r} for table {table.name}")
+            decode, nullable = decoders[name]
+            # CSV has no NULL, so an empty string stands for it in nullable columns.
+            if value is None or (value == "" and fmt == "csv" and nullable):
+                row[name] = None
+            else:
+                row[name] = decode(value)
+        yield row
+
+
+def import_rows(table, rows, batch_size=1000):
+    """Insert ``rows`` into ``table`` with one executemany INSERT per ``batch_size`` rows and return the count.
+
+    The inserts bypass the ORM, so none of the per-object hooks run. finish_import() rebuilds what they maintain.
+    """
+    count = 0
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= batch_size:
+            db.session.execute(table.insert(), batch)
+            count += len(batch)
+            batch = []
+    if batch:
+        db.session.execute(table.insert(), batch)
+        count += len(batch)
+    db.session.commit()
+    return count
+
+
+def finish_import():
+    """Rebuild everything the ORM hooks maintain for single rows, after an import, and return the reindexed count."""
+    if db.engine.dialect.name == "postgresql":
+        # Rows were inserted with their ids, so the sequences have to catch up.
+        for table in (User.__table__, Post.__table__):
+            db.session.execute(
+                db.text(
+                    f"SELECT setval(pg_get_serial_sequence('\"{table.name}\"', 'id'), coalesce(max(id), 1)) "
+                    f'FROM "{table.name}"'
+                )
+            )
+        db.session.commit()
+    reconcile_counters()
+    # Exports from before excerpts existed have none.
+    backfill_excerpts()
+    if current_app.config["TIMELINE_ENABLED"]:
+        rebuild_timelines()
+    for cache in (current_app.fragment_cache, current_app.user_cache, current_app.explore_feed.cache):
+        cache.clear()
+    return sum(model.reindex() for model in SearchableMixin.__subclasses__())
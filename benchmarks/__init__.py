@@ -0,0 +1,5 @@
+"""Load benchmarks for the main endpoints, run against a database filled with synthetic data.
+
+Run ``python -m benchmarks --help`` for the options. ``--save`` writes the results as a JSON baseline and
+``--compare`` reports every endpoint that got slower, or runs more queries, than in a saved baseline.
+"""
@@ -0,0 +1,81 @@
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+
+from app import create_app, db
+from benchmarks.driver import ENDPOINTS, run
+from benchmarks.report import compare, format_table, load, save, summarize
+from benchmarks.seed import seed
+from config import Config
+
+
+class BenchmarkConfig(Config):
+    TESTING = True
+    WTF_CSRF_ENABLED = False
+    SEARCH_BACKEND = "sqlite"
+    SEARCH_SQLITE_PATH = ":memory:"
+    SEARCH_INDEXER_THREAD = False
+    LAST_SEEN_FLUSH_INTERVAL = None
+    MAIL_WORKERS = 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks", description="Benchmark the main endpoints.")
+    parser.add_argument("--users", type=int, default=200, help="number of users to seed (default: %(default)s)")
+    parser.add_argument("--posts", type=int, default=2000, help="number of posts to seed (default: %(default)s)")
+    parser.add_argument("--follows", type=int, default=20, help="mean number of users followed (default: %(default)s)")
+    parser.add_argument("--alpha", type=float, default=1.2, help="Zipf exponent of popularity (default: %(default)s)")
+    parser.add_argument(
+        "--requests", type=int, default=50, help="measured requests per endpoint (default: %(default)s)"
+    )
+    parser.add_argument("--warmup", type=int, default=5, help="unmeasured requests per endpoint (default: %(default)s)")
+    parser.add_argument("--endpoint", action="append", choices=ENDPOINTS, help="endpoint to run, may be repeated")
+    parser.add_argument("--server", action="store_true", help="send requests to a real WSGI server")
+    parser.add_argument("--timeline", action="store_true", help="enable the materialized home timeline")
+    parser.add_argument("--database", help="database URL, defaults to a new SQLite file in a temporary directory")
+    parser.add_argument("--no-seed", action="store_true", help="use the existing data in --database")
+    parser.add_argument("--seed", type=int, default=1, help="random seed (default: %(default)s)")
+    parser.add_argument("--save", metavar="PATH", help="save the results as a JSON baseline")
+    parser.add_argument("--compare", metavar="PATH", help="compare the results with a saved baseline")
+    parser.add_argument("--threshold", type=float, default=0.2, help="allowed p95 growth (default: %(default)s)")
+    args = parser.parse_args(argv)
+
+    directory = None if args.database else tempfile.mkdtemp(prefix="microblog-bench-")
+    BenchmarkConfig.SQLALCHEMY_DATABASE_URI = args.database or "sqlite:///" + os.path.join(directory, "bench.db")
+    BenchmarkConfig.TIMELINE_ENABLED = args.timeline
+    app = create_app(BenchmarkConfig)
+    try:
+        settings = {key: value for key, value in vars(args).items() if key not in ("save", "compare", "database")}
+        if not args.no_seed:
+            with app.app_context():
+                db.create_all()
+                print(
+                    "Seeded {users} users, {follows} follows and {posts} posts.".format(
+                        **seed(args.users, args.posts, args.follows, args.alpha, random_seed=args.seed)
+                    )
+                )
+
+        samples = run(app, args.requests, args.warmup, args.server, args.endpoint or ENDPOINTS, random_seed=args.seed)
+        results = summarize(samples)
+        print(format_table(results))
+        if args.save:
+            save(args.save, results, settings)
+        if args.compare:
+            regressions = compare(results, load(args.compare), args.threshold)
+            for regression in regressions:
+                print(f"REGRESSION {regression}")
+            return 1 if regressions else 0
+        return 0
+    finally:
+        # Last seen times from the requests are written before the database goes away.
+        app.last_seen_buffer.flush()
+        with app.app_context():
+            db.engine.dispose()
+        if directory:
+            shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
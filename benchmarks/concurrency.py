@@ -0,0 +1,168 @@
+"""Read and write throughput of a file-backed SQLite database under concurrent load.
+
+Runs the same mix of Explore page reads and post inserts against two copies of a seeded database, once with SQLite's
+default rollback journal and once with the SQLITE_PRAGMAS from config.py, first from threads in one process and then
+from several processes. Run ``python -m benchmarks.concurrency --help`` for the options. Exits with status 1 when the
+tuned database reports any "database is locked" errors.
+"""
+
+import argparse
+import multiprocessing
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from sqlalchemy.exc import OperationalError
+
+from app import create_app, db
+from app.models import Post, User
+from benchmarks.seed import seed, text
+from config import Config
+
+# What a new SQLite database does without SQLITE_PRAGMAS, apart from the driver's own 5 second busy timeout.
+DEFAULT_PRAGMAS = {"journal_mode": "DELETE"}
+
+
+class ConcurrencyConfig(Config):
+    TESTING = True
+    SEARCH_BACKEND = "sqlite"
+    SEARCH_SQLITE_PATH = ":memory:"
+    SEARCH_INDEXER_THREAD = False
+    LAST_SEEN_FLUSH_INTERVAL = None
+    MAIL_WORKERS = 0
+    # Writers waiting for the lock would fill the slow query log.
+    SLOW_QUERY_THRESHOLD = None
+
+
+def make_app(database, pragmas):
+    config = type(
+        "ConcurrencyConfig",
+        (ConcurrencyConfig,),
+        {"SQLALCHEMY_DATABASE_URI": "sqlite:///" + database, "SQLITE_PRAGMAS": pragmas},
+    )
+    return create_app(config)
+
+
+def hammer(database, pragmas, threads=4, duration=2.0, write_ratio=0.2, random_seed=1):
+    """Read and write ``database`` from ``threads`` threads for ``duration`` seconds.
+
+    Every operation stands in for a request: a read loads the newest page of posts with their authors and a write
+    adds a post and commits it. Returns the numbers of reads, writes, "database is locked" errors and other errors.
+    """
+    app = make_app(database, pragmas)
+    counts = {"reads": 0, "writes": 0, "locked": 0, "errors": 0}
+    lock = threading.Lock()
+
+    def work(n):
+        rng = random.Random(random_seed * 1000 + n)
+        done = dict.fromkeys(counts, 0)
+        with app.app_context():
+            user_ids = db.session.scalars(db.select(User.id)).all()
+            db.session.remove()
+            deadline = time.monotonic() + duration
+            while time.monotonic() < deadline:
+                try:
+                    if rng.random() < write_ratio:
+                        post = Post(
+                            title=text(rng, 2, 6),
+                            subtitle=text(rng, 4, 10),
+                            body=f"<p>{text(rng, 20, 150)}</p>",
+                            user_id=rng.choice(user_ids),
+                        )
+                        db.session.add(post)
+                        db.session.commit()
+                        done["writes"] += 1
+                    else:
+                        query = Post.feed_query().order_by(Post.timestamp.desc())
+                        query.limit(app.config["POSTS_PER_PAGE"]).all()
+                        done["reads"] += 1
+                except OperationalError as e:
+                    db.session.rollback()
+                    done["locked" if "locked" in str(e.orig) else "errors"] += 1
+                finally:
+                    db.session.remove()
+        with lock:
+            for key, value in done.items():
+                counts[key] += value
+
+    workers = [threading.Thread(target=work, args=(n,)) for n in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    with app.app_context():
+        db.engine.dispose()
+    return counts
+
+
+def run(database, pragmas, processes=1, threads=4, duration=2.0, write_ratio=0.2, random_seed=1):
+    """Run hammer() in ``processes`` processes at once and return the summed counts with reads and writes per second."""
+    if processes <= 1:
+        results = [hammer(database, pragmas, threads, duration, write_ratio, random_seed)]
+    else:
+        # Spawned rather than forked, so that no process inherits another's open database connections.
+        with multiprocessing.get_context("spawn").Pool(processes) as pool:
+            results = pool.starmap(
+                hammer,
+                [(database, pragmas, threads, duration, write_ratio, random_seed + i) for i in range(processes)],
+            )
+    counts = {key: sum(result[key] for result in results) for key in results[0]}
+    counts["reads_per_s"] = counts["reads"] / duration
+    counts["writes_per_s"] = counts["writes"] / duration
+    return counts
+
+
+def format_table(rows):
+    lines = [f"{'pragmas':<8} {'procs':>5} {'threads':>7} {'reads/s':>9} {'writes/s':>9} {'locked':>7} {'errors':>7}"]
+    for name, processes, threads, r in rows:
+        lines.append(
+            f"{name:<8} {processes:>5} {threads:>7} {r['reads_per_s']:>9.1f} {r['writes_per_s']:>9.1f} "
+            f"{r['locked']:>7} {r['errors']:>7}"
+        )
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks.concurrency", description="Benchmark concurrent reads and writes on SQLite."
+    )
+    parser.add_argument("--users", type=int, default=50, help="number of users to seed (default: %(default)s)")
+    parser.add_argument("--posts", type=int, default=500, help="number of posts to seed (default: %(default)s)")
+    parser.add_argument("--processes", type=int, default=4, help="processes in the second run (default: %(default)s)")
+    parser.add_argument("--threads", type=int, default=4, help="threads per process (default: %(default)s)")
+    parser.add_argument("--duration", type=float, default=5, help="seconds per run (default: %(default)s)")
+    parser.add_argument(
+        "--write-ratio", type=float, default=0.2, help="share of operations that write (default: %(default)s)"
+    )
+    parser.add_argument("--seed", type=int, default=1, help="random seed (default: %(default)s)")
+    args = parser.parse_args(argv)
+
+    directory = tempfile.mkdtemp(prefix="microblog-concurrency-")
+    try:
+        seeded = os.path.join(directory, "seed.db")
+        app = make_app(seeded, DEFAULT_PRAGMAS)
+        with app.app_context():
+            db.create_all()
+            seed(args.users, args.posts, follows=5, random_seed=args.seed)
+            db.engine.dispose()
+
+        rows = []
+        for name, pragmas in (("default", DEFAULT_PRAGMAS), ("tuned", Config.SQLITE_PRAGMAS)):
+            for processes in (1, args.processes):
+                # Every run starts from the same data.
+                database = os.path.join(directory, f"{name}-{processes}.db")
+                shutil.copyfile(seeded, database)
+                counts = run(database, pragmas, processes, args.threads, args.duration, args.write_ratio, args.seed)
+                rows.append((name, processes, args.threads, counts))
+        print(format_table(rows))
+    finally:
+        shutil.rmtree(directory)
+    return 1 if any(r["locked"] for name, _, _, r in rows if name == "tuned") else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,146 @@
+import http.cookiejar
+import random
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+from flask import url_for
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+from app import db
+from app.models import Post, User
+from benchmarks.seed import PASSWORD, WORDS
+
+ENDPOINTS = ["main.index", "main.explore", "main.user", "main.show_post", "main.search", "main.new_post"]
+
+
+class QueryCounter:
+    """Counts the SQL statements sent by an engine while it is installed."""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.count = 0
+
+    def __enter__(self):
+        db.event.listen(self.engine, "before_cursor_execute", self.before_cursor_execute)
+        return self
+
+    def __exit__(self, *exc_info):
+        db.event.remove(self.engine, "before_cursor_execute", self.before_cursor_execute)
+
+    def before_cursor_execute(self, *args):
+        self.count += 1
+
+
+class TestClient:
+    """Sends requests through Flask's test client, so only the application itself is measured."""
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, url, data=None):
+        response = self.client.open(url, method=method, data=data)
+        response.get_data()
+        return response.status_code
+
+    def close(self):
+        pass
+
+
+class ServerClient:
+    """Sends real HTTP requests to the application served by a WSGI server in a background thread."""
+
+    def __init__(self, app):
+        self.server = make_server("127.0.0.1", 0, app, request_handler=QuietRequestHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        self.base_url = f"http://127.0.0.1:{self.server.server_port}"
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()), NoRedirect()
+        )
+
+    def request(self, method, url, data=None):
+        body = urllib.parse.urlencode(data).encode("utf-8") if data is not None else None
+        try:
+            with self.opener.open(urllib.request.Request(self.base_url + url, data=body, method=method)) as response:
+                response.read()
+                return response.status
+        except urllib.error.HTTPError as e:
+            return e.code
+
+    def close(self):
+        self.server.shutdown()
+        self.thread.join()
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+    # Report redirects as they are, like the test client does.
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+def requests_for(endpoint, rng, usernames, post_ids):
+    """Return the method, URL, form data and expected status of one request to ``endpoint``."""
+    if endpoint == "main.user":
+        return "GET", url_for(endpoint, username=rng.choice(usernames)), None, 200
+    if endpoint == "main.show_post":
+        return "GET", url_for(endpoint, post_id=rng.choice(post_ids)), None, 200
+    if endpoint == "main.search":
+        return "GET", url_for(endpoint, q=rng.choice(WORDS)), None, 200
+    if endpoint == "main.new_post":
+        data = {
+            "title": "Benchmark",
+            "subtitle": "A post written by the benchmark",
+            "body": f"<p>{rng.choice(WORDS)}</p>",
+        }
+        return "POST", url_for(endpoint), data, 302
+    return "GET", url_for(endpoint), None, 200
+
+
+def run(app, requests=50, warmup=5, server=False, endpoints=ENDPOINTS, random_seed=1):
+    """Send ``requests`` requests to each endpoint, after ``warmup`` unmeasured ones, as a logged in seeded user.
+
+    Requests go through the test client, or through a real WSGI server with ``server``. Returns a dict mapping each
+    endpoint to its samples, which are (seconds, number of queries, whether the status was as expected) tuples.
+    Forms are submitted without CSRF tokens, so the app must run with WTF_CSRF_ENABLED off.
+    """
+    rng = random.Random(random_seed)
+    with app.app_context():
+        usernames = db.session.scalars(db.select(User.username)).all()
+        post_ids = db.session.scalars(db.select(Post.id)).all()
+        # The user following the most accounts has the busiest home feed.
+        username = db.session.scalar(db.select(User.username).order_by(User.followed_count.desc()).limit(1))
+        engine = db.engine
+        with app.test_request_context():
+            login_url = url_for("auth.login")
+            plan = {
+                endpoint: [requests_for(endpoint, rng, usernames, post_ids) for _ in range(warmup + requests)]
+                for endpoint in endpoints
+            }
+
+    # No context may be active while requests are sent, or they would share it.
+    client = ServerClient(app) if server else TestClient(app)
+    samples = {}
+    try:
+        status = client.request("POST", login_url, {"username": username, "password": PASSWORD})
+        if status != 302:
+            raise RuntimeError(f"Logging in as {username} failed with status {status}")
+        for endpoint, endpoint_requests in plan.items():
+            samples[endpoint] = []
+            for i, (method, url, data, expected) in enumerate(endpoint_requests):
+                with QueryCounter(engine) as queries:
+                    start = time.perf_counter()
+                    status = client.request(method, url, data)
+                    elapsed = time.perf_counter() - start
+                if i >= warmup:
+                    samples[endpoint].append((elapsed, queries.count, status == expected))
+    finally:
+        client.close()
+    return samples
@@ -0,0 +1,75 @@
+import json
+import math
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of ``values``, for ``p`` between 0 and 100."""
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[max(math.ceil(p / 100 * len(values)) - 1, 0)]
+
+
+def summarize(samples):
+    """Turn the samples returned by driver.run() into latency, throughput and query statistics per endpoint."""
+    results = {}
+    for endpoint, rows in samples.items():
+        latencies = [elapsed for elapsed, _, _ in rows]
+        total = sum(latencies)
+        results[endpoint] = {
+            "requests": len(rows),
+            "errors": sum(1 for _, _, ok in rows if not ok),
+            "p50_ms": percentile(latencies, 50) * 1000,
+            "p95_ms": percentile(latencies, 95) * 1000,
+            "p99_ms": percentile(latencies, 99) * 1000,
+            # Requests are sent one at a time, so this is the throughput of a single worker.
+            "throughput_rps": len(rows) / total if total else 0.0,
+            "queries_mean": sum(queries for _, queries, _ in rows) / len(rows) if rows else 0.0,
+            "queries_max": max((queries for _, queries, _ in rows), default=0),
+        }
+    return results
+
+
+def format_table(results):
+    lines = [
+        f"{'endpoint':<16} {'reqs':>5} {'errs':>5} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'req/s':>8} {'queries':>8}"
+    ]
+    for endpoint, r in results.items():
+        lines.append(
+            f"{endpoint:<16} {r['requests']:>5} {r['errors']:>5} {r['p50_ms']:>8.2f} {r['p95_ms']:>8.2f} "
+            f"{r['p99_ms']:>8.2f} {r['throughput_rps']:>8.1f} {r['queries_mean']:>8.1f}"
+        )
+    return "\n".join(lines)
+
+
+def save(path, results, settings):
+    with open(path, "w") as f:
+        json.dump({"settings": settings, "results": results}, f, indent=2, sort_keys=True)
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def compare(results, baseline, threshold=0.2, min_delta_ms=1.0):
+    """Return a description of every regression of ``results`` against a baseline loaded with load().
+
+    An endpoint regresses when its p95 latency grew by more than ``threshold`` (a fraction) and by more than
+    ``min_delta_ms``, when it runs more queries on average, or when it has errors the baseline did not have.
+    """
+    regressions = []
+    for endpoint, current in results.items():
+        before = baseline["results"].get(endpoint)
+        if before is None:
+            continue
+        if (
+            current["p95_ms"] > before["p95_ms"] * (1 + threshold)
+            and current["p95_ms"] - before["p95_ms"] > min_delta_ms
+        ):
+            regressions.append(f"{endpoint}: p95 {before['p95_ms']:.2f} ms -> {current['p95_ms']:.2f} ms")
+        if current["queries_mean"] > before["queries_mean"] + 1e-9:
+            regressions.append(f"{endpoint}: queries {before['queries_mean']:.1f} -> {current['queries_mean']:.1f}")
+        if current["errors"] > before["errors"]:
+            regressions.append(f"{endpoint}: errors {before['errors']} -> {current['errors']}")
+    return regressions
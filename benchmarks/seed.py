@@ -0,0 +1,96 @@
+import itertools
+import random
+from datetime import datetime, timedelta
+
+from flask import current_app
+from werkzeug.security import generate_password_hash
+
+from app import db
+from app.models import Post, User, backfill_excerpts, followers, rebuild_timelines, reconcile_counters
+
+# Every seeded user has this password.
+PASSWORD = "benchmark"
+
+WORDS = (
+    "flask python database query index cache timeline follow post search latency server request response "
+    "template session cookie socket thread worker queue batch stream vector graph network memory disk "
+    "coffee river mountain garden winter summer music travel camera kitchen bicycle library market"
+).split()
+
+
+def popularity(rng, ids, alpha):
+    """Shuffle ``ids`` and return them with cumulative Zipf weights, so that rank r is picked with weight 1/r**alpha."""
+    ranked = list(ids)
+    rng.shuffle(ranked)
+    return ranked, list(itertools.accumulate(1 / rank**alpha for rank in range(1, len(ranked) + 1)))
+
+
+def text(rng, min_words, max_words):
+    return " ".join(rng.choices(WORDS, k=rng.randint(min_words, max_words)))
+
+
+def insert(table, rows, chunk_size=1000):
+    for start in range(0, len(rows), chunk_size):
+        db.session.execute(db.insert(table), rows[start : start + chunk_size])
+
+
+def seed(users=200, posts=2000, follows=20, alpha=1.2, days=90, random_seed=1):
+    """Fill the database with ``users`` users, ``posts`` posts and a power-law follow graph.
+
+    Each user follows on average ``follows`` others, picked by popularity, so that a few users have most of the
+    followers. Posts are spread over the last ``days`` days and their authors are also picked by popularity.
+    Rows are written with bulk inserts, after which the counters, excerpts, timelines and search index are rebuilt.
+    """
+    rng = random.Random(random_seed)
+    # Hashing is deliberately slow, so all users share one hash.
+    password_hash = generate_password_hash(PASSWORD)
+    insert(
+        User,
+        [
+            {
+                "username": f"user{i}",
+                "email": f"user{i}@example.com",
+                "password_hash": password_hash,
+                "about_me": text(rng, 3, 12),
+            }
+            for i in range(users)
+        ],
+    )
+    user_ids = db.session.scalars(db.select(User.id)).all()
+
+    ranked, weights = popularity(rng, user_ids, alpha)
+    pairs = set()
+    for follower in user_ids:
+        count = min(int(rng.expovariate(1 / follows)) if follows else 0, len(user_ids) - 1)
+        pairs.update(
+            (follower, followed)
+            for followed in rng.choices(ranked, cum_weights=weights, k=count)
+            if followed != follower
+        )
+    insert(followers, [{"follower_id": follower, "followed_id": followed} for follower, followed in pairs])
+
+    authors, weights = popularity(rng, user_ids, alpha)
+    now = datetime.utcnow()
+    insert(
+        Post,
+        [
+            {
+                "title": text(rng, 2, 6),
+                "subtitle": text(rng, 4, 10),
+                "body": f"<p>{text(rng, 20, 150)}</p>",
+                "timestamp": now - timedelta(seconds=rng.uniform(0, days * 24 * 3600)),
+                "user_id": author,
+                "fanned_out": False,
+            }
+            for author in rng.choices(authors, cum_weights=weights, k=posts)
+        ],
+    )
+    db.session.commit()
+
+    # Bulk inserts skip the ORM events that maintain these.
+    reconcile_counters()
+    backfill_excerpts()
+    if current_app.config["TIMELINE_ENABLED"]:
+        rebuild_timelines()
+    Post.reindex(workers=1)
+    return {"users": len(user_ids), "follows": len(pairs), "posts": posts}
@@ -12,9 +12,125 @@ class Config(object):
     TEST = os.environ.get("TEST")
     SQLALCHEMY_DATABASE_URI = os.environ.get("DATABASE_URL", "sqlite:///" + os.path.join(basedir, "app.db"))
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # Connection pool options, passed to SQLAlchemy only when set, e.g. DATABASE_POOL_SIZE=10.
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        "pool_pre_ping": os.environ.get("DATABASE_POOL_PRE_PING", "").lower() in ("1", "true", "yes"),
+        **{
+            option: int(os.environ[f"DATABASE_{option.upper()}"])
+            for option in ("pool_size", "max_overflow", "pool_timeout", "pool_recycle")
+            if f"DATABASE_{option.upper()}" in os.environ
+        },
+    }
+    # Run on every connection to a file-backed SQLite database. WAL lets requests read while another one commits,
+    # and busy_timeout makes writers wait for the lock instead of failing with "database is locked".
+    SQLITE_PRAGMAS = {
+        "journal_mode": os.environ.get("SQLITE_JOURNAL_MODE", "WAL"),
+        "busy_timeout": int(os.environ.get("SQLITE_BUSY_TIMEOUT", 5000)),
+        "synchronous": os.environ.get("SQLITE_SYNCHRONOUS", "NORMAL"),
+        "mmap_size": int(os.environ.get("SQLITE_MMAP_SIZE", 256 * 1024 * 1024)),
+        # Negative sizes are in KiB.
+        "cache_size": int(os.environ.get("SQLITE_CACHE_SIZE", -64 * 1024)),
+    }
+    # Comma separated database URLs of read replicas. GET requests to read-only views read from one of them.
+    READ_REPLICA_URLS = [url for url in os.environ.get("READ_REPLICA_URLS", "").split(",") if url]
+    # Users who wrote something read from the primary for this many seconds, until the replicas have caught up.
+    READ_REPLICA_STICKY_SECONDS = int(os.environ.get("READ_REPLICA_STICKY_SECONDS", 5))
     ADMINS = ["microblog.service@outlook.com"]
+    # "sendgrid", "smtp" or "file". Defaults to SendGrid when SENDGRID_API_KEY is set, otherwise to .eml files in
+    # MAIL_FILE_DIR.
+    MAIL_TRANSPORT = os.environ.get("MAIL_TRANSPORT")
+    MAIL_FILE_DIR = os.environ.get("MAIL_FILE_DIR", os.path.join(basedir, "mail"))
+    MAIL_SERVER = os.environ.get("MAIL_SERVER", "localhost")
+    MAIL_PORT = int(os.environ.get("MAIL_PORT", 25))
+    MAIL_USERNAME = os.environ.get("MAIL_USERNAME")
+    MAIL_PASSWORD = os.environ.get("MAIL_PASSWORD")
+    MAIL_USE_TLS = os.environ.get("MAIL_USE_TLS", "").lower() in ("1", "true", "yes")
+    MAIL_WORKERS = int(os.environ.get("MAIL_WORKERS", 2))
+    MAIL_MAX_ATTEMPTS = 5
+    MAIL_RETRY_DELAY = 1
+    MAIL_RETRY_MAX_DELAY = 60
+    MAIL_DEDUPE_WINDOW = int(os.environ.get("MAIL_DEDUPE_WINDOW", 300))
     POSTS_PER_PAGE = 10
+    # Characters of text in the excerpts shown on post cards. Run `flask posts backfill-excerpts --all` after changing it.
+    POST_EXCERPT_LENGTH = 500
+    API_MAX_PER_PAGE = 100
+    API_BATCH_LIMIT = 100
+    API_EXPORT_CHUNK_SIZE = 500
+    # Where `flask assets build` writes the fingerprinted and compressed static files and their manifest.
+    ASSETS_BUILD_DIR = os.environ.get("ASSETS_BUILD_DIR", os.path.join(basedir, "build", "static"))
+    # Widths of the resized copies of images. Resizing and WebP copies require Pillow.
+    ASSETS_IMAGE_WIDTHS = (480, 960)
+    ASSETS_MAX_AGE = 365 * 24 * 3600
+    # Avatars are generated, or fetched from Gravatar with AVATAR_GRAVATAR, once per size and kept in
+    # AVATAR_CACHE_DIR, which is trimmed back by deleting the least recently used images when it grows too large.
+    AVATAR_CACHE_DIR = os.environ.get("AVATAR_CACHE_DIR", os.path.join(basedir, "cache", "avatars"))
+    AVATAR_CACHE_MAX_BYTES = int(os.environ.get("AVATAR_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+    AVATAR_MAX_SIZE = 512
+    AVATAR_MAX_AGE = 7 * 24 * 3600
+    AVATAR_GRAVATAR = os.environ.get("AVATAR_GRAVATAR", "").lower() in ("1", "true", "yes")
+    AVATAR_GRAVATAR_TTL = 24 * 3600
+    AVATAR_GRAVATAR_TIMEOUT = 3
+    # Seconds without requests to Gravatar after one failed. Identicons shown meanwhile are cached for as long.
+    AVATAR_GRAVATAR_RETRY = 60
+    # Responses of these types are compressed with gzip, or brotli when the brotli package is installed and the client
+    # prefers it. Other responses, and ones smaller than COMPRESS_MIN_SIZE bytes, are sent as they are.
+    COMPRESS_ENABLED = os.environ.get("COMPRESS_ENABLED", "true").lower() in ("1", "true", "yes")
+    COMPRESS_MIMETYPES = {
+        "text/html",
+        "text/css",
+        "text/plain",
+        "text/csv",
+        "text/xml",
+        "application/json",
+        "application/x-ndjson",
+        "application/javascript",
+        "image/svg+xml",
+    }
+    COMPRESS_MIN_SIZE = int(os.environ.get("COMPRESS_MIN_SIZE", 500))
+    COMPRESS_LEVEL = int(os.environ.get("COMPRESS_LEVEL", 6))
+    COMPRESS_BR_LEVEL = int(os.environ.get("COMPRESS_BR_LEVEL", 4))
+    # Optional Redis server shared by the caches of all processes. Requires the redis package.
+    CACHE_REDIS_URL = os.environ.get("CACHE_REDIS_URL")
+    CACHE_TIMEOUT = 24 * 3600
+    FRAGMENT_CACHE_SIZE = int(os.environ.get("FRAGMENT_CACHE_SIZE", 2000))
+    EXPLORE_CACHE_PAGES = int(os.environ.get("EXPLORE_CACHE_PAGES", 10))
+    # Bounds how long updates made by other processes can be missing from the Explore feed.
+    EXPLORE_CACHE_TTL = int(os.environ.get("EXPLORE_CACHE_TTL", 60))
+    # "log" or "raise" when a template triggers a lazy load. Defaults to "log" in debug mode.
+    LAZY_LOAD_GUARD = os.environ.get("LAZY_LOAD_GUARD")
+    # Queries taking at least this many seconds are written to logs/slow-queries.log. None disables the log.
+    SLOW_QUERY_THRESHOLD = float(os.environ.get("SLOW_QUERY_THRESHOLD", 0.1))
+    # /metrics requires an "Authorization: Bearer <token>" header with this token. Without one it is only available in
+    # debug and testing mode.
+    METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
+    USER_CACHE_SIZE = int(os.environ.get("USER_CACHE_SIZE", 10000))
+    # Bounds how long other processes may serve a stale user after it changed.
+    USER_CACHE_TTL = int(os.environ.get("USER_CACHE_TTL", 60))
+    LAST_SEEN_FLUSH_INTERVAL = float(os.environ.get("LAST_SEEN_FLUSH_INTERVAL", 30))
+    # Home feeds read from materialized timelines. Run `flask timeline rebuild` after enabling it, otherwise posts from
+    # before are pulled at read time like those of popular authors.
+    TIMELINE_ENABLED = os.environ.get("TIMELINE_ENABLED", "").lower() in ("1", "true", "yes")
+    TIMELINE_FANOUT_LIMIT = int(os.environ.get("TIMELINE_FANOUT_LIMIT", 1000))
     ELASTICSEARCH_URL = os.environ.get("ELASTICSEARCH_URL")
     ELASTICK_USERNAME = os.environ.get("ELASTICK_USERNAME")
     ELASTICK_PW = os.environ.get("ELASTICK_PW")
     ELASTICSEARCH_CERT = os.environ.get("ELASTICSEARCH_CERT")
+    # "elasticsearch", "sqlite" or "none". Defaults to Elasticsearch when ELASTICSEARCH_URL is set, otherwise SQLite.
+    SEARCH_BACKEND = os.environ.get("SEARCH_BACKEND")
+    SEARCH_SQLITE_PATH = os.environ.get("SEARCH_SQLITE_PATH", os.path.join(basedir, "search.db"))
+    # Totals above this are reported as "N+" instead of being counted exactly.
+    SEARCH_TRACK_TOTAL_HITS = int(os.environ.get("SEARCH_TRACK_TOTAL_HITS", 1000))
+    # Elasticsearch's index.max_result_window. Deeper pages are fetched with search_after.
+    SEARCH_MAX_RESULT_WINDOW = 10000
+    # Render search result cards from the stored index documents instead of loading the posts from the database.
+    SEARCH_RENDER_FROM_SOURCE = os.environ.get("SEARCH_RENDER_FROM_SOURCE", "").lower() in ("1", "true", "yes")
+    # Disable the in-process indexer thread when a dedicated `flask search worker` process drains the outbox.
+    SEARCH_INDEXER_THREAD = os.environ.get("SEARCH_INDEXER_THREAD", "true").lower() in ("1", "true", "yes")
+    SEARCH_OUTBOX_BATCH_SIZE = int(os.environ.get("SEARCH_OUTBOX_BATCH_SIZE", 500))
+    SEARCH_OUTBOX_POLL_INTERVAL = float(os.environ.get("SEARCH_OUTBOX_POLL_INTERVAL", 5))
+    SEARCH_OUTBOX_RETRY_DELAY = 1
+    SEARCH_OUTBOX_RETRY_MAX_DELAY = 300
+    # Where `flask search reindex` records its progress, so that --resume can continue an interrupted run.
+    SEARCH_REINDEX_CHECKPOINT = os.environ.get(
+        "SEARCH_REINDEX_CHECKPOINT", os.path.join(basedir, "instance", "reindex-{index}.json")
+    )
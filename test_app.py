@@ -1,28 +1,91 @@
+import gc
+import gzip
+import importlib.util
+import json
 import os
+import shutil
+import struct
+import tempfile
+import threading
+import time
+import weakref
 
 os.environ["DATABASE_URL"] = "sqlite://"
 
 import unittest
 from datetime import datetime, timedelta
+from unittest import mock
 
-from app import create_app, db
-from app.models import Post, User
+from flask import g, render_template_string, url_for
+from werkzeug.datastructures import Accept
+from flask_login import login_user
+
+from app import activity, create_app, db, mail
+from app.assets import build_assets
+from app.avatars import AvatarCache, Avatars, identicon
+from app.auth.email import send_password_reset_email
+from app.compression import negotiate_encoding
+from app.excerpts import make_excerpt
+from app.fragments import render_post_card
+from app.identity import SessionUser, invalidate_user, load_user
+from app.indexer import drain
+from app.instrumentation import LazyLoadError
+from app.mail import FileTransport, Message
+from app.models import (
+    Post,
+    SearchOutbox,
+    User,
+    backfill_excerpts,
+    followers,
+    rebuild_timelines,
+    reconcile_counters,
+)
+from app.pagination import encode_cursor, paginate_by_cursor
+from app.search import ElasticsearchBackend
+from benchmarks.concurrency import hammer, make_app
+from benchmarks.driver import ENDPOINTS, run
+from benchmarks.report import compare, summarize
+from benchmarks.seed import seed
 from config import Config
 
 
 class TestConfig(Config):
     TESTING = True
     SQLALCHEMY_DATABASE_URI = "sqlite:///"
+    SEARCH_BACKEND = "sqlite"
+    SEARCH_SQLITE_PATH = ":memory:"
+    SEARCH_INDEXER_THREAD = False
+    LAZY_LOAD_GUARD = "raise"
+    LAST_SEEN_FLUSH_INTERVAL = None
+    MAIL_WORKERS = 0
+    MAIL_RETRY_DELAY = 0
+
+
+class TimelineTestConfig(TestConfig):
+    TIMELINE_ENABLED = True
+
+
+def query_plan(query, parameters=None):
+    """Return the details of SQLite's EXPLAIN QUERY PLAN for a query, a statement, or SQL with its parameters."""
+    if isinstance(query, str):
+        return [row[-1] for row in db.session.connection().exec_driver_sql(f"EXPLAIN QUERY PLAN {query}", parameters)]
+    statement = getattr(query, "statement", query)
+    sql = statement.compile(dialect=db.engine.dialect, compile_kwargs={"literal_binds": True})
+    return [row[-1] for row in db.session.execute(db.text(f"EXPLAIN QUERY PLAN {sql}"))]
 
 
 class TestUserModelCase(unittest.TestCase):
+    config_class = TestConfig
+
     def setUp(self):
-        self.app = create_app(config_class=TestConfig)
+        self.app = create_app(config_class=self.config_class)
         self.app_context = self.app.app_context()
         self.app_context.push()
         db.create_all()
 
     def tearDown(self):
+        # Requests record last seen times, which would otherwise be flushed at exit into a dropped database.
+        self.app.last_seen_buffer.flush()
         db.session.remove()
         db.drop_all()
         self.app_context.pop()
@@ -35,9 +98,74 @@ class TestUserModelCase(unittest.TestCase):
 
     def test_avatar(self):
         u = User(username="john", email="john@example.com")
-        self.assertEqual(
-            u.avatar(128), "https://www.gravatar.com/avatar/d4c74594d841139328695756648b6bd6?d=retro&s=128"
-        )
+        with self.app.test_request_context():
+            self.assertEqual(u.avatar(128), "/avatar/d4c74594d841139328695756648b6bd6/128")
+            self.assertEqual(u.avatar(50, external=True), "http://localhost/avatar/d4c74594d841139328695756648b6bd6/50")
+            u.email = "John@Example.org"
+            self.assertEqual(u.avatar_digest, "08aff750c4586c34375a0ebd987c1a7e")
+
+    def test_avatar_images(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.app.config["AVATAR_CACHE_DIR"] = directory
+        self.app.avatars = Avatars(self.app)
+        digest = "d4c74594d841139328695756648b6bd6"
+        client = self.app.test_client()
+
+        response = client.get(f"/avatar/{digest}/50")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, "image/png")
+        self.assertEqual(struct.unpack(">II", response.data[16:24]), (50, 50))
+        self.assertTrue(response.cache_control.public)
+        self.assertTrue(response.cache_control.immutable)
+        self.assertEqual(response.cache_control.max_age, self.app.config["AVATAR_MAX_AGE"])
+        self.assertNotIn("Cookie", response.vary)
+        self.assertTrue(os.path.exists(os.path.join(directory, "identicon", "d4", f"{digest}-50.png")))
+        self.assertEqual(response.data, identicon(digest, 50))
+        self.assertNotEqual(response.data, identicon("0" * 32, 50))
+        revalidated = client.get(f"/avatar/{digest}/50", headers={"If-None-Match": response.headers["ETag"]})
+        self.assertEqual(revalidated.status_code, 304)
+        self.assertEqual(client.get(f"/avatar/{digest.upper()}/50").status_code, 404)
+        self.assertEqual(client.get(f"/avatar/{digest}/0").status_code, 404)
+        self.assertEqual(client.get(f"/avatar/{digest}/4096").status_code, 404)
+
+        # Without a Gravatar, or when Gravatar can't be reached, the identicon is used.
+        self.app.config["AVATAR_GRAVATAR"] = True
+        with mock.patch.object(Avatars, "fetch_gravatar", return_value=b"") as fetch:
+            self.assertEqual(client.get(f"/avatar/{digest}/50").data, response.data)
+            self.assertEqual(client.get(f"/avatar/{digest}/50").data, response.data)
+        fetch.assert_called_once_with(digest, 50)
+        with mock.patch.object(Avatars, "fetch_gravatar", side_effect=OSError("timed out")) as fetch:
+            response = client.get(f"/avatar/{digest}/60")
+            # Gravatar isn't asked again for a while.
+            self.assertEqual(client.get(f"/avatar/{digest}/70").status_code, 200)
+        fetch.assert_called_once_with(digest, 60)
+        self.assertEqual(struct.unpack(">II", response.data[16:24]), (60, 60))
+        self.assertFalse(response.cache_control.immutable)
+        self.assertEqual(response.cache_control.max_age, self.app.config["AVATAR_GRAVATAR_RETRY"])
+        self.app.avatars._gravatar_down_until = 0
+        jpeg = b"\xff\xd8\xff\xe0 a photo"
+        with mock.patch.object(Avatars, "fetch_gravatar", return_value=jpeg):
+            response = client.get(f"/avatar/{digest}/60")
+        self.assertEqual(response.cache_control.max_age, self.app.config["AVATAR_MAX_AGE"])
+        self.assertEqual((response.mimetype, response.data), ("image/jpeg", jpeg))
+
+    def test_avatar_cache_eviction(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        cache = AvatarCache(directory, max_bytes=350)
+        for n, name in enumerate(["a/1", "a/2", "b/3"]):
+            cache.put(name, bytes(100))
+            os.utime(cache.path(name), (1000 + n, 1000 + n))
+        # Reading 1 makes 2 the least recently used.
+        self.assertEqual(cache.get("a/1"), bytes(100))
+        self.assertIsNone(cache.get("a/4"))
+        cache.put("a/4", bytes(100))
+        self.assertIsNone(cache.get("a/2"))
+        self.assertEqual(cache.get("b/3"), bytes(100))
+        self.assertEqual(cache.get("a/1"), bytes(100))
+        self.assertEqual(cache.get("a/4"), bytes(100))
+        self.assertEqual(cache.evict(), 0)
 
     def test_follow(self):
         u1 = User(username="john", email="john@example.com")
@@ -50,9 +178,13 @@ class TestUserModelCase(unittest.TestCase):
         self.assertEqual(u1.followed.all(), [])
         self.assertEqual(u1.followers.all(), [])
 
+        u1.follow(u2)
         u1.follow(u2)
         db.session.commit()
         self.assertTrue(u1.is_following(u2))
+        self.assertFalse(u2.is_following(u1))
+        self.assertEqual((u1.followed_count, u1.followers_count), (1, 0))
+        self.assertEqual((u2.followed_count, u2.followers_count), (0, 1))
         self.assertEqual(u1.followed.count(), 1)
         self.assertEqual(u1.followed.first().username, "susan")
         self.assertEqual(u2.followers.count(), 1)
@@ -61,6 +193,7 @@ class TestUserModelCase(unittest.TestCase):
         u1.unfollow(u2)
         db.session.commit()
         self.assertFalse(u1.is_following(u2))
+        self.assertEqual((u1.followed_count, u2.followers_count), (0, 0))
         self.assertEqual(u1.followed.count(), 0)
         self.assertEqual(u2.followers.count(), 0)
 
@@ -127,6 +260,980 @@ class TestUserModelCase(unittest.TestCase):
         self.assertEqual(f3, [p3, p4])
         self.assertEqual(f4, [p4])
 
+    def test_counters(self):
+        u1 = User(username="john", email="john@example.com")
+        u1.set_password("cat")
+        u2 = User(username="susan", email="susan@example.com")
+        u2.set_password("dog")
+        p1 = Post(title="Title 1", subtitle="Subtitle 1", body="post from john", author=u1)
+        p2 = Post(title="Title 2", subtitle="Subtitle 2", body="post from john", author=u1)
+        db.session.add_all([u1, u2, p1, p2])
+        db.session.commit()
+        self.assertEqual((u1.posts_count, u2.posts_count), (2, 0))
+        db.session.delete(p1)
+        db.session.commit()
+        self.assertEqual(u1.posts_count, 1)
+
+        u1.follow(u2)
+        db.session.commit()
+        db.session.execute(db.update(User).values(followers_count=7, posts_count=0))
+        db.session.commit()
+        self.assertEqual(reconcile_counters(), 2)
+        self.assertEqual((u1.posts_count, u1.followers_count, u1.followed_count), (1, 0, 1))
+        self.assertEqual((u2.posts_count, u2.followers_count, u2.followed_count), (0, 1, 0))
+        self.assertEqual(reconcile_counters(), 0)
+
+    def test_feed_query_loads_authors(self):
+        users = [User(username=name, email=f"{name}@example.com") for name in ("john", "susan", "mary")]
+        for u in users:
+            u.set_password("cat")
+        db.session.add_all(users)
+        db.session.add_all([Post(title="Title", subtitle="Subtitle", body="body", author=u) for u in users])
+        db.session.commit()
+        db.session.expunge_all()
+        template = "{% for post in posts %}{{ post.author.username }} {% endfor %}"
+
+        with self.app.test_request_context():
+            posts = Post.feed_query().order_by(Post.id).all()
+            self.assertEqual(render_template_string(template, posts=posts), "john susan mary ")
+            db.session.expunge_all()
+            posts = Post.query.all()
+            self.assertRaises(LazyLoadError, render_template_string, template, posts=posts)
+        # The template that raised is forgotten with its request, and with the request that raised in it.
+        self.assertIsNone(g.get("rendering_templates"))
+
+        @self.app.route("/broken")
+        def broken():
+            return render_template_string("{{ 1 // 0 }}")
+
+        self.assertRaises(ZeroDivisionError, self.app.test_client().get, "/broken")
+        self.assertIsNone(g.get("rendering_templates"))
+
+    def test_post_card_cache(self):
+        u1 = User(username="john", email="john@example.com")
+        u1.set_password("cat")
+        u2 = User(username="susan", email="susan@example.com")
+        u2.set_password("dog")
+        p = Post(title="Title", subtitle="Subtitle", body="post from john", author=u1)
+        db.session.add_all([u1, u2, p])
+        db.session.commit()
+        cache = self.app.fragment_cache
+
+        with self.app.test_request_context():
+            login_user(u1)
+            self.assertIn("Edit</a>", render_post_card(p))
+            login_user(u2)
+            html = render_post_card(p)
+            self.assertNotIn("Edit</a>", html)
+            self.assertIn("post from john", html)
+            self.assertEqual((cache.hits, cache.misses), (1, 1))
+
+            p.body = "edited post from john"
+            db.session.commit()
+            self.assertEqual(p.version, 2)
+            self.assertIn("edited post from john", render_post_card(p))
+            self.assertEqual(cache.misses, 2)
+
+    def test_excerpts(self):
+        self.assertEqual(
+            make_excerpt("<p>Hello <strong>big <em>world</em></strong> and more</p><script>alert(1)</script>", 12),
+            "<p>Hello <strong>big <em>...</em></strong></p>",
+        )
+        self.assertEqual(
+            make_excerpt('<p onclick="x">1 &lt; 2 <a href="javascript:alert(1)">bad</a> <a href="/user/a">ok</a>'),
+            '<p>1 &lt; 2 <a>bad</a> <a href="/user/a">ok</a></p>',
+        )
+        self.assertEqual(make_excerpt("<ul><li>one<li>two</ul><img src=x>"), "<ul><li>one</li><li>two</li></ul>")
+        # Browsers ignore control characters in URLs, so these are all javascript: links.
+        for href in (
+            "java\tscript:alert(1)",
+            "java&#9;script:alert(1)",
+            "\x01javascript:alert(1)",
+            "jav&#x0A;ascript:x",
+        ):
+            self.assertEqual(make_excerpt(f'<a href="{href}">x</a>'), "<a>x</a>")
+        self.assertEqual(
+            make_excerpt('<a href=" https://example.com/a?b=1&amp;c=2">x</a>'),
+            '<a href="https://example.com/a?b=1&amp;c=2">x</a>',
+        )
+
+        u = User(username="john", email="john@example.com")
+        u.set_password("cat")
+        p = Post(title="Title", subtitle="Subtitle", body="<p>post from <b>john</b></p>", author=u)
+        db.session.add_all([u, p])
+        db.session.commit()
+        self.assertEqual(p.excerpt, "<p>post from <b>john</b></p>")
+        p.body = "<p>edited</p>"
+        db.session.commit()
+        self.assertEqual(p.excerpt, "<p>edited</p>")
+
+        # List pages never load the body.
+        statements = []
+        db.event.listen(db.engine, "before_cursor_execute", lambda *args: statements.append(args[2]))
+        client = self.app.test_client()
+        with client.session_transaction() as session:
+            session["_user_id"] = str(u.id)
+        for url in ("/index", "/explore", "/user/john"):
+            response = client.get(url)
+            self.assertIn(b"<p>edited</p>", response.data)
+        self.assertFalse([statement for statement in statements if "post.body" in statement])
+
+        db.session.execute(db.update(Post).values(excerpt=None))
+        db.session.commit()
+        self.assertEqual(backfill_excerpts(batch_size=1), 1)
+        self.assertEqual(backfill_excerpts(), 0)
+        db.session.expire_all()
+        self.assertEqual((p.excerpt, p.version), ("<p>edited</p>", 3))
+
+    def test_static_assets(self):
+        with tempfile.TemporaryDirectory() as source, tempfile.TemporaryDirectory() as target:
+            os.makedirs(os.path.join(source, "css"))
+            os.makedirs(os.path.join(source, "fonts"))
+            with open(os.path.join(source, "css", "main.css"), "w") as f:
+                f.write('@font-face { src: url("../fonts/icons.woff2?v=1#iefix"); }\n' + "body { color: red; }\n" * 100)
+            with open(os.path.join(source, "fonts", "icons.woff2"), "wb") as f:
+                f.write(b"font")
+            with open(os.path.join(source, "css", "main.css.map"), "w") as f:
+                f.write("{}")
+            entries = build_assets(source, target)
+            self.assertEqual(set(entries), {"css/main.css", "fonts/icons.woff2"})
+            font = entries["fonts/icons.woff2"]["path"]
+            self.assertRegex(font, r"^fonts/icons\.[0-9a-f]{12}\.woff2$")
+            css = entries["css/main.css"]
+            self.assertIn("gzip", css["encodings"])
+            with open(os.path.join(target, css["path"])) as f:
+                self.assertIn(f'url("../{font}#iefix")', f.read())
+            # A second build of the same files writes the same names.
+            self.assertEqual(build_assets(source, target, clean=True), entries)
+
+            self.app.config["ASSETS_BUILD_DIR"] = target
+            self.app.assets.directory = target
+            self.app.assets.load(entries)
+            with self.app.test_request_context():
+                url = url_for("static", filename="css/main.css")
+            self.assertEqual(url, "/static/" + css["path"])
+            client = self.app.test_client()
+            response = client.get(url, headers={"Accept-Encoding": "br;q=0, gzip"})
+            self.assertEqual(response.content_encoding, "gzip")
+            self.assertEqual(response.mimetype, "text/css")
+            self.assertTrue(response.cache_control.immutable)
+            self.assertEqual(response.cache_control.max_age, self.app.config["ASSETS_MAX_AGE"])
+            self.assertNotIn("Cookie", response.vary)
+            self.assertIn(b"body { color: red; }", gzip.decompress(response.data))
+            response = client.get(url)
+            self.assertIsNone(response.content_encoding)
+            self.assertIn(b"body { color: red; }", response.data)
+            # Files that were not built are served from the static folder as before.
+            response = client.get("/static/img/logo.png")
+            self.assertEqual(response.status_code, 200)
+            self.assertFalse(response.cache_control.immutable)
+            response.close()
+
+    @unittest.skipUnless(importlib.util.find_spec("PIL"), "requires Pillow")
+    def test_static_image_variants(self):
+        with tempfile.TemporaryDirectory() as source, tempfile.TemporaryDirectory() as target:
+            os.makedirs(os.path.join(source, "img"))
+            shutil.copyfile(
+                os.path.join(self.app.static_folder, "img", "post-landscape-1.jpg"),
+                os.path.join(source, "img", "photo.jpg"),
+            )
+            entries = build_assets(source, target, image_widths=(480, 2000))
+            entry = entries["img/photo.jpg"]
+            self.assertEqual(entry["width"], 900)
+            self.assertEqual(set(entry["variants"]), {"480w.jpg", "480w.webp", ".webp"})
+            self.assertEqual(entry["variants"]["480w.webp"]["width"], 480)
+
+            self.app.assets.directory = target
+            self.app.assets.load(entries)
+            with self.app.test_request_context():
+                urls = [url_for("static", filename=f"img/photo{name}") for name in ("-480w.webp", ".webp", ".jpg")]
+            self.assertEqual(
+                urls,
+                ["/static/" + entry["variants"][name]["path"] for name in ("480w.webp", ".webp")]
+                + ["/static/" + entry["path"]],
+            )
+            response = self.app.test_client().get(urls[0])
+            self.assertEqual(response.mimetype, "image/webp")
+            self.assertTrue(response.cache_control.immutable)
+            response.close()
+
+    def test_apps_are_not_kept_alive_for_exit_hooks(self):
+        self.assertIn(self.app.last_seen_buffer, activity._buffers)
+        self.assertIn(self.app.mail_queue, mail._queues)
+        app = create_app(config_class=TestConfig)
+        refs = [weakref.ref(app), weakref.ref(app.last_seen_buffer), weakref.ref(app.mail_queue)]
+        del app
+        gc.collect()
+        self.assertEqual([ref() for ref in refs], [None, None, None])
+
+    def test_last_seen_buffer(self):
+        u1 = User(username="john", email="john@example.com", last_seen=datetime(2020, 1, 1))
+        u1.set_password("cat")
+        u2 = User(username="susan", email="susan@example.com", last_seen=datetime(2020, 1, 1))
+        u2.set_password("dog")
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        buffer = self.app.last_seen_buffer
+        buffer.touch(u1.id, datetime(2023, 1, 1))
+        buffer.touch(u2.id, datetime(2023, 1, 2))
+        buffer.touch(u1.id, datetime(2023, 1, 3))
+        self.assertEqual(u1.last_seen, datetime(2020, 1, 1))
+        self.assertEqual(buffer.flush(), 2)
+        db.session.expire_all()
+        self.assertEqual((u1.last_seen, u2.last_seen), (datetime(2023, 1, 3), datetime(2023, 1, 2)))
+        self.assertEqual(buffer.flush(), 0)
+
+    def test_cached_user_loader(self):
+        u = User(username="john", email="john@example.com")
+        u.set_password("cat")
+        db.session.add(u)
+        db.session.commit()
+        first = load_user(str(u.id))
+        self.assertIsInstance(first, SessionUser)
+        self.assertIs(load_user(str(u.id)), first)
+        self.assertEqual(self.app.user_cache.stats()["hit_rate"], 0.5)
+        self.assertEqual(first, u)
+        with self.app.test_request_context():
+            self.assertEqual(first.avatar(128), u.avatar(128))
+        self.assertIs(first.rehydrate(), u)
+        self.assertIsNone(load_user("9999"))
+
+        u.about_me = "hello"
+        db.session.commit()
+        invalidate_user(u)
+        self.assertEqual(load_user(str(u.id)).about_me, "hello")
+
+    def test_mail_queue(self):
+        u = User(username="john", email="john@example.com")
+        u.set_password("cat")
+        db.session.add(u)
+        db.session.commit()
+        with tempfile.TemporaryDirectory() as directory:
+            queue = self.app.mail_queue
+            queue.transport = FileTransport(directory)
+            with self.app.test_request_context():
+                send_password_reset_email(u)
+                send_password_reset_email(u)
+            self.assertEqual(os.listdir(directory), [])
+            self.assertEqual(queue.drain(), 1)
+            [name] = os.listdir(directory)
+            with open(os.path.join(directory, name)) as f:
+                self.assertIn("Subject: [Microblog] Reset Your Password", f.read())
+
+            # Failed deliveries are retried until MAIL_MAX_ATTEMPTS is reached.
+            failures = [ConnectionError(), ConnectionError()]
+
+            def flaky_send(message):
+                if failures:
+                    raise failures.pop()
+
+            with mock.patch.object(queue.transport, "send", side_effect=flaky_send) as send:
+                self.assertTrue(queue.send(Message("a@example.com", "b@example.com", "Hi", "<p>Hi</p>")))
+                self.assertEqual(queue.drain(), 1)
+                self.assertEqual(send.call_count, 3)
+                send.side_effect = ConnectionError()
+                queue.send(Message("a@example.com", "b@example.com", "Hi", "<p>Hi</p>"))
+                self.assertEqual(queue.drain(), 0)
+                self.assertEqual(send.call_count, 3 + self.app.config["MAIL_MAX_ATTEMPTS"])
+
+    def test_conditional_get(self):
+        u1 = User(username="john", email="john@example.com")
+        u1.set_password("cat")
+        u2 = User(username="susan", email="susan@example.com")
+        u2.set_password("dog")
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        p = Post(title="t", subtitle="s", body="post from susan", author=u2)
+        db.session.add(p)
+        db.session.commit()
+
+        client = self.app.test_client()
+        with client.session_transaction() as session:
+            session["_user_id"] = str(u1.id)
+        for url in ["/explore", "/user/susan", f"/post/{p.id}"]:
+            response = client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.headers["Cache-Control"], "private, no-cache")
+            etag = response.headers["ETag"]
+            response = client.get(url, headers={"If-None-Match": etag})
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response.data, b"")
+
+            # Editing the post changes every page that shows it.
+            p.body = "edited " + url
+            db.session.commit()
+            self.assertEqual(client.get(url, headers={"If-None-Match": etag}).status_code, 200)
+
+        etag = client.get("/user/susan").headers["ETag"]
+        u1.follow(u2)
+        db.session.commit()
+        self.assertEqual(client.get("/user/susan", headers={"If-None-Match": etag}).status_code, 200)
+
+    def test_explore_feed(self):
+        self.app.config["EXPLORE_CACHE_PAGES"] = 2
+        u = User(username="john", email="john@example.com")
+        u.set_password("cat")
+        db.session.add(u)
+        now = datetime.utcnow()
+        posts = [
+            Post(title="t", subtitle="s", body=f"post {i}", author=u, timestamp=now - timedelta(minutes=i))
+            for i in range(25)
+        ]
+        db.session.add_all(posts)
+        db.session.commit()
+        feed = self.app.explore_feed
+        per_page = self.app.config["POSTS_PER_PAGE"]
+
+        page = feed.paginate(per_page)
+        self.assertEqual([id for _, id in page.items], [p.id for p in posts[:per_page]])
+        page = feed.paginate(per_page, before=encode_cursor(posts[per_page - 1]))
+        self.assertEqual([id for _, id in page.items], [p.id for p in posts[per_page : 2 * per_page]])
+        self.assertEqual(feed.paginate(per_page, page=2).total, 25)
+        # The third page is not cached.
+        self.assertIsNone(feed.paginate(per_page, before=encode_cursor(posts[2 * per_page - 1])))
+        self.assertIsNone(feed.paginate(per_page, page=3))
+
+        # New and deleted posts are applied to the cached list without rebuilding it.
+        with mock.patch.object(feed, "_build", wraps=feed._build) as build:
+            p = Post(title="t", subtitle="s", body="new post", author=u)
+            db.session.add(p)
+            db.session.commit()
+            db.session.delete(posts[0])
+            db.session.commit()
+            page = feed.paginate(per_page)
+            self.assertEqual([id for _, id in page.items], [p.id] + [p.id for p in posts[1:per_page]])
+            self.assertEqual(feed.paginate(per_page, page=1).total, 25)
+            self.assertEqual(build.call_count, 0)
+
+        # Concurrent misses rebuild the list only once.
+        feed.cache.clear()
+
+        def slow_build():
+            time.sleep(0.1)
+            return [], 0
+
+        with mock.patch.object(feed, "_build", side_effect=slow_build) as build:
+            threads = [threading.Thread(target=feed.get) for _ in range(5)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(build.call_count, 1)
+
+    def assertUsesIndexes(self, query, *expected, parameters=None):
+        details = query_plan(query, parameters)
+        full_scans = [detail for detail in details if detail.split()[:2] in [["SCAN", t] for t in db.metadata.tables]]
+        self.assertEqual(full_scans, [], details)
+        for text in expected:
+            self.assertTrue(any(text in detail for detail in details), f"{text!r} not in {details}")
+
+    def test_query_plans(self):
+        u1 = User(username="john", email="john@example.com")
+        u1.set_password("cat")
+        u2 = User(username="susan", email="susan@example.com")
+        u2.set_password("dog")
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        self.assertUsesIndexes(u1.followed_posts(), "SEARCH followers", "ix_post_user_id_timestamp")
+        # The plan of the statement that is_following actually runs.
+        u1_id, u2_id = u1.id, u2.id
+        executed = []
+        capture = lambda conn, cursor, statement, parameters, *args: executed.append((statement, parameters))
+        db.event.listen(db.engine, "before_cursor_execute", capture)
+        try:
+            self.assertFalse(u1.is_following(u2))
+        finally:
+            db.event.remove(db.engine, "before_cursor_execute", capture)
+        self.assertEqual(len(executed), 1, executed)
+        statement, parameters = executed[0]
+        self.assertEqual(parameters[:2], (u1_id, u2_id))
+        self.assertUsesIndexes(statement, "SEARCH followers", parameters=parameters)
+        self.assertUsesIndexes(u1.posts.order_by(Post.timestamp.desc()), "ix_post_user_id_timestamp")
+        self.assertUsesIndexes(u1.followers, "ix_followers_followed_id")
+
+    def test_benchmarks(self):
+        self.app.config["WTF_CSRF_ENABLED"] = False
+        seed(users=10, posts=30, follows=3)
+        # The driver needs no active context, like a real client.
+        self.app_context.pop()
+        try:
+            results = summarize(run(self.app, requests=2, warmup=1))
+        finally:
+            self.app_context.push()
+        self.assertEqual(list(results), ENDPOINTS)
+        for result in results.values():
+            self.assertEqual((result["requests"], result["errors"]), (2, 0))
+            self.assertGreater(result["queries_mean"], 0)
+        baseline = {"results": results}
+        self.assertEqual(compare(results, baseline), [])
+        slower = {"main.index": dict(results["main.index"], p95_ms=results["main.index"]["p95_ms"] * 2 + 10)}
+        self.assertEqual(len(compare(slower, baseline)), 1)
+
+    def test_sqlite_pragmas(self):
+        pragma = lambda name: db.session.execute(db.text(f"PRAGMA {name}")).scalar()
+        # The in-memory test database is left alone.
+        self.assertEqual(pragma("journal_mode"), "memory")
+        with tempfile.TemporaryDirectory() as directory:
+            database = os.path.join(directory, "app.db")
+            app = make_app(database, Config.SQLITE_PRAGMAS)
+            with app.app_context():
+                db.create_all()
+                seed(users=5, posts=10, follows=2)
+                self.assertEqual(pragma("journal_mode"), "wal")
+                self.assertEqual(pragma("busy_timeout"), 5000)
+                self.assertEqual(pragma("synchronous"), 1)
+                db.session.remove()
+                db.engine.dispose()
+            counts = hammer(database, Config.SQLITE_PRAGMAS, threads=4, duration=0.5, write_ratio=0.5)
+        self.assertEqual((counts["locked"], counts["errors"]), (0, 0))
+        self.assertGreater(counts["reads"], 0)
+        self.assertGreater(counts["writes"], 0)
+
+    def test_metrics(self):
+        u = User(username="john", email="john@example.com")
+        u.set_password("cat")
+        db.session.add(u)
+        db.session.add(Post(title="t", subtitle="s", body="not indexed yet", author=u))
+        db.session.commit()
+        client = self.app.test_client()
+        with client.session_transaction() as session:
+            session["_user_id"] = str(u.id)
+        self.app.config["SLOW_QUERY_THRESHOLD"] = 0
+        with self.assertLogs("app.slow_queries", "WARNING") as logs:
+            self.assertEqual(client.get("/explore").status_code, 200)
+        self.assertIn("in main.explore: SELECT", logs.output[0])
+        self.app.config["SLOW_QUERY_THRESHOLD"] = None
+
+        self.app.config["TESTING"] = False
+        self.assertEqual(client.get("/metrics").status_code, 404)
+        self.app.config["TESTING"] = True
+        self.app.config["METRICS_TOKEN"] = "secret"
+        self.assertEqual(client.get("/metrics").status_code, 401)
+        self.assertEqual(client.get("/metrics", headers={"Authorization": "Bearer secreT"}).status_code, 401)
+        response = client.get("/metrics", headers={"Authorization": "Bearer secret"})
+        self.assertEqual(response.status_code, 200)
+        metrics = response.get_data(as_text=True)
+        self.assertIn('microblog_request_duration_seconds_count{endpoint="main.explore"} 1', metrics)
+        self.assertIn('microblog_request_queries_bucket{endpoint="main.explore",le="+Inf"} 1', metrics)
+        self.assertIn('microblog_cache_hits_total{cache="users",tier="local"}', metrics)
+        self.assertIn("microblog_search_outbox_pending 1", metrics)
+        self.assertIn(f"microblog_slow_queries_total {len(logs.output)}", metrics)
+
+    def test_response_compression(self):
+        u = User(username="john", email="john@example.com")
+        u.set_password("cat")
+        db.session.add(u)
+        db.session.add_all([Post(title=f"t{i}", subtitle="s", body=f"body {i}", author=u) for i in range(5)])
+        db.session.commit()
+        client = self.app.test_client()
+        with client.session_transaction() as session:
+            session["_user_id"] = str(u.id)
+
+        plain = client.get("/explore")
+        self.assertIsNone(plain.content_encoding)
+        self.assertIn("Accept-Encoding", plain.vary)
+        response = client.get("/explore", headers={"Accept-Encoding": "gzip, deflate"})
+        self.assertEqual(response.content_encoding, "gzip")
+        self.assertEqual(gzip.decompress(response.data), plain.data)
+        self.assertLess(len(response.data), len(plain.data))
+        etag, weak = response.get_etag()
+        self.assertTrue(weak)
+        response = client.get("/explore", headers={"If-None-Match": f'W/"{etag}"', "Accept-Encoding": "gzip"})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.get_etag(), (etag, True))
+        self.assertIn("Accept-Encoding", response.vary)
+
+        # Pages with a CSRF token aren't compressed when they may show text from the request, as that gives away the
+        # token (BREACH).
+        response = client.get("/explore?page=1", headers={"Accept-Encoding": "gzip"})
+        self.assertEqual(response.content_encoding, "gzip")
+        response = client.get("/edit_profile", headers={"Accept-Encoding": "gzip"})
+        self.assertEqual(response.content_encoding, "gzip")
+        self.assertIn(b"csrf_token", gzip.decompress(response.data))
+        response = client.get("/edit_profile?about_me=guess", headers={"Accept-Encoding": "gzip"})
+        self.assertIsNone(response.content_encoding)
+        self.assertIn(b"csrf_token", response.data)
+
+        # Small responses are not worth compressing.
+        response = client.get("/api/v1/users/john", headers={"Accept-Encoding": "gzip"})
+        self.assertIsNone(response.content_encoding)
+
+        # Streamed responses are compressed chunk by chunk.
+        plain = client.get("/api/v1/posts/export")
+        response = client.get("/api/v1/posts/export", headers={"Accept-Encoding": "gzip"})
+        self.assertTrue(response.is_streamed)
+        self.assertEqual(response.content_encoding, "gzip")
+        self.assertEqual(gzip.decompress(response.data), plain.data)
+
+        self.assertEqual(negotiate_encoding(Accept([("gzip", 1), ("br", 1)])), "br")
+        self.assertEqual(negotiate_encoding(Accept([("gzip", 1), ("br", 1)]), brotli=False), "gzip")
+        self.assertEqual(negotiate_encoding(Accept([("br", 0.5), ("gzip", 1)])), "gzip")
+        self.assertIsNone(negotiate_encoding(Accept([("identity", 1)])))
+
+        metrics = client.get("/metrics").get_data(as_text=True)
+        self.assertIn('microblog_compression_responses_total{encoding="gzip"} 4', metrics)
+        self.assertIn('microblog_compression_ratio{encoding="gzip"} 0.', metrics)
+        self.assertIn('microblog_compression_cpu_seconds_total{encoding="gzip"}', metrics)
+
+    @unittest.skipUnless(importlib.util.find_spec("brotli"), "requires brotli")
+    def test_brotli_compression(self):
+        import brotli
+
+        u = User(username="john", email="john@example.com")
+        u.set_password("cat")
+        db.session.add(u)
+        db.session.add_all([Post(title=f"t{i}", subtitle="s", body=f"body {i}", author=u) for i in range(5)])
+        db.session.commit()
+        client = self.app.test_client()
+        with client.session_transaction() as session:
+            session["_user_id"] = str(u.id)
+
+        plain = client.get("/explore")
+        response = client.get("/explore", headers={"Accept-Encoding": "gzip, br"})
+        self.assertEqual(response.content_encoding, "br")
+        self.assertEqual(brotli.decompress(response.data), plain.data)
+        self.assertLess(len(response.data), len(plain.data))
+
+        plain = client.get("/api/v1/posts/export")
+        response = client.get("/api/v1/posts/export", headers={"Accept-Encoding": "br"})
+        self.assertTrue(response.is_streamed)
+        self.assertEqual(response.content_encoding, "br")
+        self.assertEqual(brotli.decompress(response.data), plain.data)
+        metrics = client.get("/metrics").get_data(as_text=True)
+        self.assertIn('microblog_compression_responses_total{encoding="br"} 2', metrics)
+
+    def test_api(self):
+        u1 = User(username="john", email="john@example.com")
+        u1.set_password("cat")
+        u2 = User(username="susan", email="susan@example.com")
+        u2.set_password("dog")
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        now = datetime.utcnow()
+        posts = [
+            Post(title=f"t{i}", subtitle="s", body=f"body {i}", author=u2, timestamp=now - timedelta(minutes=i))
+            for i in range(5)
+        ]
+        db.session.add_all(posts)
+        db.session.commit()
+
+        client = self.app.test_client()
+        # Requests share the test's app context, so the anonymous user must not end up in its g.
+        with self.app.app_context():
+            self.assertEqual(client.get("/api/v1/explore").status_code, 401)
+        with client.session_transaction() as session:
+            session["_user_id"] = str(u1.id)
+
+        response = client.get("/api/v1/explore?limit=3&fields=id,author")
+        self.assertEqual(response.json["items"], [{"id": p.id, "author": "susan"} for p in posts[:3]])
+        response = client.get(response.json["_links"]["next"])
+        self.assertEqual([item["id"] for item in response.json["items"]], [p.id for p in posts[3:]])
+        self.assertIsNone(response.json["next_cursor"])
+        self.assertEqual(client.get("/api/v1/timeline").json["items"], [])
+        self.assertEqual(client.get("/api/v1/explore?fields=nope").status_code, 400)
+
+        self.assertEqual(client.get("/api/v1/users/susan").json["posts_count"], 5)
+        self.assertEqual(client.get("/api/v1/users/nobody").json, {"error": "Not Found"})
+        response = client.get(f"/api/v1/posts?ids={posts[2].id},9999,{posts[0].id}&fields=id,body")
+        self.assertEqual(
+            response.json["items"], [{"id": posts[2].id, "body": "body 2"}, {"id": posts[0].id, "body": "body 0"}]
+        )
+        self.assertEqual(response.json["missing"], [9999])
+
+        response = client.get("/api/v1/posts/export?user=susan&fields=id,title")
+        self.assertEqual(response.mimetype, "application/x-ndjson")
+        self.assertEqual(
+            [json.loads(line) for line in response.get_data(as_text=True).splitlines()],
+            [{"id": p.id, "title": p.title} for p in posts],
+        )
+
+    def test_data_export_import(self):
+        u1 = User(username="john", email="john@example.com", about_me="")
+        u1.set_password("cat")
+        u2 = User(username="susan", email="susan@example.com")
+        u2.set_password("dog")
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        u1.follow(u2)
+        db.session.add_all([Post(title="t", subtitle="s", body=f"imported body {i}", author=u2) for i in range(3)])
+        db.session.commit()
+        drain()
+        runner = self.app.test_cli_runner()
+        for fmt in ("ndjson", "csv"):
+            with tempfile.TemporaryDirectory() as directory:
+                result = runner.invoke(args=["data", "export", directory, "--format", fmt])
+                self.assertIn("posts: 3 rows", result.output)
+                db.session.remove()
+                db.drop_all()
+                db.create_all()
+                self.app.search_backend.remove("post", 1)
+                result = runner.invoke(args=["data", "import", directory, "--format", fmt, "--batch-size", "2"])
+                self.assertIn("follows: 1 rows", result.output)
+
+            john = db.session.scalar(db.select(User).filter_by(username="john"))
+            susan = db.session.scalar(db.select(User).filter_by(username="susan"))
+            self.assertTrue(john.check_password("cat"))
+            self.assertEqual(john.about_me, "" if fmt == "ndjson" else None)
+            self.assertEqual(john.followed.all(), [susan])
+            self.assertEqual((susan.posts_count, susan.followers_count), (3, 1))
+            self.assertEqual(SearchOutbox.query.count(), 0)
+            self.assertEqual(Post.search("imported", 1)[1], 3)
+
+    def test_cursor_pagination(self):
+        u1 = User(username="john", email="john@example.com")
+        u1.set_password("cat")
+        u2 = User(username="susan", email="susan@example.com")
+        u2.set_password("dog")
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        u1.follow(u2)
+        db.session.commit()
+
+        # Posts share timestamps in pairs so the id has to break ties.
+        now = datetime.utcnow()
+        posts = [
+            Post(
+                title=f"Title {i}",
+                subtitle="Subtitle",
+                body="body",
+                author=[u1, u2][i % 2],
+                timestamp=now - timedelta(seconds=i // 2),
+            )
+            for i in range(5)
+        ]
+        db.session.add_all(posts)
+        db.session.commit()
+        expected = sorted(posts, key=lambda p: (p.timestamp, p.id), reverse=True)
+
+        page1 = paginate_by_cursor(u1.followed_posts(), Post, 2)
+        self.assertEqual(page1.items, expected[:2])
+        self.assertTrue(page1.has_next)
+        self.assertFalse(page1.has_prev)
+        page2 = paginate_by_cursor(u1.followed_posts(), Post, 2, before=page1.next_cursor)
+        self.assertEqual(page2.items, expected[2:4])
+        page3 = paginate_by_cursor(u1.followed_posts(), Post, 2, before=page2.next_cursor)
+        self.assertEqual(page3.items, expected[4:])
+        self.assertFalse(page3.has_next)
+        back = paginate_by_cursor(u1.followed_posts(), Post, 2, after=page3.prev_cursor)
+        self.assertEqual(back.items, expected[2:4])
+        self.assertRaises(ValueError, paginate_by_cursor, u1.followed_posts(), Post, 2, before="not-a-cursor")
+
+
+class TestTimelineCase(TestUserModelCase):
+    # Runs every user model test again with the materialized timeline enabled.
+    config_class = TimelineTestConfig
+
+    def make_users(self, *names):
+        users = []
+        for name in names:
+            u = User(username=name, email=f"{name}@example.com")
+            u.set_password("cat")
+            users.append(u)
+        db.session.add_all(users)
+        db.session.commit()
+        return users
+
+    def test_fan_out_and_delete(self):
+        u1, u2 = self.make_users("john", "susan")
+        u1.follow(u2)
+        db.session.commit()
+        p = Post(title="Title", subtitle="Subtitle", body="post from susan", author=u2)
+        db.session.add(p)
+        db.session.commit()
+        self.assertTrue(p.fanned_out)
+        self.assertEqual(u1.followed_posts().all(), [p])
+        self.assertEqual(u2.followed_posts().all(), [p])
+
+        db.session.delete(p)
+        db.session.commit()
+        self.assertEqual(u1.followed_posts().all(), [])
+
+    def test_popular_author_is_pulled(self):
+        self.app.config["TIMELINE_FANOUT_LIMIT"] = 0
+        u1, u2 = self.make_users("john", "susan")
+        u1.follow(u2)
+        db.session.commit()
+        p = Post(title="Title", subtitle="Subtitle", body="post from susan", author=u2)
+        db.session.add(p)
+        db.session.commit()
+        self.assertFalse(p.fanned_out)
+        self.assertEqual(u1.followed_posts().all(), [p])
+
+        u1.unfollow(u2)
+        db.session.commit()
+        self.assertEqual(u1.followed_posts().all(), [])
+
+    def test_posts_from_before_timeline(self):
+        u1, u2 = self.make_users("john", "susan")
+        self.app.config["TIMELINE_ENABLED"] = False
+        p1 = Post(title="Title 1", subtitle="Subtitle 1", body="post from john", author=u1)
+        p2 = Post(title="Title 2", subtitle="Subtitle 2", body="post from susan", author=u2)
+        db.session.add_all([p1, p2])
+        u1.follow(u2)
+        db.session.commit()
+        self.app.config["TIMELINE_ENABLED"] = True
+        self.assertEqual(set(u1.followed_posts().all()), {p1, p2})
+        self.assertEqual(u2.followed_posts().all(), [p2])
+
+    def test_rebuild_timelines(self):
+        u1, u2 = self.make_users("john", "susan")
+        self.app.config["TIMELINE_ENABLED"] = False
+        p1 = Post(title="Title 1", subtitle="Subtitle 1", body="post from john", author=u1)
+        p2 = Post(title="Title 2", subtitle="Subtitle 2", body="post from susan", author=u2)
+        db.session.add_all([p1, p2])
+        u1.follow(u2)
+        db.session.commit()
+        self.app.config["TIMELINE_ENABLED"] = True
+        self.assertEqual(rebuild_timelines(), 3)
+        self.assertEqual(set(u1.followed_posts().all()), {p1, p2})
+        self.assertEqual(u2.followed_posts().all(), [p2])
+
+
+class TestSearchCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(config_class=TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        u = User(username="john", email="john@example.com")
+        u.set_password("cat")
+        self.post = Post(title="Title", subtitle="Subtitle", body="post from john", author=u)
+        db.session.add_all([u, self.post])
+        db.session.commit()
+
+    def tearDown(self):
+        self.app.last_seen_buffer.flush()
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def test_updates_are_coalesced(self):
+        self.post.body = "edited post from john"
+        db.session.commit()
+        self.assertEqual(SearchOutbox.query.count(), 2)
+        with mock.patch("app.indexer.bulk_update", return_value=set()) as bulk_update:
+            self.assertEqual(drain(), 2)
+        bulk_update.assert_called_once_with("post", [self.post], set())
+        self.assertEqual(SearchOutbox.query.count(), 0)
+
+    def test_delete(self):
+        post_id = self.post.id
+        db.session.delete(self.post)
+        db.session.commit()
+        with mock.patch("app.indexer.bulk_update", return_value=set()) as bulk_update:
+            drain()
+        bulk_update.assert_called_once_with("post", [], {post_id})
+
+    def test_failures_are_retried(self):
+        with mock.patch("app.indexer.bulk_update", side_effect=ConnectionError):
+            self.assertEqual(drain(), 1)
+        entry = SearchOutbox.query.one()
+        self.assertEqual(entry.attempts, 1)
+        self.assertGreater(entry.available_at, datetime.utcnow())
+        # Not due again until the backoff has passed.
+        self.assertEqual(drain(), 0)
+
+    def test_rollback_discards_entries(self):
+        self.post.body = "edited post from john"
+        db.session.flush()
+        db.session.rollback()
+        self.assertEqual(SearchOutbox.query.count(), 1)
+
+    def test_search(self):
+        p2 = Post(
+            title="Gardening", subtitle="Tomatoes", body="<p>Growing tomatoes on a balcony</p>", author=self.post.author
+        )
+        p3 = Post(
+            title="Tomatoes",
+            subtitle="Tomato soup",
+            body="<p>Tomatoes, tomatoes and more tomatoes</p>",
+            author=self.post.author,
+        )
+        db.session.add_all([p2, p3])
+        db.session.commit()
+        drain()
+        posts, total = Post.search("tomatoes", 1)
+        self.assertEqual(total, 2)
+        self.assertEqual(posts.items, [p3, p2])
+        posts, total = Post.search("john OR balcony", 1)
+        self.assertEqual(total, 2)
+        # Markup is not indexed.
+        self.assertEqual(Post.search("p", 1)[1], 0)
+
+        db.session.delete(p3)
+        p2.title = "Balcony"
+        db.session.commit()
+        drain()
+        posts, total = Post.search("tomatoes", 1)
+        self.assertEqual(posts.items, [p2])
+
+    def test_search_pages(self):
+        posts = [
+            Post(title=f"Tomatoes {i}", subtitle="Subtitle", body="body", author=self.post.author) for i in range(5)
+        ]
+        db.session.add_all(posts)
+        db.session.commit()
+        drain()
+        self.app.config["SEARCH_TRACK_TOTAL_HITS"] = 4
+        self.app.config["SEARCH_MAX_RESULT_WINDOW"] = 2
+        page1, total = Post.search("tomatoes", 1, per_page=2)
+        self.assertEqual(total, 4)
+        self.assertTrue(page1.total_is_capped)
+        self.assertIsNotNone(page1.next_cursor)
+        page2, _ = Post.search("tomatoes", 2, per_page=2, after=page1.next_cursor)
+        page3, _ = Post.search("tomatoes", 3, per_page=2, after=page2.next_cursor)
+        # The count stops at 4, but the fifth hit is still reachable.
+        self.assertTrue(page2.has_next)
+        self.assertEqual(len(page3.items), 1)
+        self.assertEqual(set(page1.items + page2.items + page3.items), set(posts))
+        self.assertRaises(ValueError, Post.search, "tomatoes", 2, after="not-a-cursor")
+
+        # Going back from a page past the window uses a cursor too, as its page number can't be fetched directly.
+        self.assertIsNotNone(page3.prev_cursor)
+        self.assertIsNone(page2.prev_cursor)
+        back, _ = Post.search("tomatoes", 2, per_page=2, before=page3.prev_cursor)
+        self.assertEqual(back.items, page2.items)
+        self.assertRaises(ValueError, Post.search, "tomatoes", 2, per_page=2)
+        self.assertEqual(list(page3.iter_pages()), [1, None])
+
+        client = self.app.test_client()
+        with client.session_transaction() as session:
+            session["_user_id"] = str(self.post.author.id)
+        self.app.config["POSTS_PER_PAGE"] = 2
+        self.assertEqual(client.get("/search?q=tomatoes&page=2").status_code, 400)
+        response = client.get(f"/search?q=tomatoes&page=3&after={page2.next_cursor}")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(f"before={page3.prev_cursor}".encode(), response.data)
+
+    def test_search_from_source(self):
+        self.app.config["SEARCH_RENDER_FROM_SOURCE"] = True
+        drain()
+        sql = self.app.search_backend.conn.execute("SELECT sql FROM sqlite_master WHERE name = 'post'").fetchone()[0]
+        self.assertIn('"timestamp" UNINDEXED, "user_id" UNINDEXED', sql)
+        self.assertEqual(Post.search(str(self.post.author.id), 1)[1], 0)
+        posts, total = Post.search("john", 1)
+        post = posts.items[0]
+        self.assertEqual(total, 1)
+        self.assertEqual(post.id, self.post.id)
+        self.assertEqual(post.timestamp, self.post.timestamp)
+        self.assertEqual(post.author, self.post.author)
+        self.assertNotIn(post, db.session)
+
+    def test_elasticsearch_sorts_on_id_field(self):
+        client = mock.Mock()
+        client.search.return_value = {
+            "hits": {
+                "total": {"value": 1},
+                "hits": [{"_id": "7", "sort": [1.5, 7], "_source": {"title": "t", "id": 7}}],
+            }
+        }
+        backend = ElasticsearchBackend(client)
+        backend.add("post", 7, {"title": "t"})
+        self.assertEqual(client.index.call_args.kwargs["document"], {"title": "t", "id": 7})
+        backend.create_index("post-1")
+        self.assertEqual(client.indices.create.call_args.kwargs["mappings"]["properties"]["id"], {"type": "long"})
+        hits, total = backend.query("post", "t", ["title"], 1, 10, 100, source=True)
+        self.assertEqual(hits, [{"id": 7, "sort": [1.5, 7], "source": {"title": "t"}}])
+        self.assertNotIn("_id", json.dumps(client.search.call_args.kwargs["body"]["sort"]))
+
+    def test_reindex_into_new_index_deletes_old_ones(self):
+        backend = self.app.search_backend
+        with mock.patch.object(backend, "swap_alias", return_value=["post-old"]) as swap_alias:
+            with mock.patch.object(backend, "delete_index") as delete_index:
+                self.assertEqual(Post.reindex(new_index=True), 1)
+        self.assertRegex(swap_alias.call_args.args[1], r"^post-\d{14}$")
+        delete_index.assert_called_once_with("post-old")
+
+    def test_reindex_resumes_from_checkpoint(self):
+        posts = [Post(title=f"Title {i}", subtitle="Subtitle", body="body", author=self.post.author) for i in range(4)]
+        db.session.add_all(posts)
+        db.session.commit()
+        ids = sorted(p.id for p in posts + [self.post])
+        checkpoint = os.path.join(tempfile.mkdtemp(), "reindex.json")
+        sent = []
+        failures = [ConnectionError]
+
+        def send_bulk(index, docs):
+            if len(sent) == 2 and failures:
+                raise failures.pop()
+            sent.append([id for id, _ in docs])
+
+        with mock.patch.object(self.app.search_backend, "send_bulk", side_effect=send_bulk):
+            with self.assertRaises(ConnectionError):
+                Post.reindex(chunk_size=2, workers=1, checkpoint=checkpoint)
+            self.assertTrue(os.path.exists(checkpoint))
+            self.assertEqual(Post.reindex(chunk_size=2, workers=1, checkpoint=checkpoint, resume=True), 1)
+        self.assertEqual(sent, [ids[0:2], ids[2:4], ids[4:]])
+        self.assertFalse(os.path.exists(checkpoint))
+
+
+class TestReadReplicaCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        primary = os.path.join(self.directory, "primary.db")
+        replica = os.path.join(self.directory, "replica.db")
+
+        class ReplicaTestConfig(TestConfig):
+            SQLALCHEMY_DATABASE_URI = "sqlite:///" + primary
+            READ_REPLICA_URLS = ["sqlite:///" + replica]
+
+        self.app = create_app(config_class=ReplicaTestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.user = User(username="john", email="john@example.com")
+        self.user.set_password("cat")
+        db.session.add(self.user)
+        db.session.commit()
+        # The replica has caught up to this point, but not with the post added below. The checkpoint moves the
+        # committed rows from the write-ahead log into the database file.
+        db.session.execute(db.text("PRAGMA wal_checkpoint(TRUNCATE)"))
+        shutil.copyfile(primary, replica)
+        self.post = Post(title="Title", subtitle="Subtitle", body="post from john", author=self.user)
+        db.session.add(self.post)
+        db.session.commit()
+
+    def tearDown(self):
+        self.app.last_seen_buffer.flush()
+        db.session.remove()
+        for engine in db.engines.values():
+            engine.dispose()
+        self.app_context.pop()
+        shutil.rmtree(self.directory)
+
+    def test_read_only_views_use_replica(self):
+        client = self.app.test_client()
+        with client.session_transaction() as session:
+            session["_user_id"] = str(self.user.id)
+        self.assertEqual(client.get(f"/post/{self.post.id}").status_code, 404)
+        self.assertEqual(client.get(f"/api/v1/posts/{self.post.id}").status_code, 404)
+        # Views that are not marked read-only always use the primary.
+        self.assertEqual(client.get(f"/edit_post/{self.post.id}").status_code, 200)
+        self.assertIsNone(db.session.info.get("replica"))
+
+    def test_reads_after_writes_use_primary(self):
+        with self.app.test_request_context():
+            db.session.info["replica"] = db.engines["replica0"]
+            self.assertEqual(db.session.scalar(db.select(db.func.count(Post.id))), 0)
+            db.session.add(Post(title="Another", subtitle="Subtitle", body="another post", user_id=self.user.id))
+            db.session.flush()
+            self.assertNotIn("flushing", db.session.info)
+            self.assertEqual(db.session.scalar(db.select(db.func.count(Post.id))), 2)
+            db.session.rollback()
+
+        self.app.config["WTF_CSRF_ENABLED"] = False
+        client = self.app.test_client()
+        with client.session_transaction() as session:
+            session["_user_id"] = str(self.user.id)
+        data = {"title": "New", "subtitle": "Subtitle", "body": "new post"}
+        self.assertEqual(client.post("/new_post", data=data).status_code, 302)
+        # The writer keeps reading from the primary for a while after the write.
+        new_post = Post.query.filter_by(title="New").one()
+        self.assertEqual(client.get(f"/post/{new_post.id}").status_code, 200)
+        with client.session_transaction() as session:
+            session["read_primary_until"] = time.time() - 1
+        self.assertEqual(client.get(f"/post/{new_post.id}").status_code, 404)
+
 
 if __name__ == "__main__":
     unittest.main(verbosity=2)